@@ -1,4 +1,111 @@
 # LINE Task Bot
 render.neon
 
-This is a LINE bot running on Render.
\ No newline at end of file
+This is a LINE bot running on Render.
+## 環境変数
+
+- `DATABASE_URL` : Postgres（Neon）の接続先
+- `LINE_CHANNEL_ACCESS_TOKEN` : LINE Messaging API のトークン
+- `LINE_CHANNEL_SECRET` : 設定すると webhook の署名（X-Line-Signature）をチェックする
+- `WEBHOOK_MODE` : `sync`（既定：処理してから 200） / `async`（キューに積んですぐ 200、ワーカースレッドで処理）
+- `BATCH_WORKERS` : 1回の webhook に複数ユーザーのイベントがあるとき、並列に処理するスレッド数（既定 4）
+- `WEBHOOK_DEDUP_TTL` / `WEBHOOK_DEDUP_CACHE_SIZE` : 処理済み webhookEventId を覚えておく秒数 / メモリに持つ件数（再送の重複処理防止）
+- `EVENT_WORKERS` / `EVENT_QUEUE_SIZE` / `EVENT_ENQUEUE_TIMEOUT` : `async` のワーカー数 / キューの上限 / 満杯のとき待つ秒数（超えたら 503。1回の webhook の分は全部積むか1つも積まないか。1つのワーカーのキューに入りきらない数が来たときは、空くのを待ってから順に積む）
+- `DB_POOL_MIN_SIZE` / `DB_POOL_MAX_SIZE` : DBコネクションプールの最小/最大（既定 1 / 5）
+- `DB_POOL_MAX_IDLE` / `DB_POOL_MAX_LIFETIME` / `DB_POOL_TIMEOUT` : 未使用接続を閉じる秒数 / 接続を作り直す秒数 / 空き待ちの上限秒数
+- `STORAGE_MODE` : `relational`（既定：テーブル分割） / `kv`（旧方式：kv_store の1行に全部入り）
+- `STORAGE_BACKEND` : 保存先。`postgres`（既定） / `sqlite`（1ファイル・WAL。gunicorn の複数ワーカーで共有できる） / `memory`（プロセスの中だけ。再起動で消える・ワーカーごとに別。手元の確認用）。どれも版数はユーザー・集会所・グループごとで、別のユーザー同士の保存はぶつからない。`STORAGE_MODE` と読み込みキャッシュは `postgres` のときだけ
+- `SQLITE_PATH` / `SQLITE_BUSY_TIMEOUT` : `sqlite` のファイル（既定 tasks.db）/ 他のプロセスが書いている間に待つ秒数（既定 5）
+- `STATE_MAX_RETRIES` / `STATE_RETRY_BASE` / `STATE_RETRY_CAP` : 同時に保存がぶつかったときのやり直し回数 / 待ち時間の基準秒 / 上限秒
+- `STATE_CACHE` / `STATE_CACHE_SIZE` / `STATE_CACHE_TTL` : 読み込みキャッシュ（`0` で無効、既定 1 / 1000件 / 60秒）。保存すると NOTIFY で全ワーカーのキャッシュを捨てる
+- `KV_PATCH_MAX_OPS` : `kv` のとき、部分更新（jsonb_set など）で書く操作数の上限。超えたら丸ごと書く（既定 32）
+- `FLEX_CACHE_SIZE` : 組み立て＋JSON 化済みの Flex 画面を覚えておく数（既定 512）。キーは読んだ範囲の版数＋ UI フラグ・カーソルなので、保存すれば次は作り直す
+- `FLEX_PAGE_ROWS` / `FLEX_BUBBLE_MAX_BYTES` / `FLEX_CAROUSEL_MAX_BYTES` : 予定表・伝言板・集会所一覧・チェックリストの1ページの行数 / bubble・carousel のサイズ上限（既定 20 / 25000 / 45000。LINE の上限は 30KB / 50KB）
+- `SPACE_NOTIFY` / `SPACE_NOTIFY_DELAY` : `1` で集会所に全体予定が追加されたとき、ほかのメンバーに multicast で知らせる（既定 0）/ その秒数の間の追加は1通にまとめる（既定 5）
+- `LINE_CONNECT_TIMEOUT` / `LINE_READ_TIMEOUT` : LINE API の接続/応答タイムアウト秒（既定 3.05 / 10）
+- `LINE_MAX_RETRIES` / `LINE_RETRY_BASE` / `LINE_RETRY_MAX_WAIT` : 5xx・429・通信エラー時の再送回数 / 待ち時間の基準秒 / 上限秒
+- `LINE_POOL_SIZE` : LINE API への keep-alive 接続数（既定 10）
+- `LINE_RATE_REPLY` / `LINE_RATE_PUSH` / `LINE_RATE_MULTICAST` : 1秒あたりに送る上限（既定 1000 / 1000 / 100）。429 を受けたら Retry-After の間そのエンドポイントを止める
+- `LINE_RATE_WAIT_REPLY` / `LINE_RATE_WAIT_PUSH` / `LINE_RATE_WAIT_MULTICAST` : 順番待ちの上限秒（既定 5 / 30 / 60）。過ぎたら送らない
+- `LINE_RATE_BURST` : 何秒分まで溜めて一気に送れるか（既定 1）
+- `LINE_QUOTA_CHECK` / `LINE_QUOTA_REFRESH` : `1` で月の送信数の上限と使用数を LINE に聞き、超えそうなら push は reply に切り替え・集会所の通知は送らない（既定 0）/ 聞き直す秒数（既定 600）
+- `LOG_LEVEL` / `LOG_FORMAT` : ログのレベル（既定 INFO）/ `json`（既定：1行1 JSON）か `text`（手元で読む用）。ログは別スレッドが書き出す
+- `LOG_DEBUG_SAMPLE` : DEBUG（webhook の受信・LINE の 200 応答など）を残す割合（既定 0.01、同じイベントの分はまとめて残す）
+- `LOG_QUEUE_SIZE` / `LOG_BODY_MAX` : 書き出し待ちの上限（溢れたら捨てて `linebot_errors_total{kind="log_dropped"}` に数える、既定 10000）/ LINE のエラー応答の本文を載せる文字数（既定 1000）
+- `LOG_USER_SALT` : ログの `user`（user_id のハッシュ）に混ぜる値。ログには trace_id・route・user が付く
+
+## 起動
+
+本番は gunicorn（設定は `gunicorn.conf.py`）：`gunicorn -c gunicorn.conf.py app:app`。
+`python app.py` は開発用サーバー。
+
+- `GUNICORN_WORKER_CLASS` : `gthread`（既定） / `gevent`（`pip install gevent` が必要）
+- `WEB_CONCURRENCY` / `GUNICORN_THREADS` / `GUNICORN_WORKER_CONNECTIONS` : ワーカープロセス数 / gthread のスレッド数 / gevent の同時接続数（既定 2 / 8 / 200）
+- `GUNICORN_TIMEOUT` / `GUNICORN_GRACEFUL_TIMEOUT` : 固まったワーカーを入れ替える秒数 / 止めるときに処理中・キューのイベントを待つ秒数（既定 30 / 30）
+- `GUNICORN_PRELOAD` : `1`（既定）で app を親で読み込んでから fork。テーブル作成・移行は親で1回だけ、接続は子ごとに作り直す
+
+### 非同期モード（app_async.py）
+
+aiohttp + async psycopg で `/webhook` を受ける。DB・LINE API を待っている間も別のイベントを進めるので、
+1プロセスで多くのイベントを同時に処理できる。イベントの処理（ハンドラ・保存・返信）は app.py と同じものを使う。
+
+- `python app_async.py`、または `GUNICORN_WORKER_CLASS=aiohttp.GunicornWebWorker gunicorn -c gunicorn.conf.py app_async:create_app`
+- `ASYNC_MAX_INFLIGHT` : 1プロセスで同時に処理するイベントの上限（既定 100）
+
+## 保存先の移行
+
+`relational` で起動すると、最初の1回だけ旧 kv_store の "tasks" をテーブルに展開する。
+手動でやり直すときは `python app.py migrate --force`。
+
+保存先を足すときは `Storage` を継承して `STORAGE_BACKENDS` に登録し、`tests/test_storage.py` の `BACKENDS` に名前を足して
+`python -m pytest tests` が通ることを確かめる（読み書き・1ユーザー分の保存で他の人の中身が変わらないこと・合言葉での参加・
+StateConflict・bench と同じ大きさのデータにスレッドから `run_in_uow` で同時に書いて、本番と同じ `STATE_MAX_RETRIES` 回の
+やり直しで変更が失われないこと・集会所ID・再送の印。全部の保存先で同じテストを流す）。
+`postgres` は `TEST_DATABASE_URL` を指定したときだけ流す（中身を消すので本番の DB には使わない。`STORAGE_MODE` で relational / kv。
+kv は1行に全部入りで版数も1つなので、別の人とぶつからないことと同時書き込みのテストは飛ばす）。
+
+## 計測
+
+`GET /metrics` : Prometheus のテキスト形式。webhook 全体・ルート（postback の種類）ごとの処理時間とエラー数、
+load_tasks / save_tasks の時間と `kv` のときの読み書きバイト数、LINE API の時間（エンドポイント・ステータス別）、
+エラー数（種類別）、「DB が一時的に不調」の返信数。
+ルートごとの1イベントの読み書き回数（`linebot_uow_*`。2回以上読んだ・書いたイベントは `linebot_uow_over_budget_total`）。
+保存の競合（`linebot_state_conflicts_total{outcome="retried"|"gave_up"}`）。
+`WEBHOOK_MODE=async` のキューの深さ・上限（gauge）と待ち時間、積んだ数・断った数（`linebot_event_queue_*`）。
+再送の重複チェック（`linebot_webhook_dedup_total{result}`：claimed / duplicate_memory / duplicate_db / released）。
+読み込みキャッシュのヒット・ミス（ヒット率は `hit / 全部`）、捨てた数、NOTIFY の受信数、件数（`linebot_state_cache_*`）。
+Flex のキャッシュのヒット・ミス・bypass（画面の種類別。bypass は同じイベントで書き換えた直後の画面）とミスしたときの組み立て時間（`linebot_flex_*`）。
+LINE API の順番待ち（送れた・諦めた数と待ち時間）、429 の回数、再送の回数、push/multicast で使った通数、`LINE_QUOTA_CHECK=1` なら月の上限と使用数（`linebot_line_*`）。
+集会所のお知らせ（まとめた数・multicast の回数・失敗・上限で送らなかった人数・待っている数、`linebot_space_notify_*`）。
+DB 接続プールの空き待ち時間（`linebot_db_pool_wait_seconds`）と大きさ・空き・待っている数（`linebot_db_pool_*`）。
+
+- `METRICS_TOKEN` : 指定すると `Authorization: Bearer <トークン>` が無い /metrics は 401
+- `METRICS_DIR` / `METRICS_FLUSH_INTERVAL` : gunicorn で複数ワーカーのとき、各ワーカーがこのディレクトリに自分の分を書き（既定 5 秒ごと）、
+  /metrics は全ワーカー分を足して返す（gauge は生きているワーカーの分だけ）。指定しないと、受けたワーカーの分だけ。起動時に前回の分は消す
+
+遅いイベント：1イベントごとにトレース ID（LINE の webhookEventId）を付けて、DB 接続の空き待ち・読み込み・JSON の解析・
+Flex の組み立て・保存・LINE API の時間を数え、`TRACE_SLOW_MS`（既定 1000）を超えたら `slow event` のログ（`spans` に内訳）を出す。
+
+`/admin/profile?seconds=N` : N 秒（上限 `PROFILE_MAX_SECONDS`、既定 60）の間、全スレッドのスタックを `PROFILE_INTERVAL`（既定 5ms）ごとに数えて、
+collapsed 形式（flamegraph.pl / speedscope で読める）で返す。`ADMIN_TOKEN` を設定して `Authorization: Bearer <トークン>` を付ける（未設定なら 404）。
+例：`curl -H "Authorization: Bearer $ADMIN_TOKEN" "https://.../admin/profile?seconds=30" > profile.txt && flamegraph.pl profile.txt > profile.svg`
+
+- `python app.py bench-router` : postback の振り分け（dict + trie）と、前の if/elif 相当の1回あたりの時間を比べる
+- `python app_async.py bench [--events N] [--users N] [--concurrency N] [--async-concurrency N] [--line-latency 秒]` : 同期モード（Flask + スレッド）と非同期モードの events/s を比べる（LINE API は応答に指定秒かかる手元のスタブ）。
+  非同期は `--concurrency` と同じ同時数、`--async-concurrency`（既定 `ASYNC_MAX_INFLIGHT`）の両方で測る。
+  例（手元の Postgres、DB プール 5、LINE の応答 50ms、300イベント・50ユーザー）：
+
+  | 同時数 | 同期（スレッド） | 非同期（in-flight） |
+  |---|---|---|
+  | 8 | 74 events/s | 83 events/s |
+  | 100 | 272 events/s | 247 events/s |
+
+  同じ同時数ならほぼ同じ。非同期の良いところは速さではなく、同時 100 をスレッド 100 本なしで（1スレッド・greenlet で）持てること
+- `BENCH_DATABASE_URL=... python bench.py [--sizes 10,100,500] [--users N] [--spaces N] [--checklists N] [--events N] [--mix 種類=重み,...] [--gunicorn] [--json 結果.json]` :
+  データを作って（⚠️ BENCH_DATABASE_URL の DB は毎回作り直す）、予定一覧・集会所の完了・チェックの切り替え・伝言板の並べ替え・「個人予定を追加」→入力 を混ぜて /webhook に流し、
+  データの大きさ（1人あたりの予定・伝言板、リスト1つの項目、集会所1つの予定の数）ごと・ルートごとに events/s と p50/p95/p99 を出す。
+  同じユーザーの操作は順番に流す（別のユーザー同士を同時に）。`errors` は 200 以外の応答と、スタブに届いた「DB が一時的に不調」の返信（ハンドラの例外）の数。
+  既定は Flask の test client、`--gunicorn` なら gunicorn.conf.py で起動して HTTP で叩く。LINE API は手元のスタブ（`--line-latency 秒`）。
+  `STORAGE_BACKEND=sqlite`（`SQLITE_PATH` を作り直す）/ `memory` なら BENCH_DATABASE_URL は要らない（`memory` は `--gunicorn` 不可）。
+  `--check-uow` なら測らずに、登録されている全ルートの postback を1つずつ流して「1イベントで読むのは1回・書くのは1回まで」かを確かめる（だめなら終了コード 1。同じことを `tests/test_uow.py` でも memory で流す）。
+  大きさを増やしたときに遅くなり方が変わったら（読み込みが全体の大きさに比例し始めた等）要注意。`--json` の結果を前回と比べる。
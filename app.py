@@ -1,50 +1,67 @@
 from flask import Flask, request
 import requests
+import requests.adapters
 import os
 import psycopg
 from psycopg.rows import dict_row
 from psycopg.types.json import Jsonb
-import traceback
 import re
+import copy
+import sys
+import time
+import atexit
+import threading
+import sqlite3
+import logging
+import logging.handlers
+import contextvars
+import random
+import uuid
+import secrets
+import email.utils
+import queue
+import zlib
+import hmac
+import hashlib
+import bisect
+import base64
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque, namedtuple
+from psycopg_pool import ConnectionPool
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-def db_ping():
-    if not DATABASE_URL:
-        print("❌ DATABASE_URL is missing")
-        return False
-    try:
-        with psycopg.connect(DATABASE_URL) as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1;")
-                cur.fetchone()
-        print("✅ DB connected (SELECT 1 OK)")
-        return True
-    except Exception as e:
-        print("❌ DB connection failed:", e)
-        return False
 import json
 
 app = Flask(__name__)
 
 DB_READY = False
+_db_ready_lock = threading.Lock()
 
 def ensure_db_ready():
     global DB_READY
     if DB_READY:
         return True
-    try:
-        init_db()          # テーブル作成
-        DB_READY = True
-        print("✅ init_db done (once)")
-        return True
-    except Exception as e:
-        print("❌ init_db failed:", e)
-        DB_READY = False
-        return False
+    io = _async_io.get()
+    if io is not None:
+        # 非同期モード：イベントループのスレッドでロックを待つと全部止まるので、別スレッドで作る
+        return io.run_blocking(ensure_db_ready)
+    # 並列に処理してるイベントが同時にテーブル作成しないように
+    with _db_ready_lock:
+        if DB_READY:
+            return True
+        try:
+            storage().init()   # テーブル作成
+            DB_READY = True
+            log.info("init_db done")
+            return True
+        except Exception as e:
+            log.error("init_db failed", exc_info=True)
+            DB_READY = False
+            return False
 
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-print("TOKEN EXISTS:", bool(LINE_CHANNEL_ACCESS_TOKEN))
 
 user_states = {}
 DATA_FILE = "tasks.json"
@@ -60,34 +77,486 @@ DEFAULT_TASKS = {
     "spaces": {},           # space_id -> {name, pass, created_by}
     "memberships": {},      # user_id -> [space_id...]
     "active_space": {},      # user_id -> space_id
-    "space_tasks": {},   # space_id -> [ {text, done_by: []}, ... ]
+    "space_tasks": {},   # space_id -> [ {text, done_mask: int}, ... ]（done_mask は完了したメンバーのビット）
+    "space_ordinals": {},   # space_id -> {user_id: ビット番号}（集会所ごとに 0 から振る）
 }
 
+# 保存先： "postgres"（既定） / "sqlite" / "memory"（下の Storage を参照）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+# postgres の保存方式： "relational"（テーブル分割・既定） / "kv"（旧方式：kv_store の1行に全部入り）
+STORAGE_MODE = os.getenv("STORAGE_MODE", "relational")
+
+# 旧 kv_store → テーブル分割 の移行が終わった印（kv_store のキー）
+MIGRATED_KEY = "relational_migrated"
+MIGRATION_LOCK_ID = 7310001
+INIT_LOCK_ID = 7310002
+
+# コネクションプール（プロセスごとに1つ。接続のたびに TCP+TLS+認証 をやり直さない）
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))          # 秒：使われてない接続を閉じる
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))  # 秒：古い接続は作り直す
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))             # 秒：空き待ちの上限
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global _db_pool, _db_pool_pid
+    pid = os.getpid()
+    if _db_pool is not None and _db_pool_pid == pid:
+        return _db_pool
+
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != pid:
+            # fork 後の子プロセスは親の接続を使わない（閉じると親の接続まで切れるので捨てるだけ）
+            _db_pool = ConnectionPool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=max(DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE),
+                max_idle=DB_POOL_MAX_IDLE,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                timeout=DB_POOL_TIMEOUT,
+                check=ConnectionPool.check_connection,   # 貸し出す前に生きてるか確認（Neon の idle 切断対策）
+                kwargs={"row_factory": dict_row},
+                name=f"line-task-bot-{pid}",
+                open=True,
+            )
+            _db_pool_pid = pid
+    return _db_pool
+
+def close_db_pool():
+    global _db_pool, _db_pool_pid
+    with _db_pool_lock:
+        if _db_pool is not None and _db_pool_pid == os.getpid():
+            _db_pool.close()
+        _db_pool = None
+        _db_pool_pid = None
+
+atexit.register(close_db_pool)
+
+def get_db_pool_stats():
+    """プールの状態（psycopg_pool の統計）。空き待ち時間は linebot_db_pool_wait_seconds"""
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        return _db_pool.get_stats()
+    return {}
+
+# 非同期モード（app_async.py）でイベントを処理している間だけ入る I/O の差し替え先。
+# db_connect() / line_client() / pause() はこれがあれば async の接続・HTTP・sleep を使う（処理の中身は同じ）
+_async_io = contextvars.ContextVar("async_io", default=None)
+
+def pause(seconds):
+    """time.sleep の代わり（非同期モードではイベントループを止めない）"""
+    io = _async_io.get()
+    if io is not None:
+        io.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+@contextmanager
 def db_connect():
+    """
+    プールから接続を借りる。with を抜けると commit（例外なら rollback）して返す。
+    """
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL が未設定です（Renderの環境変数に入れてね）")
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+
+    io = _async_io.get()
+    if io is not None:
+        t0 = time.perf_counter()
+        with io.db_connect() as conn:
+            wait = time.perf_counter() - t0
+            trace_add("db_connect", wait)
+            metrics.observe("linebot_db_pool_wait_seconds", wait)
+            yield conn
+        return
+
+    pool = get_db_pool()
+    t0 = time.perf_counter()
+    with pool.connection() as conn:
+        wait = time.perf_counter() - t0
+        trace_add("db_connect", wait)
+        metrics.observe("linebot_db_pool_wait_seconds", wait)
+        yield conn
+
+RELATIONAL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS app_users (
+        user_id TEXT PRIMARY KEY,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+
+    CREATE TABLE IF NOT EXISTS personal_tasks (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        pos INTEGER NOT NULL,
+        text TEXT NOT NULL DEFAULT '',
+        status TEXT,
+        extra JSONB NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS personal_tasks_user_idx ON personal_tasks (user_id, pos);
+
+    CREATE TABLE IF NOT EXISTS group_tasks (
+        id BIGSERIAL PRIMARY KEY,
+        group_id TEXT NOT NULL,
+        pos INTEGER NOT NULL,
+        text TEXT NOT NULL DEFAULT '',
+        done_by JSONB NOT NULL DEFAULT '[]',
+        extra JSONB NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS group_tasks_group_idx ON group_tasks (group_id, pos);
+
+    CREATE TABLE IF NOT EXISTS spaces (
+        space_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL DEFAULT '',
+        pass TEXT NOT NULL DEFAULT '',
+        created_by TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS memberships (
+        user_id TEXT NOT NULL,
+        space_id TEXT NOT NULL,
+        pos INTEGER NOT NULL,
+        PRIMARY KEY (user_id, space_id)
+    );
+    CREATE INDEX IF NOT EXISTS memberships_space_idx ON memberships (space_id);
+
+    CREATE TABLE IF NOT EXISTS active_spaces (
+        user_id TEXT PRIMARY KEY,
+        space_id TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS space_tasks (
+        id BIGSERIAL PRIMARY KEY,
+        space_id TEXT NOT NULL,
+        pos INTEGER NOT NULL,
+        text TEXT NOT NULL DEFAULT '',
+        extra JSONB NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS space_tasks_space_idx ON space_tasks (space_id, pos);
+
+    -- 旧形式の完了者（1行 = 1人）。init_db で done_mask に移して空にする
+    CREATE TABLE IF NOT EXISTS space_task_done (
+        task_id BIGINT NOT NULL REFERENCES space_tasks (id) ON DELETE CASCADE,
+        user_id TEXT NOT NULL,
+        done_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+        PRIMARY KEY (task_id, user_id)
+    );
+
+    -- 集会所ごとのメンバーのビット番号（space_tasks.done_mask の何ビット目か）。一度振ったら変えない
+    CREATE TABLE IF NOT EXISTS space_ordinals (
+        space_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        ordinal INTEGER NOT NULL,
+        PRIMARY KEY (space_id, user_id),
+        UNIQUE (space_id, ordinal)
+    );
+
+    CREATE TABLE IF NOT EXISTS checklists (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        pos INTEGER NOT NULL,
+        title TEXT NOT NULL DEFAULT '',
+        extra JSONB NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS checklists_user_idx ON checklists (user_id, pos);
+
+    CREATE TABLE IF NOT EXISTS checklist_items (
+        id BIGSERIAL PRIMARY KEY,
+        checklist_id BIGINT NOT NULL REFERENCES checklists (id) ON DELETE CASCADE,
+        pos INTEGER NOT NULL,
+        text TEXT NOT NULL DEFAULT '',
+        done BOOLEAN NOT NULL DEFAULT false,
+        extra JSONB NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS checklist_items_list_idx ON checklist_items (checklist_id, pos);
+
+    CREATE TABLE IF NOT EXISTS board_items (
+        id BIGSERIAL PRIMARY KEY,
+        owner_type TEXT NOT NULL,
+        owner_id TEXT NOT NULL,
+        pos INTEGER NOT NULL,
+        text TEXT NOT NULL DEFAULT '',
+        extra JSONB NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX IF NOT EXISTS board_items_owner_idx ON board_items (owner_type, owner_id, pos);
+
+    -- 楽観ロック用：範囲（"user:U" / "space:S" / "group:G"）ごとの版数
+    CREATE TABLE IF NOT EXISTS state_versions (
+        scope TEXT PRIMARY KEY,
+        version BIGINT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS ui_settings (
+        user_id TEXT NOT NULL,
+        section TEXT NOT NULL,
+        data JSONB NOT NULL,
+        PRIMARY KEY (user_id, section)
+    );
+
+    -- 項目の固定ID（postback は位置ではなくこれで指す）
+    ALTER TABLE personal_tasks ADD COLUMN IF NOT EXISTS item_id TEXT;
+    ALTER TABLE group_tasks ADD COLUMN IF NOT EXISTS item_id TEXT;
+    ALTER TABLE space_tasks ADD COLUMN IF NOT EXISTS item_id TEXT;
+    ALTER TABLE checklists ADD COLUMN IF NOT EXISTS item_id TEXT;
+    ALTER TABLE checklist_items ADD COLUMN IF NOT EXISTS item_id TEXT;
+    ALTER TABLE board_items ADD COLUMN IF NOT EXISTS item_id TEXT;
+    CREATE INDEX IF NOT EXISTS personal_tasks_item_idx ON personal_tasks (item_id);
+    CREATE INDEX IF NOT EXISTS group_tasks_item_idx ON group_tasks (item_id);
+    CREATE INDEX IF NOT EXISTS space_tasks_item_idx ON space_tasks (item_id);
+    CREATE INDEX IF NOT EXISTS checklists_item_idx ON checklists (item_id);
+    CREATE INDEX IF NOT EXISTS checklist_items_item_idx ON checklist_items (item_id);
+    CREATE INDEX IF NOT EXISTS board_items_item_idx ON board_items (item_id);
+
+    -- 集会所の全体予定を完了したメンバーのビット（64人を超えても入るよう NUMERIC）
+    ALTER TABLE space_tasks ADD COLUMN IF NOT EXISTS done_mask NUMERIC NOT NULL DEFAULT 0;
+"""
+
+# item_id を持つ表（ID の無い古い行は init_db で振る）
+ITEM_ID_TABLES = ["personal_tasks", "group_tasks", "space_tasks", "checklists", "checklist_items", "board_items"]
+# 英小文字1文字 + 7文字（new_item_id() と同じ形）
+ITEM_ID_SQL = "chr(97 + floor(random() * 26)::int) || substr(md5(random()::text || clock_timestamp()::text), 1, 7)"
+
+RELATIONAL_TABLES = [
+    "space_task_done", "space_ordinals", "space_tasks", "checklist_items", "checklists",
+    "personal_tasks", "group_tasks", "board_items", "ui_settings",
+    "active_spaces", "memberships", "spaces", "app_users",
+]
+
 def init_db():
     with db_connect() as conn:
         with conn.cursor() as cur:
+            # 複数プロセスが同時に起動しても CREATE がぶつからないように
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (INIT_LOCK_ID,))
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS kv_store (
                     k TEXT PRIMARY KEY,
                     v JSONB NOT NULL,
                     updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
                 );
-            """)
+                ALTER TABLE kv_store ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
 
-def load_tasks():
-    if not ensure_db_ready():
-        raise RuntimeError("DB_INIT_FAILED")
+                -- 処理済みの webhookEventId（再送の重複防止）
+                CREATE TABLE IF NOT EXISTS webhook_events (
+                    event_id TEXT PRIMARY KEY,
+                    seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                CREATE INDEX IF NOT EXISTS webhook_events_seen_idx ON webhook_events (seen_at);
 
+                -- 集会所ID（s1, s2, ...）の採番
+                CREATE SEQUENCE IF NOT EXISTS space_id_seq;
+            """)
+            if STORAGE_MODE == "relational":
+                cur.execute(RELATIONAL_SCHEMA)
+                migrate_space_task_done(cur)
+            sync_space_id_seq(cur)
+
+    if STORAGE_MODE == "relational":
+        migrate_kv_to_relational()
+        ensure_space_pass_index()
+    backfill_item_ids()
+
+def migrate_space_task_done(cur):
+    """旧形式の space_task_done（完了者1人 = 1行）を space_ordinals + done_mask に移す（一度だけ）"""
+    cur.execute("""
+        SELECT t.space_id, d.task_id, d.user_id FROM space_task_done d
+        JOIN space_tasks t ON t.id = d.task_id
+        ORDER BY d.done_at, d.user_id;
+    """)
+    rows = cur.fetchall()
+    if not rows:
+        return
+    sids = sorted({r["space_id"] for r in rows})
+    cur.execute("SELECT space_id, user_id, ordinal FROM space_ordinals WHERE space_id = ANY(%s);", (sids,))
+    doc = {"space_ordinals": {}}
+    for r in cur.fetchall():
+        doc["space_ordinals"].setdefault(r["space_id"], {})[r["user_id"]] = r["ordinal"]
+    known = {(sid, uid) for sid, m in doc["space_ordinals"].items() for uid in m}
+
+    masks = {}
+    for r in rows:
+        bit = space_member_bit(doc, r["space_id"], r["user_id"], create=True)
+        masks[r["task_id"]] = masks.get(r["task_id"], 0) | bit
+    for sid, m in doc["space_ordinals"].items():
+        for uid, n in m.items():
+            if (sid, uid) not in known:
+                cur.execute("INSERT INTO space_ordinals (space_id, user_id, ordinal) VALUES (%s, %s, %s);",
+                            (sid, uid, n))
+    cur.executemany("UPDATE space_tasks SET done_mask = %s WHERE id = %s;",
+                    [(mask, task_id) for task_id, mask in masks.items()])
+    cur.execute("DELETE FROM space_task_done;")
+    log.info("space_task_done → done_mask migration done", extra={"rows": len(rows)})
+
+def sync_space_id_seq(cur):
+    """今ある "s<番号>" の最大より後から振るように sequence を進める（戻しはしない）"""
+    if STORAGE_MODE == "relational":
+        cur.execute("SELECT MAX(substring(space_id FROM '^s([0-9]+)$')::bigint) AS n FROM spaces;")
+    else:
+        cur.execute("""
+            SELECT MAX(substring(sid FROM '^s([0-9]+)$')::bigint) AS n
+            FROM kv_store, jsonb_object_keys(
+                CASE WHEN jsonb_typeof(v->'spaces') = 'object' THEN v->'spaces' ELSE '{}'::jsonb END
+            ) AS sid
+            WHERE k = %s;
+        """, ("tasks",))
+    n = cur.fetchone()["n"] or 0
+    cur.execute("SELECT last_value, is_called FROM space_id_seq;")
+    row = cur.fetchone()
+    used = row["last_value"] if row["is_called"] else row["last_value"] - 1
+    if n > used:
+        cur.execute("SELECT setval('space_id_seq', %s);", (n,))
+
+def ensure_space_pass_index():
+    """
+    合言葉の一意 index（同じ合言葉で同時に作られても1つになる）。
+    移行したデータに重複があって作れないときは普通の index にしておく。
+    """
     with db_connect() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT v FROM kv_store WHERE k = %s;", ("tasks",))
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (INIT_LOCK_ID,))
+            try:
+                with conn.transaction():
+                    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS spaces_pass_key ON spaces (pass);")
+            except psycopg.errors.UniqueViolation:
+                log.warning("spaces.pass に重複があるので一意 index は作らない")
+                cur.execute("CREATE INDEX IF NOT EXISTS spaces_pass_idx ON spaces (pass);")
+
+def backfill_item_ids():
+    """
+    ID の無い項目（この変更より前のデータ）に ID を振って保存しておく。
+    読むたびに違う ID が振られると、表示した postback が次に押したとき見つからないので。
+    """
+    with db_connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (INIT_LOCK_ID,))
+            if STORAGE_MODE == "relational":
+                n = 0
+                for table in ITEM_ID_TABLES:
+                    cur.execute(f"UPDATE {table} SET item_id = {ITEM_ID_SQL} WHERE item_id IS NULL;")
+                    n += cur.rowcount
+                if n:
+                    notify_state_changed(cur, {"*"})
+                    log.info("item_id を振った", extra={"rows": n})
+                return
+
+            cur.execute("SELECT v, version FROM kv_store WHERE k = %s FOR UPDATE;", ("tasks",))
             row = cur.fetchone()
+            if not row or not isinstance(row["v"], dict):
+                return
+            data = row["v"]
+            if assign_item_ids(data):
+                cur.execute("""
+                    UPDATE kv_store SET v = %s, version = version + 1, updated_at = now() WHERE k = %s;
+                """, (Jsonb(data), "tasks"))
+                notify_state_changed(cur, {"*"})
+                log.info("kv_store の項目に ID を振った")
+
+ITEM_ID_CHARS = "abcdefghijklmnopqrstuvwxyz234567"
+
+def new_item_id():
+    """
+    項目の固定ID（8文字）。先頭は英小文字なので、旧形式の位置（"0", "12"）とは見分けられる。
+    "_" を含まないので postback の区切りともぶつからない。
+    """
+    raw = secrets.token_bytes(8)
+    return ITEM_ID_CHARS[raw[0] % 26] + "".join(ITEM_ID_CHARS[b % 32] for b in raw[1:])
+
+def _item_lists(data):
+    """ID を持つリストを (索引の名前, リスト) で全部"""
+    for section in ("users", "groups", "space_tasks", "checklists"):
+        for owner, items in (data.get(section) or {}).items():
+            yield (section, owner), items
+    for uid, lists in (data.get("checklists") or {}).items():
+        for c in lists:
+            if isinstance(c, dict):
+                yield ("checklist_items", uid, c.get("id")), c.get("items") or []
+    board = data.get("board") or {}
+    for kind in ("users", "groups"):
+        for owner, items in (board.get(kind) or {}).items():
+            yield (f"board_{kind}", owner), items
+
+def assign_item_ids(data):
+    """ID の無い項目に振る。振ったら True"""
+    changed = False
+    for _, items in _item_lists(data):
+        for it in items or []:
+            if isinstance(it, dict) and not it.get("id"):
+                it["id"] = new_item_id()
+                changed = True
+    return changed
+
+def is_position_ref(ref):
+    """旧形式の postback（リストの位置）か"""
+    return ref.isdigit() or (ref.startswith("-") and ref[1:].isdigit())
+
+def _index_items(items):
+    return {it.get("id"): i for i, it in enumerate(items or []) if isinstance(it, dict) and it.get("id")}
+
+def build_item_index(doc):
+    """
+    読み込んだときに1回だけ、全リストの {項目ID: 位置} を作る（読み込みと同じ O(n)）。
+    キャッシュのコピーにはそのまま付いていくので、イベントごとには作り直さない。
+    """
+    doc.item_index = {key: _index_items(items) for key, items in _item_lists(doc)}
 
-    data = row["v"] if row else DEFAULT_TASKS.copy()
+def find_item(tasks, key, items, ref):
+    """
+    postback の ref（項目の ID。旧形式の位置も可）→ items の中の位置。見つからなければ None。
+    key: 索引の名前（("users", user_id) など）。索引は読み込み時に作ってあり、ずれていたらそのリストだけ作り直す。
+    """
+    if ref is None or items is None:
+        return None
+    ref = str(ref)
+    if is_position_ref(ref):
+        pos = int(ref)
+        return pos if 0 <= pos < len(items) else None
+
+    index = tasks.item_index if isinstance(tasks, TaskDoc) else {}
+    pos = index.get(key, {}).get(ref)
+    if pos is not None and pos < len(items) and items[pos].get("id") == ref:
+        return pos
+    # このイベントで追加・削除・並べ替えてずれた → そのリストだけ作り直す
+    # （中の dict はキャッシュのコピー同士で共有しているので、書き換えずに差し替える）
+    built = _index_items(items)
+    if isinstance(tasks, TaskDoc):
+        index[key] = built
+    return built.get(ref)
+
+def item_ref(item, pos):
+    """postback に入れる ref（ID が無ければ位置）"""
+    return item.get("id") or str(pos)
+
+class TaskDoc(dict):
+    """
+    load_tasks() が返す dict（中身の形は今まで通り）。
+    relational のときは「どこまで読んだか」と読んだ時点のスナップショットを持っていて、
+    save_tasks() は変わった行だけ書く。
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.partial = False     # True: 1ユーザー分だけ読んだ doc
+        self.loaded = set()      # {(section, owner)} 読んだ範囲
+        self.row_ids = {}        # {(section, owner): [行ID, ...]}（リストと同じ並び）
+        self.snapshot = {}
+        self.versions = {}       # {scope: 読んだ時点の版数}（無い scope はまだ行が無い）
+        self.pass_index = None   # {合言葉: space_id}（読んである集会所の分。space_pass_index() で作る）
+        self.item_index = {}     # {索引の名前: {項目ID: 位置}}（build_item_index() で作る）
+
+    def is_loaded(self, section, owner):
+        return not self.partial or (section, owner) in self.loaded
+
+    def clone(self):
+        doc = TaskDoc(copy.deepcopy(dict(self)))
+        doc.partial = self.partial
+        doc.loaded = set(self.loaded)
+        doc.row_ids = {k: list(v) for k, v in self.row_ids.items()}
+        doc.snapshot = copy.deepcopy(self.snapshot)
+        doc.versions = dict(self.versions)
+        doc.pass_index = dict(self.pass_index) if self.pass_index is not None else None
+        doc.item_index = dict(self.item_index)   # 中の dict は共有（find_item() は差し替えるだけ）
+        return doc
+
+def normalize_tasks(data):
     data.setdefault("users", {})
     data.setdefault("groups", {})
     data.setdefault("checklists", {})
@@ -99,39 +568,2431 @@ def load_tasks():
     data.setdefault("memberships", {})
     data.setdefault("active_space", {})
     data.setdefault("space_tasks", {})
+    data.setdefault("space_ordinals", {})
+    # 旧形式（完了者のリスト done_by）→ done_mask
+    for sid, items in data["space_tasks"].items():
+        for t in items:
+            if "done_by" in t:
+                mask = t.get("done_mask", 0)
+                for uid in t.pop("done_by") or []:
+                    mask |= space_member_bit(data, sid, uid, create=True)
+                t["done_mask"] = mask
+    assign_item_ids(data)
     return data
 
+def space_member_bit(tasks, sid, user_id, create=False):
+    """集会所の done_mask でそのメンバーを表すビット。未登録なら 0（create=True なら番号を振る）"""
+    ordinals = tasks.get("space_ordinals", {}).get(sid, {})
+    n = ordinals.get(user_id)
+    if n is None:
+        if not create:
+            return 0
+        ordinals = tasks.setdefault("space_ordinals", {}).setdefault(sid, {})
+        n = ordinals[user_id] = len(ordinals)
+    return 1 << n
+
+def is_space_task_done(tasks, sid, task, user_id):
+    return bool(task.get("done_mask", 0) & space_member_bit(tasks, sid, user_id))
+
+def set_space_task_done(tasks, sid, task, user_id, done=True):
+    bit = space_member_bit(tasks, sid, user_id, create=done)
+    if done:
+        task["done_mask"] = task.get("done_mask", 0) | bit
+    else:
+        task["done_mask"] = task.get("done_mask", 0) & ~bit
+
+# =========================
+# メトリクス（/metrics で Prometheus のテキスト形式）
+# =========================
+
+# 書くのはスレッドごとの dict（ロックなし）。/metrics で読むときに全スレッド分を足す。
+# gunicorn で複数ワーカーのとき：METRICS_DIR を指定すると各ワーカーが METRICS_FLUSH_INTERVAL 秒ごとに
+# 自分の分をファイルに書き、/metrics はディレクトリの全ワーカー分（終わったワーカーの分も）を足して返す。
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))   # 秒
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")   # 指定したら Authorization: Bearer <これ> が必要
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (1e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+
+class Metrics:
+    """
+    counter / histogram はここで数える（増やすだけなので、スレッド・ワーカーを足しても正しい）。
+    gauge と、ほかの場所で持っている数（プール・キャッシュ・キューなど）は collector で読むときに集める。
+    labels は (("route", "#done_"), ...) のタプル。
+    """
+    def __init__(self):
+        self.families = {}    # name -> (kind, help, buckets)
+        self._local = threading.local()
+        self._shards = []     # 各スレッドの dict（スレッドが終わっても数は残す）
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._collectors = []
+
+    def define(self, name, kind, help, buckets=None):
+        self.families[name] = (kind, help, tuple(buckets) if buckets else None)
+
+    def collector(self, fn):
+        """
+        fn() -> [(name, labels, 値), ...] を /metrics（と METRICS_DIR への書き出し）のたびに呼ぶ。デコレータで使う。
+        gauge はワーカーごとの今の値（複数ワーカーなら生きているワーカーの分を足す）。
+        """
+        self._collectors.append(fn)
+        return fn
+
+    def _collect_now(self):
+        """このプロセスの分：数えたもの + collector の今の値"""
+        total = self.snapshot()
+        for fn in self._collectors:
+            try:
+                rows = fn()
+            except Exception as e:
+                log.warning("metrics collector failed", extra={"collector": fn.__name__, "error": repr(e)})
+                continue
+            for name, labels, v in rows:
+                _merge_metric(total, (name, tuple(labels)), v)
+        return total
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """histogram：バケツごとの数（累積しない）+ 合計 + 件数"""
+        shard = self._shard()
+        key = (name, labels)
+        buckets = self.families[name][2]
+        h = shard.get(key)
+        if h is None:
+            h = shard[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+        h[bisect.bisect_left(buckets, value)] += 1
+        h[-2] += value
+        h[-1] += 1
+
+    def snapshot(self):
+        """このプロセスの全スレッド分を足したもの"""
+        with self._lock:
+            shards = list(self._shards)
+        total = {}
+        for shard in shards:
+            for key, v in list(shard.items()):
+                _merge_metric(total, key, v)
+        return total
+
+    def reset(self):
+        """fork した子：親の数は持ち越さない"""
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    # ---- 複数ワーカー（METRICS_DIR） ----
+
+    def _path(self, pid=None):
+        return os.path.join(METRICS_DIR, f"metrics_{pid or os.getpid()}.json")
+
+    def flush(self):
+        """このプロセスの分をファイルに書く（書いてから rename するので、読む側が途中を見ない）"""
+        if not METRICS_DIR:
+            return
+        rows = [[name, [list(l) for l in labels], v] for (name, labels), v in self._collect_now().items()]
+        tmp = self._path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(rows, f)
+        os.replace(tmp, self._path())
+
+    def start_flusher(self):
+        if not METRICS_DIR or self._flusher is not None:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+
+        def loop():
+            while True:
+                time.sleep(METRICS_FLUSH_INTERVAL)
+                try:
+                    self.flush()
+                except OSError as e:
+                    log.warning("metrics flush failed", extra={"error": repr(e)})
+
+        self._flusher = threading.Thread(target=loop, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+
+    def collect(self):
+        """/metrics に出す分：METRICS_DIR があれば全ワーカー、なければこのプロセスだけ"""
+        if not METRICS_DIR:
+            return self._collect_now()
+        self.flush()
+        total = {}
+        for fname in os.listdir(METRICS_DIR):
+            if not (fname.startswith("metrics_") and fname.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, fname)) as f:
+                    rows = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # 終わったワーカーの counter は残す（減ると rate() がおかしくなる）が、gauge（今の値）は捨てる
+            pid = fname[len("metrics_"):-len(".json")]
+            alive = pid.isdigit() and _pid_alive(int(pid))
+            for name, labels, v in rows:
+                if not alive and self.families.get(name, ("counter",))[0] == "gauge":
+                    continue
+                _merge_metric(total, (name, tuple(tuple(l) for l in labels)), v)
+        return total
+
+    def render(self):
+        """Prometheus のテキスト形式（version 0.0.4）"""
+        values = self.collect()
+        by_name = {}
+        for (name, labels), v in values.items():
+            by_name.setdefault(name, []).append((labels, v))
+
+        lines = []
+        for name, (kind, help, buckets) in self.families.items():
+            series = by_name.get(name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, v in sorted(series):
+                if kind in ("counter", "gauge"):
+                    lines.append(f"{name}{_metric_labels(labels)} {_metric_value(v)}")
+                    continue
+                cumulative = 0
+                for le, n in zip(buckets + (float("inf"),), v[:-2]):
+                    cumulative += n
+                    le_text = "+Inf" if le == float("inf") else _metric_value(le)
+                    lines.append(f"{name}_bucket{_metric_labels(labels + (('le', le_text),))} {cumulative}")
+                lines.append(f"{name}_sum{_metric_labels(labels)} {_metric_value(v[-2])}")
+                lines.append(f"{name}_count{_metric_labels(labels)} {v[-1]}")
+        return "\n".join(lines) + "\n"
+
+def _merge_metric(total, key, v):
+    if isinstance(v, list):
+        cur = total.get(key)
+        total[key] = list(v) if cur is None else [a + b for a, b in zip(cur, v)]
+    else:
+        total[key] = total.get(key, 0) + v
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _metric_labels(labels):
+    if not labels:
+        return ""
+    def esc(s):
+        return str(s).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+def _metric_value(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+metrics = Metrics()
+metrics.define("linebot_webhook_seconds", "histogram", "Time to handle one /webhook request.", SECONDS_BUCKETS)
+metrics.define("linebot_route_seconds", "histogram", "Time to handle one event, by postback route.", SECONDS_BUCKETS)
+metrics.define("linebot_route_errors_total", "counter", "Events whose handler raised, by postback route.")
+metrics.define("linebot_tasks_load_seconds", "histogram", "load_tasks latency (DB read, not cache hits).", SECONDS_BUCKETS)
+metrics.define("linebot_tasks_save_seconds", "histogram", "save_tasks latency.", SECONDS_BUCKETS)
+metrics.define("linebot_tasks_load_bytes", "histogram", "Bytes read per load_tasks (kv storage).", BYTES_BUCKETS)
+metrics.define("linebot_tasks_save_bytes", "histogram", "Bytes written per save_tasks (kv storage).", BYTES_BUCKETS)
+metrics.define("linebot_line_api_seconds", "histogram", "LINE Messaging API call latency.", SECONDS_BUCKETS)
+metrics.define("linebot_errors_total", "counter", "Errors by kind.")
+metrics.define("linebot_db_fallback_replies_total", "counter", "Replies telling the user the DB is temporarily unavailable.")
+
+# DB 接続プール：psycopg_pool の get_stats() の今の値は gauge、累計は counter
+metrics.define("linebot_db_pool_wait_seconds", "histogram", "Time waiting for a pooled DB connection.", SECONDS_BUCKETS)
+DB_POOL_METRICS = {
+    "pool_max": ("linebot_db_pool_max", "gauge", "Configured maximum pool size."),
+    "pool_size": ("linebot_db_pool_size", "gauge", "Connections currently open (in use + idle)."),
+    "pool_available": ("linebot_db_pool_available", "gauge", "Idle connections ready to hand out."),
+    "requests_waiting": ("linebot_db_pool_waiting", "gauge", "Callers currently waiting for a connection."),
+    "requests_num": ("linebot_db_pool_requests_total", "counter", "Connection requests."),
+    "requests_queued": ("linebot_db_pool_requests_queued_total", "counter", "Connection requests that had to wait."),
+    "requests_errors": ("linebot_db_pool_request_errors_total", "counter", "Connection requests that timed out or failed."),
+    "connections_num": ("linebot_db_pool_connects_total", "counter", "New connections opened."),
+    "connections_lost": ("linebot_db_pool_connections_lost_total", "counter", "Connections found broken by the health check."),
+}
+for _name, _kind, _help in DB_POOL_METRICS.values():
+    metrics.define(_name, _kind, _help)
+
+def db_pool_metrics(stats):
+    """psycopg_pool の get_stats()（sync / async どちらでも）→ collector の行"""
+    if not stats:
+        return []
+    return [(name, (), stats.get(key, 0)) for key, (name, _kind, _help) in DB_POOL_METRICS.items()]
+
+@metrics.collector
+def _collect_db_pool():
+    return db_pool_metrics(get_db_pool_stats())
+
+def metrics_authorized(header):
+    """METRICS_TOKEN が無ければ誰でも見られる"""
+    if not METRICS_TOKEN:
+        return True
+    return hmac.compare_digest(header or "", f"Bearer {METRICS_TOKEN}")
+
+# =========================
+# トレース：1イベントの中で、どこ（DB 接続・読み込み・JSON・Flex・LINE API）に時間がかかったか
+# =========================
+
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))   # これより遅いイベントは内訳をログに出す（0 で全部）
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """1イベント分。spans: 名前 -> [合計秒, 回数]（入れ子の span はそれぞれに数える）"""
+    def __init__(self, trace_id, route=None, user=None):
+        self.trace_id = trace_id
+        self.route = route
+        self.user = user          # ログ用の user_id のハッシュ
+        self.t0 = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name, seconds):
+        s = self.spans.get(name)
+        if s is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            s[0] += seconds
+            s[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.t0
+
+    def breakdown(self):
+        """例: {"db_connect": {"ms": 2.1, "n": 2}, "load_tasks": {"ms": 35.0, "n": 1}}"""
+        return {name: {"ms": round(total * 1000, 1), "n": n} for name, (total, n) in self.spans.items()}
+
+def current_trace():
+    return _current_trace.get()
+
+def trace_add(name, seconds):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+@contextmanager
+def span(name):
+    """トレース中なら with の中の時間を name で足す（トレースの外では何もしない）"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - t0)
+
+@contextmanager
+def start_trace(trace_id=None, route=None, user_id=None):
+    """1イベント分のトレース。終わったときに TRACE_SLOW_MS を超えていたら内訳をログに出す"""
+    trace = Trace(trace_id or uuid.uuid4().hex[:16], route, log_user_hash(user_id))
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        ms = trace.elapsed() * 1000
+        if ms >= TRACE_SLOW_MS:
+            log.warning("slow event", extra={"ms": round(ms, 1), "spans": trace.breakdown()})
+        _current_trace.reset(token)
+
+# =========================
+# ログ：1行1 JSON（LOG_FORMAT=text で手元用の1行テキスト）
+# 書き出しは別スレッド（キュー経由）。処理中のスレッドは stdout を待たない。キューが溢れたら捨てる
+# =========================
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                     # "json" | "text"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "0.01"))   # DEBUG を残す割合（同じトレースの分はまとめて残す）
+LOG_BODY_MAX = int(os.getenv("LOG_BODY_MAX", "1000"))            # LINE の応答本文はここまで
+LOG_USER_SALT = os.getenv("LOG_USER_SALT", "")                    # user_id のハッシュに混ぜる
+
+log = logging.getLogger("linebot")
+
+# LogRecord がもともと持っている属性（これ以外は extra= で渡されたフィールド）
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+def log_user_hash(user_id):
+    """ログには user_id をそのまま出さない"""
+    if not user_id:
+        return None
+    return hashlib.blake2b(user_id.encode(), digest_size=6, key=LOG_USER_SALT.encode()[:64]).hexdigest()
+
+def _log_sampled(trace):
+    if LOG_DEBUG_SAMPLE >= 1:
+        return True
+    if trace is None:
+        return random.random() < LOG_DEBUG_SAMPLE
+    return zlib.crc32(trace.trace_id.encode()) % 10000 < LOG_DEBUG_SAMPLE * 10000
+
+class _LogContext(logging.Filter):
+    """ログを書いたスレッドで：トレース ID・ルート・ユーザー（ハッシュ）を付ける。DEBUG は間引く"""
+    def filter(self, record):
+        trace = _current_trace.get()
+        if record.levelno <= logging.DEBUG and not _log_sampled(trace):
+            return False
+        if trace is not None:
+            record.trace_id = trace.trace_id
+            record.route = trace.route
+            if trace.user:
+                record.user = trace.user
+        return True
+
+class _LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 文字列にするのはここ（書いたスレッド）で。例外の traceback はフィールド exc に
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+            record.exc_text = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("linebot_errors_total", (("kind", "log_dropped"),))
+
+class JsonFormatter(logging.Formatter):
+    def fields(self, record):
+        return {k: v for k, v in vars(record).items() if k not in _LOG_RECORD_ATTRS}
+
+    def format(self, record):
+        ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z"
+        out = {"ts": ts, "level": record.levelname.lower(), "msg": record.getMessage(), "pid": record.process}
+        out.update(self.fields(record))
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class TextFormatter(JsonFormatter):
+    def format(self, record):
+        fields = self.fields(record)
+        exc = fields.pop("exc", None)
+        line = " ".join([record.levelname, record.getMessage()] + [f"{k}={v}" for k, v in fields.items()])
+        return f"{line}\n{exc}" if exc else line
+
+_log_listener = None
+
+def setup_logging():
+    """プロセスに1つ。fork した子でも呼び直す（書き出しスレッドは fork で引き継がれない）"""
+    global _log_listener
+    q = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = _LogQueueHandler(q)
+    handler.addFilter(_LogContext())
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    log.handlers = [handler]
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    _log_listener = logging.handlers.QueueListener(q, out)
+    _log_listener.start()
+
+def stop_logging():
+    """キューに残っている分を書き出してから止める"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+setup_logging()
+atexit.register(stop_logging)
+
+log.info("config", extra={"line_token": bool(LINE_CHANNEL_ACCESS_TOKEN), "backend": STORAGE_BACKEND, "storage": STORAGE_MODE})
+
+# =========================
+# 1イベント = 1 UnitOfWork（読むのは1回、書くのも最後に1回）
+# =========================
+
+_current_uow = contextvars.ContextVar("current_uow", default=None)
+
+# ルート（postback の種類）ごとの読み書き回数。1イベントで2回以上読んだ・書いたら over_budget に数える
+# （python bench.py --check-uow で全ルートを流して確かめる）
+metrics.define("linebot_uow_events_total", "counter", "Events handled in a unit of work, by route.")
+metrics.define("linebot_uow_loads_total", "counter", "State loads (DB reads) by route.")
+metrics.define("linebot_uow_saves_total", "counter", "State saves (DB writes) by route.")
+metrics.define("linebot_uow_over_budget_total", "counter", "Events that loaded or saved more than once, by route and kind.")
+
+class StateConflict(Exception):
+    """保存しようとしたら、読んだ後に他の誰かが同じ範囲を書いていた"""
+
+# 競合したときのやり直し（イベント処理をもう一度、最新の中身で実行する）
+STATE_MAX_RETRIES = int(os.getenv("STATE_MAX_RETRIES", "8"))
+STATE_RETRY_BASE = float(os.getenv("STATE_RETRY_BASE", "0.02"))   # 秒
+STATE_RETRY_CAP = float(os.getenv("STATE_RETRY_CAP", "0.5"))      # 秒
+
+# 競合の回数：outcome="retried"（やり直した）/ "gave_up"（上限まで競合してあきらめた）。足すと競合の回数
+metrics.define("linebot_state_conflicts_total", "counter", "Optimistic-concurrency conflicts on save, by outcome.")
+
+# DB 側で検出される競合もやり直し対象
+RETRYABLE_ERRORS = (StateConflict, psycopg.errors.SerializationFailure, psycopg.errors.DeadlockDetected)
+
+_MISSING = object()
+
+class UnitOfWork:
+    """
+    webhook の1イベント分の作業単位。
+    - load_tasks() は最初の1回だけ DB を読み、あとは同じ dict を返す
+    - save_tasks() は「変更あり」の印を付けるだけで、書き込みはイベントの最後に1回
+    - LINE への送信もイベントの最後（保存が成功してから）にまとめて送る
+    """
+    def __init__(self, user_id=None, group_id=None, route=None):
+        self.user_id = user_id
+        self.group_id = group_id
+        self.route = route
+        self.tasks = None
+        self.dirty = False
+        self.loads = 0        # 実際に DB を読んだ回数
+        self.saves = 0        # 実際に DB に書いた回数
+        self.outbox = []      # [(送信関数, args)]
+        self.sending = False
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_uow.set(self)
+        self._saved_user_state = user_states.get(self.user_id, _MISSING)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+        except BaseException:
+            self._rollback()
+            raise
+        else:
+            if exc_type is not None:
+                self._rollback()
+        finally:
+            _current_uow.reset(self._token)
+            self._record_stats()
+        return False
+
+    def _rollback(self):
+        # 失敗したイベントの返信は捨てる（呼び出し側がエラー返信 or やり直し）
+        self.outbox.clear()
+        # メモリ上の入力待ち state も元に戻す（やり直したときに別の分岐に入らないように）
+        if self._saved_user_state is _MISSING:
+            user_states.pop(self.user_id, None)
+        else:
+            user_states[self.user_id] = self._saved_user_state
+
+    def get_tasks(self):
+        if self.tasks is None:
+            self.tasks = _load_tasks_now(self.user_id, self.group_id)
+            self.loads += 1
+        return self.tasks
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def flush(self):
+        if self.dirty and self.tasks is not None:
+            _save_tasks_now(self.tasks)
+            self.saves += 1
+            self.dirty = False
+
+    def commit(self):
+        self.flush()
+        self.sending = True
+        outbox, self.outbox = self.outbox, []
+        for fn, args in outbox:
+            fn(*args)
+
+    def defer(self, fn, args):
+        if self.sending:
+            return False
+        self.outbox.append((fn, args))
+        return True
+
+    def _record_stats(self):
+        if not self.route:
+            return
+        labels = (("route", self.route),)
+        metrics.inc("linebot_uow_events_total", labels)
+        metrics.inc("linebot_uow_loads_total", labels, self.loads)
+        metrics.inc("linebot_uow_saves_total", labels, self.saves)
+        if self.loads > 1:
+            metrics.inc("linebot_uow_over_budget_total", labels + (("kind", "load"),))
+        if self.saves > 1:
+            metrics.inc("linebot_uow_over_budget_total", labels + (("kind", "save"),))
+
+def current_uow():
+    return _current_uow.get()
+
+def run_in_uow(fn, user_id=None, group_id=None, route=None):
+    """
+    fn() を UnitOfWork の中で実行する。保存で競合したら最新の中身で fn() をやり直す
+    （回数上限あり・待ち時間はジッター付きの指数バックオフ）。
+    """
+    for attempt in range(STATE_MAX_RETRIES + 1):
+        try:
+            with UnitOfWork(user_id, group_id, route=route):
+                return fn()
+        except RETRYABLE_ERRORS as e:
+            # 古いキャッシュで書こうとした可能性があるので、その範囲を捨てて最新を読み直す
+            scope = e.args[0] if isinstance(e, StateConflict) and e.args else "*"
+            invalidate_state_cache({scope})
+            if attempt >= STATE_MAX_RETRIES:
+                metrics.inc("linebot_state_conflicts_total", (("outcome", "gave_up"),))
+                raise
+            metrics.inc("linebot_state_conflicts_total", (("outcome", "retried"),))
+            with span("conflict_retry_wait"):
+                pause(random.uniform(0, min(STATE_RETRY_CAP, STATE_RETRY_BASE * (2 ** attempt))))
+
+def defer_outbound(fn, *args):
+    """UnitOfWork の中なら送信を後回しにして True を返す"""
+    uow = current_uow()
+    return uow is not None and uow.defer(fn, args)
+
+def load_tasks(user_id=None, group_id=None):
+    """
+    UnitOfWork の中ならイベントで読み込み済みの dict を返す（引数は無視）。
+    """
+    uow = current_uow()
+    if uow is not None:
+        return uow.get_tasks()
+    return _load_tasks_now(user_id, group_id)
+
 def save_tasks(data):
+    """
+    UnitOfWork の中なら「変更あり」にするだけ。書き込みはイベントの最後に1回。
+    """
+    uow = current_uow()
+    if uow is not None and data is uow.tasks:
+        uow.mark_dirty()
+        return
+    _save_tasks_now(data)
+
+def _load_tasks_now(user_id=None, group_id=None):
+    """
+    relational のとき user_id を渡すと、そのユーザーに関係する行だけ読む
+    （個人予定・チェックリスト・伝言板・設定・参加中の集会所とその予定、group_id の伝言板）。
+    user_id なしは全部読む。
+    読み込みキャッシュが使えるときは DB を読まずにキャッシュのコピーを返す。
+    """
     if not ensure_db_ready():
         raise RuntimeError("DB_INIT_FAILED")
 
+    cache = state_cache()
+    key = state_cache_key(user_id, group_id)
+    if cache is not None and key is not None:
+        doc = cache.get(key)
+        if doc is not None:
+            return doc
+        seq = cache.seq()
+
+    t0 = time.perf_counter()
+    with span("load_tasks"):
+        doc = _read_tasks(user_id, group_id)
+        build_item_index(doc)
+    metrics.observe("linebot_tasks_load_seconds", time.perf_counter() - t0, (("storage", storage().label),))
+
+    if cache is not None and key is not None:
+        cache.put(key, doc, doc_scopes(doc), seq)
+    return doc
+
+def _read_tasks(user_id=None, group_id=None):
+    return storage().load(user_id, group_id)
+
+def _save_tasks_now(data):
+    if not ensure_db_ready():
+        raise RuntimeError("DB_INIT_FAILED")
+
+    t0 = time.perf_counter()
+    with span("save_tasks"):
+        scopes = storage().save(data)
+    metrics.observe("linebot_tasks_save_seconds", time.perf_counter() - t0, (("storage", storage().label),))
+
+    if scopes:
+        invalidate_state_cache(scopes)
+
+def _kv_save(cur, data):
+    """return: 書いたら {"tasks"}、変更なしなら空"""
+    if not isinstance(data, TaskDoc):
+        cur.execute("""
+            INSERT INTO kv_store (k, v)
+            VALUES (%s, %s)
+            ON CONFLICT (k)
+            DO UPDATE SET v = EXCLUDED.v, version = kv_store.version + 1, updated_at = now();
+        """, ("tasks", Jsonb(data)))
+        return {"tasks"}
+
+    # 読んだ時点の版数のままなら書く（compare-and-swap）
+    version = data.versions.get("tasks")
+
+    # 変わった所だけ jsonb_set / jsonb_insert / #- で書く（大きく変わったときは丸ごと）
+    ops = json_patch_ops(data.snapshot, data) if version is not None and data.snapshot else None
+    if ops == []:
+        return set()
+    if ops is not None and len(ops) <= KV_PATCH_MAX_OPS:
+        kv_patch(cur, ops, version)
+        data.versions["tasks"] = version + 1
+        data.snapshot = json.loads(json.dumps(data))
+        return {"tasks"}
+
+    if version is None:
+        cur.execute("""
+            INSERT INTO kv_store (k, v, version)
+            VALUES (%s, %s, 1)
+            ON CONFLICT (k) DO NOTHING;
+        """, ("tasks", Jsonb(data)))
+    else:
+        cur.execute("""
+            UPDATE kv_store SET v = %s, version = version + 1, updated_at = now()
+            WHERE k = %s AND version = %s;
+        """, (Jsonb(data), "tasks", version))
+    if cur.rowcount != 1:
+        raise StateConflict("tasks")
+    data.versions["tasks"] = (version or 0) + 1
+    data.snapshot = json.loads(json.dumps(data))
+    _count_kv_save("full", len(json.dumps(data, ensure_ascii=False)))
+    return {"tasks"}
+
+# =========================
+# 読み込みキャッシュ（プロセス内）＋ LISTEN/NOTIFY で全ワーカーに無効化を配る
+# =========================
+
+STATE_CACHE_ENABLED = os.getenv("STATE_CACHE", "1") == "1"
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "1000"))     # 件（ユーザー単位の doc）
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "60"))       # 秒：通知を取りこぼしても古いままにしない
+STATE_NOTIFY_CHANNEL = "task_state_changed"
+
+class StateCache:
+    """
+    ユーザー（+グループ）単位で読んだ doc を持つ LRU キャッシュ。
+    各エントリは依存する範囲（"user:U" / "space:S" / "group:G" / "tasks"）を覚えていて、
+    その範囲に保存があったら（自プロセスでも他プロセスの NOTIFY でも）捨てる。
+    LISTEN の接続が切れている間は使わない（通知を取りこぼすので）。
+    古いキャッシュで書いてしまっても、保存時の版数チェック（StateConflict）で弾かれる。
+    """
+    def __init__(self, size=STATE_CACHE_SIZE, ttl=STATE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> (期限, doc, scopes)
+        self.by_scope = {}             # scope -> {key, ...}
+        self.healthy = False
+        self._seq = 0
+        self._log = deque(maxlen=1024)   # 最近の無効化 [(seq, scopes)]
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "puts": 0, "put_skipped": 0,
+                      "invalidations": 0, "notifications": 0, "evictions": 0}
+
+    def seq(self):
+        with self._lock:
+            return self._seq
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key) if self.healthy else None
+            if entry is None or entry[0] < time.monotonic():
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            doc = entry[1]
+        return doc.clone()
+
+    def put(self, key, doc, scopes, seq):
+        """seq: 読み込みを始めた時点の seq()。読んでる途中に関係する無効化があったら入れない"""
+        cached = doc.clone()
+        with self._lock:
+            stale = any(s > seq and ("*" in sc or scopes & sc) for s, sc in self._log)
+            too_old = self._log and len(self._log) == self._log.maxlen and self._log[0][0] > seq + 1
+            if not self.healthy or stale or too_old:
+                self.stats["put_skipped"] += 1
+                return
+            self._drop(key)
+            self.entries[key] = (time.monotonic() + self.ttl, cached, scopes)
+            for scope in scopes:
+                self.by_scope.setdefault(scope, set()).add(key)
+            self.stats["puts"] += 1
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate(self, scopes, notified=False):
+        scopes = set(scopes)
+        with self._lock:
+            self._seq += 1
+            self._log.append((self._seq, scopes))
+            if notified:
+                self.stats["notifications"] += 1
+            if "*" in scopes:
+                self.stats["invalidations"] += len(self.entries)
+                self.entries.clear()
+                self.by_scope.clear()
+                return
+            for scope in scopes:
+                for key in list(self.by_scope.get(scope, ())):
+                    self._drop(key)
+                    self.stats["invalidations"] += 1
+
+    def set_healthy(self, healthy):
+        with self._lock:
+            self.healthy = healthy
+        # つながり直したときは、切れてた間の通知が無いので全部捨てる
+        self.invalidate({"*"})
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for scope in entry[2]:
+            keys = self.by_scope.get(scope)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_scope[scope]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["healthy"] = self.healthy
+        return stats
+
+class StateCacheListener(threading.Thread):
+    """専用の接続で LISTEN して、届いた範囲をキャッシュから捨てる"""
+    def __init__(self, cache):
+        super().__init__(name="state-cache-listener", daemon=True)
+        self.cache = cache
+        self.stopping = threading.Event()
+
+    def run(self):
+        backoff = 1.0
+        while not self.stopping.is_set():
+            try:
+                with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {STATE_NOTIFY_CHANNEL};")
+                    self.cache.set_healthy(True)
+                    backoff = 1.0
+                    while not self.stopping.is_set():
+                        for n in conn.notifies(timeout=5.0):
+                            try:
+                                scopes = set(json.loads(n.payload).get("scopes", ["*"]))
+                            except ValueError:
+                                scopes = {"*"}
+                            self.cache.invalidate(scopes, notified=True)
+                        # 何も届かなくても接続が生きてるか確認
+                        conn.execute("SELECT 1;")
+            except Exception as e:
+                log.warning("state cache listener failed", extra={"error": repr(e)})
+            self.cache.set_healthy(False)
+            self.stopping.wait(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def stop(self):
+        self.stopping.set()
+
+_state_cache = None
+_state_cache_pid = None
+_state_cache_lock = threading.Lock()
+
+def state_cache():
+    """プロセスごとに1つ（LISTEN スレッドも一緒に起動）。無効なら None"""
+    global _state_cache, _state_cache_pid
+    # 他のプロセスの書き込みを LISTEN/NOTIFY で知れるのは postgres だけ
+    if not STATE_CACHE_ENABLED or not DATABASE_URL or STORAGE_BACKEND != "postgres":
+        return None
+    pid = os.getpid()
+    if _state_cache is None or _state_cache_pid != pid:
+        with _state_cache_lock:
+            if _state_cache is None or _state_cache_pid != pid:
+                cache = StateCache()
+                cache.listener = StateCacheListener(cache)
+                cache.listener.start()
+                _state_cache = cache
+                _state_cache_pid = pid
+    return _state_cache
+
+metrics.define("linebot_state_cache_lookups_total", "counter", "State cache lookups by result (hit rate = hit / all).")
+metrics.define("linebot_state_cache_puts_total", "counter", "State cache stores by result (skipped: invalidated while loading).")
+metrics.define("linebot_state_cache_evictions_total", "counter", "State cache entries dropped for size (LRU).")
+metrics.define("linebot_state_cache_invalidations_total", "counter", "State cache entries dropped because their scope was saved.")
+metrics.define("linebot_state_cache_notifications_total", "counter", "Invalidation NOTIFYs received from other workers.")
+metrics.define("linebot_state_cache_entries", "gauge", "Docs currently in the state cache.")
+metrics.define("linebot_state_cache_healthy", "gauge", "1 while the LISTEN connection is up (the cache is only used then).")
+
+@metrics.collector
+def _collect_state_cache():
+    cache = _state_cache
+    if cache is None or _state_cache_pid != os.getpid():
+        return []
+    stats = cache.get_stats()
+    return [
+        ("linebot_state_cache_lookups_total", (("result", "hit"),), stats["hits"]),
+        ("linebot_state_cache_lookups_total", (("result", "miss"),), stats["misses"]),
+        ("linebot_state_cache_puts_total", (("result", "stored"),), stats["puts"]),
+        ("linebot_state_cache_puts_total", (("result", "skipped"),), stats["put_skipped"]),
+        ("linebot_state_cache_evictions_total", (), stats["evictions"]),
+        ("linebot_state_cache_invalidations_total", (), stats["invalidations"]),
+        ("linebot_state_cache_notifications_total", (), stats["notifications"]),
+        ("linebot_state_cache_entries", (), stats["entries"]),
+        ("linebot_state_cache_healthy", (), int(stats["healthy"])),
+    ]
+
+def state_cache_key(user_id, group_id):
+    # kv は1行に全部入りなので1エントリ。relational の全件読み（user_id なし）はキャッシュしない
+    if STORAGE_MODE != "relational":
+        return ("kv",)
+    if not user_id:
+        return None
+    return ("relational", user_id, group_id)
+
+def doc_scopes(doc):
+    if STORAGE_MODE != "relational":
+        return {"tasks"}
+    return loaded_scopes(doc)
+
+def loaded_scopes(doc):
+    """doc が読んだ範囲（"user:U" / "space:S" / "group:G"）"""
+    return {f"{SECTION_SCOPES[section]}:{owner}" for section, owner in doc.loaded if section in SECTION_SCOPES}
+
+def data_scopes(data):
+    """丸ごとの dict に入っている範囲全部"""
+    return {f"{kind}:{owner}" for section, kind in SECTION_SCOPES.items() for owner in _section_map(data, section)}
+
+def notify_state_changed(cur, scopes):
+    cur.execute("SELECT pg_notify(%s, %s);", (STATE_NOTIFY_CHANNEL, json.dumps({"scopes": sorted(scopes)})))
+
+def invalidate_state_cache(scopes):
+    if _state_cache is not None and _state_cache_pid == os.getpid():
+        _state_cache.invalidate(scopes)
+
+# =========================
+# kv：部分更新（jsonb_set / jsonb_insert / #-）
+# =========================
+
+# これより操作が多いときは丸ごと書いた方が速い
+KV_PATCH_MAX_OPS = int(os.getenv("KV_PATCH_MAX_OPS", "32"))
+
+# 保存の回数と送ったバイト数は linebot_tasks_save_bytes{kind="full"|"patch"}、部分更新の操作数はこちら
+metrics.define("linebot_tasks_save_patch_ops_total", "counter", "jsonb patch operations sent by partial kv saves.")
+
+def _count_kv_save(kind, nbytes, nops=0):
+    metrics.observe("linebot_tasks_save_bytes", nbytes, (("kind", kind),))
+    if nops:
+        metrics.inc("linebot_tasks_save_patch_ops_total", value=nops)
+
+def json_patch_ops(old, new, path=()):
+    """
+    old → new にする操作のリストを返す。
+      ("set", path, value)    : jsonb_set
+      ("append", path, value) : 配列の末尾に追加（jsonb_insert）
+      ("delete", path, None)  : #-
+    ルートごと置き換えになるときは None
+    例: tasks["users"][uid][0]["status"] = "done"
+        -> [("set", ("users", uid, "0", "status"), "done")]
+    """
+    if old == new:
+        return []
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for k in old:
+            if k not in new:
+                ops.append(("delete", path + (k,), None))
+        for k, v in new.items():
+            if k not in old:
+                ops.append(("set", path + (k,), v))
+            elif old[k] != v:
+                sub = json_patch_ops(old[k], v, path + (k,))
+                if sub is None:
+                    return None
+                ops += sub
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        if len(old) == len(new):
+            ops = []
+            for i, (o, n) in enumerate(zip(old, new)):
+                if o != n:
+                    ops += json_patch_ops(o, n, path + (str(i),))
+            return ops
+        if len(new) > len(old) and new[:len(old)] == old:
+            return [("append", path, v) for v in new[len(old):]]
+        if len(new) == len(old) - 1:
+            i = next((i for i, (o, n) in enumerate(zip(old, new)) if o != n), len(new))
+            if old[:i] + old[i + 1:] == new:
+                return [("delete", path + (str(i),), None)]
+
+    if not path:
+        return None
+    return [("set", path, new)]
+
+def kv_patch(cur, ops, version):
+    """
+    kv_store の "tasks" に ops をサーバー側で当てる（送るのは変わった値だけ）。
+    version が読んだ時点と違えば StateConflict。
+    """
+    expr = "v"
+    params = []
+    nbytes = 0
+    for op, path, value in ops:
+        if op == "set":
+            expr = f"jsonb_set({expr}, %s::text[], %s, true)"
+            params += [list(path), Jsonb(value)]
+        elif op == "append":
+            expr = f"jsonb_insert({expr}, %s::text[], %s, true)"
+            params += [list(path) + ["-1"], Jsonb(value)]
+        else:
+            expr = f"({expr} #- %s::text[])"
+            params += [list(path)]
+        nbytes += len(json.dumps(value, ensure_ascii=False)) if value is not None else 0
+
+    cur.execute(f"""
+        UPDATE kv_store SET v = {expr}, version = version + 1, updated_at = now()
+        WHERE k = %s AND version = %s;
+    """, params + ["tasks", version])
+    if cur.rowcount != 1:
+        raise StateConflict("tasks")
+    _count_kv_save("patch", nbytes, len(ops))
+
+# =========================
+# relational：読み込み
+# =========================
+
+def _rel_filter(doc, col, values):
+    # 全部読むときは絞り込みなし
+    if not doc.partial:
+        return "", ()
+    return f"WHERE {col} = ANY(%s)", (list(values),)
+
+def _row_item(r, fields):
+    item = {f: r[f] for f in fields if r[f] is not None}
+    item.update(r["extra"] or {})
+    if r.get("item_id"):
+        item["id"] = r["item_id"]
+    return item
+
+def rel_load(cur, user_id=None, group_id=None):
+    # 途中で他のプロセスが書いても、読む中身と版数がずれないように
+    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+
+    doc = TaskDoc(copy.deepcopy(DEFAULT_TASKS))
+    doc.partial = user_id is not None
+    users = [user_id] if user_id else []
+    groups = [group_id] if group_id else []
+
+    if doc.partial:
+        for section in ("users", "checklists", "board_users", "settings", "memberships", "active_space"):
+            doc.loaded.add((section, user_id))
+        for gid in groups:
+            doc.loaded.add(("groups", gid))
+            doc.loaded.add(("board_groups", gid))
+
+    # 個人予定
+    w, p = _rel_filter(doc, "user_id", users)
+    cur.execute(f"SELECT id, item_id, user_id, text, status, extra FROM personal_tasks {w} ORDER BY user_id, pos, id;", p)
+    for r in cur.fetchall():
+        doc["users"].setdefault(r["user_id"], []).append(_row_item(r, ("text", "status")))
+        doc.row_ids.setdefault(("users", r["user_id"]), []).append(r["id"])
+
+    # 旧：グループの全体予定
+    if groups or not doc.partial:
+        w, p = _rel_filter(doc, "group_id", groups)
+        cur.execute(f"SELECT id, item_id, group_id, text, done_by, extra FROM group_tasks {w} ORDER BY group_id, pos, id;", p)
+        for r in cur.fetchall():
+            doc["groups"].setdefault(r["group_id"], []).append(_row_item(r, ("text", "done_by")))
+            doc.row_ids.setdefault(("groups", r["group_id"]), []).append(r["id"])
+
+    # チェックリスト（と項目）
+    w, p = _rel_filter(doc, "user_id", users)
+    cur.execute(f"SELECT id, item_id, user_id, title, extra FROM checklists {w} ORDER BY user_id, pos, id;", p)
+    by_id = {}
+    for r in cur.fetchall():
+        checklist = _row_item(r, ("title",))
+        checklist["items"] = []
+        by_id[r["id"]] = checklist
+        doc["checklists"].setdefault(r["user_id"], []).append(checklist)
+        doc.row_ids.setdefault(("checklists", r["user_id"]), []).append(r["id"])
+    if by_id:
+        cur.execute("""
+            SELECT id, item_id, checklist_id, text, done, extra FROM checklist_items
+            WHERE checklist_id = ANY(%s) ORDER BY checklist_id, pos, id;
+        """, (list(by_id),))
+        for r in cur.fetchall():
+            by_id[r["checklist_id"]]["items"].append(_row_item(r, ("text", "done")))
+            doc.row_ids.setdefault(("checklist_items", r["checklist_id"]), []).append(r["id"])
+
+    # 伝言板
+    if doc.partial:
+        cur.execute("""
+            SELECT id, item_id, owner_type, owner_id, text, extra FROM board_items
+            WHERE (owner_type = 'user' AND owner_id = ANY(%s))
+               OR (owner_type = 'group' AND owner_id = ANY(%s))
+            ORDER BY owner_type, owner_id, pos, id;
+        """, (users, groups))
+    else:
+        cur.execute("SELECT id, item_id, owner_type, owner_id, text, extra FROM board_items ORDER BY owner_type, owner_id, pos, id;")
+    for r in cur.fetchall():
+        section = "board_users" if r["owner_type"] == "user" else "board_groups"
+        board = doc["board"]["users" if r["owner_type"] == "user" else "groups"]
+        board.setdefault(r["owner_id"], []).append(_row_item(r, ("text",)))
+        doc.row_ids.setdefault((section, r["owner_id"]), []).append(r["id"])
+
+    # UI設定・入力待ち state
+    w, p = _rel_filter(doc, "user_id", users)
+    cur.execute(f"SELECT user_id, section, data FROM ui_settings {w};", p)
+    for r in cur.fetchall():
+        doc["settings"].setdefault(r["user_id"], {})[r["section"]] = r["data"]
+
+    # 集会所の参加状況
+    w, p = _rel_filter(doc, "user_id", users)
+    cur.execute(f"SELECT user_id, space_id FROM memberships {w} ORDER BY user_id, pos;", p)
+    for r in cur.fetchall():
+        doc["memberships"].setdefault(r["user_id"], []).append(r["space_id"])
+
+    cur.execute(f"SELECT user_id, space_id FROM active_spaces {w};", p)
+    for r in cur.fetchall():
+        doc["active_space"][r["user_id"]] = r["space_id"]
+
+    if doc.partial:
+        sids = set(doc["memberships"].get(user_id, []))
+        if doc["active_space"].get(user_id):
+            sids.add(doc["active_space"][user_id])
+        _rel_load_spaces(cur, doc, sorted(sids))
+    else:
+        _rel_load_spaces(cur, doc, None)
+
+    if doc.partial:
+        scopes = [f"user:{user_id}"] + [f"group:{gid}" for gid in groups]
+        scopes += [f"space:{owner}" for section, owner in doc.loaded if section == "spaces"]
+        _rel_read_versions(cur, doc, scopes)
+    else:
+        _rel_read_versions(cur, doc, None)
+
+    doc.snapshot = copy.deepcopy(dict(doc))
+    space_pass_index(doc)
+    return doc
+
+def _rel_read_versions(cur, doc, scopes):
+    if scopes is None:
+        cur.execute("SELECT scope, version FROM state_versions;")
+    else:
+        cur.execute("SELECT scope, version FROM state_versions WHERE scope = ANY(%s);", (list(scopes),))
+    for r in cur.fetchall():
+        doc.versions[r["scope"]] = r["version"]
+
+def _rel_load_spaces(cur, doc, sids):
+    """集会所と、その全体予定（done_mask）・メンバーのビット番号を doc に読み込む。sids=None は全部"""
+    if sids is not None:
+        if not sids:
+            return
+        for sid in sids:
+            doc.loaded.add(("spaces", sid))
+            doc.loaded.add(("space_tasks", sid))
+        w, p = "WHERE space_id = ANY(%s)", (list(sids),)
+    else:
+        w, p = "", ()
+
+    cur.execute(f"SELECT space_id, name, pass, created_by FROM spaces {w};", p)
+    for r in cur.fetchall():
+        doc["spaces"][r["space_id"]] = {"name": r["name"], "pass": r["pass"], "created_by": r["created_by"]}
+
+    cur.execute(f"SELECT id, item_id, space_id, text, done_mask, extra FROM space_tasks {w} ORDER BY space_id, pos, id;", p)
+    for r in cur.fetchall():
+        task = _row_item(r, ("text",))
+        task["done_mask"] = int(r["done_mask"])
+        doc["space_tasks"].setdefault(r["space_id"], []).append(task)
+        doc.row_ids.setdefault(("space_tasks", r["space_id"]), []).append(r["id"])
+
+    cur.execute(f"SELECT space_id, user_id, ordinal FROM space_ordinals {w};", p)
+    for r in cur.fetchall():
+        doc["space_ordinals"].setdefault(r["space_id"], {})[r["user_id"]] = r["ordinal"]
+
+def rel_attach_space_by_pass(doc, passphrase):
+    """一部だけ読んだ doc に、合言葉が一致する集会所を追加で読み込む"""
     with db_connect() as conn:
         with conn.cursor() as cur:
+            cur.execute("SELECT space_id FROM spaces WHERE pass = %s ORDER BY space_id LIMIT 1;", (passphrase,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            sid = row["space_id"]
+            if ("spaces", sid) not in doc.loaded:
+                _rel_read_versions(cur, doc, [f"space:{sid}"])
+                _rel_load_spaces(cur, doc, [sid])
+                doc.snapshot["spaces"][sid] = copy.deepcopy(doc["spaces"].get(sid))
+                if sid in doc["space_tasks"]:
+                    doc.snapshot["space_tasks"][sid] = copy.deepcopy(doc["space_tasks"][sid])
+                if sid in doc["space_ordinals"]:
+                    doc.snapshot.setdefault("space_ordinals", {})[sid] = dict(doc["space_ordinals"][sid])
+                space_pass_index(doc).setdefault(passphrase, sid)
+            return sid
+
+def next_space_id():
+    """同時に作っても・消した後でも重ならない（postgres は sequence から）"""
+    return storage().next_space_id()
+
+# =========================
+# relational：保存（差分だけ書く）
+# =========================
+
+def _db_value(v):
+    return Jsonb(v) if isinstance(v, (dict, list)) else v
+
+def _owner_where(owner):
+    return " AND ".join(f"{col} = %s" for col in owner), list(owner.values())
+
+def _rel_insert(cur, table, owner, row):
+    # pos は「今の末尾 + 1」（既存の行には触らない）
+    cols = {**owner, **row}
+    where, params = _owner_where(owner)
+    names = ", ".join(cols)
+    marks = ", ".join(["%s"] * len(cols))
+    cur.execute(f"""
+        INSERT INTO {table} ({names}, pos)
+        SELECT {marks}, COALESCE(MAX(pos) + 1, 0) FROM {table} WHERE {where}
+        RETURNING id;
+    """, [_db_value(v) for v in cols.values()] + params)
+    return cur.fetchone()["id"]
+
+def _rel_update(cur, table, row_id, row):
+    sets = ", ".join(f"{col} = %s" for col in row)
+    cur.execute(f"UPDATE {table} SET {sets} WHERE id = %s;", [_db_value(v) for v in row.values()] + [row_id])
+
+def _rel_sync_list(cur, doc, key, table, owner, old, new, to_row):
+    """
+    1オーナー分のリスト（個人予定・伝言板など）を old → new の差分で書く。
+    追加・1件削除・中身の書き換えはその行だけ、それ以外（並びが大きく変わった）はオーナー分を作り直す。
+    old=None は「読んでない範囲」：既存行には触らず末尾に足すだけ。
+    return: new と同じ並びの [(行ID, 元の要素 or None), ...]
+    """
+    new = new or []
+    ids = doc.row_ids.get(key, [])
+
+    if old is None:
+        mapping = [(_rel_insert(cur, table, owner, to_row(it)), None) for it in new]
+
+    elif len(old) == len(new):
+        for row_id, o, n in zip(ids, old, new):
+            if to_row(o) != to_row(n):
+                _rel_update(cur, table, row_id, to_row(n))
+        mapping = list(zip(ids, old))
+
+    elif len(new) > len(old) and new[:len(old)] == old:
+        mapping = list(zip(ids, old))
+        mapping += [(_rel_insert(cur, table, owner, to_row(it)), None) for it in new[len(old):]]
+
+    else:
+        i = next((i for i, (o, n) in enumerate(zip(old, new)) if o != n), len(new))
+        if len(new) == len(old) - 1 and old[:i] + old[i + 1:] == new:
+            cur.execute(f"DELETE FROM {table} WHERE id = %s;", (ids[i],))
+            mapping = list(zip(ids[:i] + ids[i + 1:], new))
+        else:
+            where, params = _owner_where(owner)
+            cur.execute(f"DELETE FROM {table} WHERE {where};", params)
+            mapping = [(_rel_insert(cur, table, owner, to_row(it)), None) for it in new]
+
+    doc.row_ids[key] = [row_id for row_id, _ in mapping]
+    return mapping
+
+def _split_row(item, fields, skip=()):
+    row = {f: item.get(f) for f in fields}
+    row["item_id"] = item.get("id")
+    row["extra"] = {k: v for k, v in item.items() if k not in fields and k not in skip and k != "id"}
+    return row
+
+def _personal_row(t):
+    return _split_row(t, ("text", "status"))
+
+def _group_task_row(t):
+    row = _split_row(t, ("text", "done_by"))
+    row["done_by"] = row["done_by"] or []
+    return row
+
+def _checklist_row(c):
+    return _split_row(c, ("title",), skip=("items",))
+
+def _checklist_item_row(it):
+    row = _split_row(it, ("text", "done"))
+    row["done"] = bool(row["done"])
+    return row
+
+def _board_row(it):
+    return _split_row(it, ("text",))
+
+def _space_task_row(t):
+    row = _split_row(t, ("text", "done_mask"))
+    row["done_mask"] = int(row["done_mask"] or 0)
+    return row
+
+def _rel_changes(doc, section, new_map, old_map):
+    """section の中で変わったオーナーを (owner, old, new) で返す。old=None は読んでない範囲"""
+    for owner in list(dict.fromkeys(list(old_map) + list(new_map))):
+        old = old_map.get(owner)
+        new = new_map.get(owner)
+        if old == new:
+            continue
+        if old is None and doc.is_loaded(section, owner):
+            old = type(new)() if new is not None else None
+        yield owner, old, new
+
+SECTION_SCOPES = {
+    "users": "user", "checklists": "user", "board_users": "user", "settings": "user",
+    "memberships": "user", "active_space": "user",
+    "groups": "group", "board_groups": "group",
+    "spaces": "space", "space_tasks": "space",
+}
+
+def _rel_touched_scopes(doc):
+    """変更がある範囲を (読んだ範囲, 読んでない範囲) で返す"""
+    snap = doc.snapshot or {}
+    snap_board = snap.get("board", {})
+    old_maps = {
+        "board_users": snap_board.get("users", {}),
+        "board_groups": snap_board.get("groups", {}),
+    }
+    loaded, unloaded = set(), set()
+    for section, kind in SECTION_SCOPES.items():
+        old_map = old_maps.get(section, snap.get(section, {}))
+        for owner, old, _ in _rel_changes(doc, section, _section_map(doc, section), old_map):
+            (loaded if old is not None else unloaded).add(f"{kind}:{owner}")
+    # メンバーのビット番号は space_tasks と一緒に読んでいる
+    for sid, old, _ in _rel_changes(doc, "space_tasks", doc.get("space_ordinals", {}), snap.get("space_ordinals", {})):
+        (loaded if old is not None else unloaded).add(f"space:{sid}")
+    return loaded, unloaded - loaded
+
+def _rel_bump_versions(cur, doc):
+    """
+    変更する範囲の版数を +1。読んだ時点から他の誰かが書いていたら StateConflict。
+    ロック順が揃うように scope 名の順で更新する（デッドロック防止）
+    """
+    loaded, unloaded = _rel_touched_scopes(doc)
+    scopes = loaded | unloaded
+    for scope in sorted(scopes):
+        if scope in unloaded:
+            # 読んでない範囲は末尾に足すだけなので版数は上げるだけ（他の人に変更を知らせる）
+            cur.execute("""
+                INSERT INTO state_versions (scope, version) VALUES (%s, 1)
+                ON CONFLICT (scope) DO UPDATE SET version = state_versions.version + 1;
+            """, (scope,))
+            continue
+
+        version = doc.versions.get(scope)
+        if version is None:
+            cur.execute("""
+                INSERT INTO state_versions (scope, version) VALUES (%s, 1)
+                ON CONFLICT (scope) DO NOTHING;
+            """, (scope,))
+        else:
+            cur.execute("""
+                UPDATE state_versions SET version = version + 1
+                WHERE scope = %s AND version = %s;
+            """, (scope, version))
+        if cur.rowcount != 1:
+            raise StateConflict(scope)
+        doc.versions[scope] = (version or 0) + 1
+    return scopes
+
+def rel_save(cur, doc):
+    """return: 書いた範囲（scope の set）"""
+    scopes = _rel_bump_versions(cur, doc)
+
+    snap = doc.snapshot or {}
+    snap_board = snap.get("board", {})
+    touched_users = set()
+    unloaded = []
+
+    def sync_lists(section, new_map, old_map, table, owner_of, to_row):
+        for owner, old, new in _rel_changes(doc, section, new_map, old_map):
+            if old is None:
+                unloaded.append((section, owner))
+            yield owner, _rel_sync_list(cur, doc, (section, owner), table, owner_of(owner), old, new, to_row), old
+
+    for uid, _, _ in sync_lists("users", doc["users"], snap.get("users", {}),
+                                "personal_tasks", lambda o: {"user_id": o}, _personal_row):
+        touched_users.add(uid)
+
+    for _ in sync_lists("groups", doc["groups"], snap.get("groups", {}),
+                        "group_tasks", lambda o: {"group_id": o}, _group_task_row):
+        pass
+
+    for uid, mapping, _ in sync_lists("checklists", doc["checklists"], snap.get("checklists", {}),
+                                      "checklists", lambda o: {"user_id": o}, _checklist_row):
+        touched_users.add(uid)
+        for (cid, old_c), new_c in zip(mapping, doc["checklists"].get(uid, [])):
+            old_items = old_c.get("items", []) if old_c is not None else []
+            new_items = new_c.get("items", [])
+            if old_items != new_items:
+                _rel_sync_list(cur, doc, ("checklist_items", cid), "checklist_items",
+                               {"checklist_id": cid}, old_items, new_items, _checklist_item_row)
+
+    for uid, _, _ in sync_lists("board_users", doc["board"]["users"], snap_board.get("users", {}),
+                                "board_items", lambda o: {"owner_type": "user", "owner_id": o}, _board_row):
+        touched_users.add(uid)
+
+    for _ in sync_lists("board_groups", doc["board"]["groups"], snap_board.get("groups", {}),
+                        "board_items", lambda o: {"owner_type": "group", "owner_id": o}, _board_row):
+        pass
+
+    # 集会所（新規作成・名前変更）
+    for sid, old, new in _rel_changes(doc, "spaces", doc["spaces"], snap.get("spaces", {})):
+        if new is None:
+            continue
+        values = (new.get("name", ""), new.get("pass", ""), new.get("created_by"), sid)
+        if old:
+            cur.execute("UPDATE spaces SET name = %s, pass = %s, created_by = %s WHERE space_id = %s;", values)
+            continue
+        try:
+            with cur.connection.transaction():
+                cur.execute("INSERT INTO spaces (name, pass, created_by, space_id) VALUES (%s, %s, %s, %s);", values)
+        except psycopg.errors.UniqueViolation:
+            # 同じ合言葉の集会所を誰かが先に作った → 読み直すとそっちに参加する
+            raise StateConflict(f"space:{sid}")
+
+    # 集会所メンバーのビット番号（増えるだけ。同じ番号を別の人に振られていたら StateConflict）
+    snap_ordinals = snap.get("space_ordinals", {})
+    for sid, ordinals in doc["space_ordinals"].items():
+        old_ordinals = snap_ordinals.get(sid, {})
+        added = [(sid, uid, n) for uid, n in ordinals.items() if uid not in old_ordinals]
+        if not added:
+            continue
+        try:
+            with cur.connection.transaction():
+                cur.executemany("INSERT INTO space_ordinals (space_id, user_id, ordinal) VALUES (%s, %s, %s);", added)
+        except psycopg.errors.UniqueViolation:
+            raise StateConflict(f"space:{sid}")
+
+    # 集会所の全体予定（完了者は done_mask 列のビット）
+    for _ in sync_lists("space_tasks", doc["space_tasks"], snap.get("space_tasks", {}),
+                        "space_tasks", lambda o: {"space_id": o}, _space_task_row):
+        pass
+
+    # 参加中の集会所（並び順つき）
+    for uid, old, new in _rel_changes(doc, "memberships", doc["memberships"], snap.get("memberships", {})):
+        touched_users.add(uid)
+        if old is not None:
+            cur.execute("DELETE FROM memberships WHERE user_id = %s;", (uid,))
+        for pos, sid in enumerate(new or []):
+            cur.execute("""
+                INSERT INTO memberships (user_id, space_id, pos) VALUES (%s, %s, %s)
+                ON CONFLICT DO NOTHING;
+            """, (uid, sid, pos))
+
+    for uid, old, new in _rel_changes(doc, "active_space", doc["active_space"], snap.get("active_space", {})):
+        touched_users.add(uid)
+        if new is None:
+            cur.execute("DELETE FROM active_spaces WHERE user_id = %s;", (uid,))
+        else:
+            cur.execute("""
+                INSERT INTO active_spaces (user_id, space_id) VALUES (%s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET space_id = EXCLUDED.space_id;
+            """, (uid, new))
+
+    # UI設定：セクション（check_ui / board_ui / schedule_ui / _state）ごとに1行
+    for uid, old, new in _rel_changes(doc, "settings", doc["settings"], snap.get("settings", {})):
+        touched_users.add(uid)
+        old = old or {}
+        new = new or {}
+        for section in set(old) | set(new):
+            if section not in new:
+                cur.execute("DELETE FROM ui_settings WHERE user_id = %s AND section = %s;", (uid, section))
+            elif old.get(section) != new[section]:
+                cur.execute("""
+                    INSERT INTO ui_settings (user_id, section, data) VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id, section) DO UPDATE SET data = EXCLUDED.data;
+                """, (uid, section, Jsonb(new[section])))
+
+    for uid in touched_users:
+        cur.execute("INSERT INTO app_users (user_id) VALUES (%s) ON CONFLICT DO NOTHING;", (uid,))
+
+    # 読んでない範囲に足した分は doc から外す（同じ doc でもう一度 save しても二重に足さない）
+    for section, owner in unloaded:
+        container = _section_map(doc, section)
+        container.pop(owner, None)
+        doc.row_ids.pop((section, owner), None)
+
+    doc.snapshot = copy.deepcopy(dict(doc))
+    return scopes
+
+def _section_map(doc, section):
+    if section == "board_users":
+        return doc["board"]["users"]
+    if section == "board_groups":
+        return doc["board"]["groups"]
+    return doc[section]
+
+def rel_replace_all(cur, data):
+    """丸ごとの dict（旧 kv_store の中身と同じ形）でテーブルを全部置き換える"""
+    cur.execute(f"TRUNCATE {', '.join(RELATIONAL_TABLES)} RESTART IDENTITY;")
+    # 版数は消さずに全部上げる（1 からやり直すと、前に読んだ doc の保存や画面のキャッシュが今の中身と区別できない）
+    cur.execute("UPDATE state_versions SET version = version + 1;")
+    doc = TaskDoc(normalize_tasks(copy.deepcopy(dict(data))))
+    doc.snapshot = copy.deepcopy(DEFAULT_TASKS)
+    _rel_read_versions(cur, doc, None)
+    rel_save(cur, doc)
+
+def migrate_kv_to_relational(force=False):
+    """
+    旧 kv_store の "tasks"（全部入りの1行）をテーブルに展開する。1回だけ。
+    複数プロセスが同時に起動しても advisory lock で1つだけが実行する。
+    kv_store の "tasks" 行は消さずに残す（戻したいときは STORAGE_MODE=kv）。
+    """
+    with db_connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+            cur.execute("SELECT 1 FROM kv_store WHERE k = %s;", (MIGRATED_KEY,))
+            if cur.fetchone() and not force:
+                return False
+
+            cur.execute("SELECT v FROM kv_store WHERE k = %s;", ("tasks",))
+            row = cur.fetchone()
+            if row:
+                rel_replace_all(cur, row["v"])
+                notify_state_changed(cur, {"*"})
+                sync_space_id_seq(cur)
+
             cur.execute("""
                 INSERT INTO kv_store (k, v)
                 VALUES (%s, %s)
                 ON CONFLICT (k)
                 DO UPDATE SET v = EXCLUDED.v, updated_at = now();
-            """, ("tasks", Jsonb(data)))
+            """, (MIGRATED_KEY, Jsonb({"from_kv": bool(row)})))
+
+    log.info("kv_store → relational migration done")
+    return True
 
 def db_ping():
     try:
+        storage().ping()
+        log.info("DB connected (SELECT 1 OK)", extra={"storage": storage().name})
+        return True
+    except Exception as e:
+        log.error("DB connection failed", extra={"error": repr(e)})
+        return False
+    
+# =========================
+# 保存先（STORAGE_BACKEND）：postgres（既定） / sqlite（WAL・1台用） / memory（プロセス内・テストやベンチ用）
+# load_tasks / save_tasks / ensure_db_ready / 再送チェック / 集会所の採番 はここを通る
+# =========================
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "tasks.db")
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))   # 秒：他の書き込みが終わるのを待つ上限
+
+class Storage:
+    """
+    保存先のインターフェース。
+    save() は、load() で読んだ後に他の誰かが同じ範囲を書いていたら StateConflict（run_in_uow がやり直す）。
+    """
+    name = None
+
+    @property
+    def label(self):
+        """メトリクスの storage ラベル"""
+        return self.name
+
+    def init(self):
+        """テーブル作成・移行。何回呼んでもよい"""
+        raise NotImplementedError
+
+    def load(self, user_id=None, group_id=None):
+        """return: TaskDoc（user_id を渡すとそのユーザーに関係する所だけのこともある）"""
+        raise NotImplementedError
+
+    def save(self, data):
+        """
+        data: load() の TaskDoc（変わった所を書く）か、丸ごとの dict（全部置き換え）。
+        return: 書いた範囲（読み込みキャッシュの無効化に使う。変更なしなら空）
+        """
+        raise NotImplementedError
+
+    def claim_event(self, event_id):
+        """webhookEventId を初めて見たなら True（印を付ける）"""
+        raise NotImplementedError
+
+    def release_event(self, event_id):
+        raise NotImplementedError
+
+    def next_space_id(self):
+        """集会所ID（"s<番号>"）。同時に呼んでも・消した後でも重ならない"""
+        raise NotImplementedError
+
+    def space_members(self, sid):
+        """return: (集会所の名前, [user_id, ...])"""
+        raise NotImplementedError
+
+    def attach_space_by_pass(self, doc, passphrase):
+        """一部だけ読んだ doc に、合言葉が一致する集会所を足す。return: space_id か None"""
+        raise NotImplementedError
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+    def after_fork(self):
+        """fork した子で：親から引き継いだロック・接続を使わないようにする"""
+
+class PostgresStorage(Storage):
+    """STORAGE_MODE で relational（テーブル分割）/ kv（kv_store の1行）"""
+    name = "postgres"
+
+    def __init__(self):
+        self._last_purge = 0.0
+
+    @property
+    def label(self):
+        return STORAGE_MODE
+
+    def init(self):
+        init_db()
+
+    def load(self, user_id=None, group_id=None):
+        if STORAGE_MODE == "relational":
+            with db_connect() as conn:
+                with conn.cursor() as cur:
+                    return rel_load(cur, user_id=user_id, group_id=group_id)
+
+        with db_connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT v::text AS v_text, version FROM kv_store WHERE k = %s;", ("tasks",))
+                row = cur.fetchone()
+        if not row:
+            return TaskDoc(normalize_tasks(copy.deepcopy(DEFAULT_TASKS)))
+        return _doc_from_json(row["v_text"], row["version"])
+
+    def save(self, data):
+        with db_connect() as conn:
+            with conn.cursor() as cur:
+                if STORAGE_MODE == "relational":
+                    if isinstance(data, TaskDoc):
+                        scopes = rel_save(cur, data)
+                    else:
+                        rel_replace_all(cur, data)
+                        scopes = {"*"}
+                else:
+                    scopes = _kv_save(cur, data)
+                if not isinstance(data, TaskDoc):
+                    # 丸ごと置き換えで入った集会所（移行など）とも重ならないように
+                    sync_space_id_seq(cur)
+
+                # 他のプロセスの読み込みキャッシュに知らせる（commit されたら届く）
+                if scopes:
+                    notify_state_changed(cur, scopes)
+        return scopes
+
+    def claim_event(self, event_id):
+        with db_connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO webhook_events (event_id) VALUES (%s)
+                    ON CONFLICT (event_id) DO NOTHING;
+                """, (event_id,))
+                claimed = cur.rowcount == 1
+
+                now = time.monotonic()
+                if now - self._last_purge > WEBHOOK_DEDUP_PURGE_INTERVAL:
+                    self._last_purge = now
+                    cur.execute("DELETE FROM webhook_events WHERE seen_at < now() - make_interval(secs => %s);",
+                                (WEBHOOK_DEDUP_TTL,))
+        return claimed
+
+    def release_event(self, event_id):
+        with db_connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM webhook_events WHERE event_id = %s;", (event_id,))
+
+    def next_space_id(self):
+        """sequence から振る"""
+        with db_connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT nextval('space_id_seq') AS n;")
+                return f"s{cur.fetchone()['n']}"
+
+    def space_members(self, sid):
+        with db_connect() as conn:
+            with conn.cursor() as cur:
+                if STORAGE_MODE == "relational":
+                    cur.execute("SELECT name FROM spaces WHERE space_id = %s;", (sid,))
+                    row = cur.fetchone()
+                    cur.execute("SELECT user_id FROM memberships WHERE space_id = %s ORDER BY user_id;", (sid,))
+                else:
+                    cur.execute("SELECT v->'spaces'->%s->>'name' AS name FROM kv_store WHERE k = %s;", (sid, "tasks"))
+                    row = cur.fetchone()
+                    cur.execute("""
+                        SELECT m.key AS user_id
+                        FROM kv_store, jsonb_each(
+                            CASE WHEN jsonb_typeof(v->'memberships') = 'object' THEN v->'memberships' ELSE '{}'::jsonb END
+                        ) AS m
+                        WHERE k = %s AND jsonb_typeof(m.value) = 'array' AND m.value ? %s
+                        ORDER BY m.key;
+                    """, ("tasks", sid))
+                return (row["name"] if row else None), [r["user_id"] for r in cur.fetchall()]
+
+    def attach_space_by_pass(self, doc, passphrase):
+        # 一部だけ読むのは relational だけ（kv は丸ごと読んでいる）
+        if STORAGE_MODE != "relational":
+            return None
+        return rel_attach_space_by_pass(doc, passphrase)
+
+    def ping(self):
         with db_connect() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT 1;")
                 cur.fetchone()
-        print("✅ DB connected (SELECT 1 OK)")
+
+    def close(self):
+        close_db_pool()
+
+def _doc_from_json(text, version):
+    """丸ごと1つの JSON（kv_store の "tasks"）→ TaskDoc"""
+    metrics.observe("linebot_tasks_load_bytes", len(text))
+    # 保存時の差分用に、DB にある通りの中身も持っておく（JSON を2回パースする方が deepcopy より速い）
+    with span("json_decode"):
+        doc = TaskDoc(normalize_tasks(json.loads(text)))
+        doc.snapshot = json.loads(text)
+    doc.versions["tasks"] = version
+    space_pass_index(doc)
+    return doc
+
+# rel_load(user_id=...) と同じく、1ユーザー分として読む範囲
+USER_SECTIONS = ("users", "checklists", "board_users", "settings", "memberships", "active_space")
+GROUP_SECTIONS = ("groups", "board_groups")
+SPACE_SECTIONS = ("spaces", "space_tasks", "space_ordinals")
+
+def _doc_slice(data, user_id, group_id=None):
+    """丸ごとの data から、user_id（と group_id）に関係する所だけをコピーした doc"""
+    doc = TaskDoc(copy.deepcopy(DEFAULT_TASKS))
+    doc.partial = True
+    pairs = [(section, user_id) for section in USER_SECTIONS]
+    if group_id:
+        pairs += [(section, group_id) for section in GROUP_SECTIONS]
+    for section, owner in pairs:
+        doc.loaded.add((section, owner))
+        value = _section_map(data, section).get(owner)
+        if value is not None:
+            _section_map(doc, section)[owner] = copy.deepcopy(value)
+
+    sids = set(doc["memberships"].get(user_id) or [])
+    if doc["active_space"].get(user_id):
+        sids.add(doc["active_space"][user_id])
+    _doc_slice_spaces(doc, data, sorted(sids))
+    return doc
+
+def _doc_slice_spaces(doc, data, sids):
+    for sid in sids:
+        doc.loaded.add(("spaces", sid))
+        doc.loaded.add(("space_tasks", sid))
+        for section in SPACE_SECTIONS:
+            value = data[section].get(sid)
+            if value is not None:
+                doc[section][sid] = copy.deepcopy(value)
+
+def _doc_merge(base, doc):
+    """
+    doc で変わったオーナーだけを、今の全体 base に重ねた dict（base は書き換えない）。
+    読んだ範囲は doc の通りに（消えていれば消す）、読んでない範囲は足すだけ（relational の保存と同じ）。
+    """
+    snap = doc.snapshot or copy.deepcopy(DEFAULT_TASKS)
+    merged = dict(base)
+    merged["board"] = dict(base["board"])
+    for section in USER_SECTIONS + GROUP_SECTIONS + SPACE_SECTIONS:
+        # space_ordinals は space_tasks と一緒に読んでいる
+        loaded_as = "space_tasks" if section == "space_ordinals" else section
+        out = None
+        for owner, old, new in _rel_changes(doc, loaded_as, _section_map(doc, section), _section_map(snap, section)):
+            if out is None:
+                out = dict(_section_map(base, section))
+            # doc はこの後も書き換えられるので、重ねるのはコピー（base と共有しない）
+            new = copy.deepcopy(new)
+            if old is not None:
+                if new is None:
+                    out.pop(owner, None)
+                else:
+                    out[owner] = new
+            elif new is None:
+                continue
+            elif isinstance(out.get(owner), list) and isinstance(new, list):
+                out[owner] = out[owner] + new
+            elif isinstance(out.get(owner), dict) and isinstance(new, dict):
+                out[owner] = {**out[owner], **new}
+            else:
+                out[owner] = new
+        if out is None:
+            continue
+        if section.startswith("board_"):
+            merged["board"][section[len("board_"):]] = out
+        else:
+            merged[section] = out
+    return merged
+
+class DocState:
+    """DocStorage の1回の読み書き（子クラスの _state() の中だけで使う）"""
+    shared = False   # True: data() は保存先が持っている dict そのもの（書き換えない・渡すときはコピー）
+
+    def data(self):
+        """return: 全体か None（まだ何も無い）。shared でなければ normalize_tasks 前の読んだまま"""
+        raise NotImplementedError
+
+    def versions(self, scopes=None):
+        """return: {scope: 版数}（無い scope は入らない）。scopes=None は全部"""
+        raise NotImplementedError
+
+    def write(self, data, versions):
+        """全体を data に置き換えて、versions（{scope: 新しい版数}）を書く。return: 書いたバイト数（分からなければ 0）"""
+        raise NotImplementedError
+
+class DocStorage(Storage):
+    """
+    全部を1つの JSON として持つ保存先（sqlite / memory）。
+    版数は relational と同じく範囲（"user:U" / "space:S" / "group:G"）ごと。保存は書き込みロックの中で今の全体を読み、
+    変わった範囲の版数だけ確かめて、その範囲だけ重ねて書く（別のユーザー同士はぶつからない）。
+    子クラスは _state / _read / 再送の印 / 採番 だけ書く。
+    """
+    @contextmanager
+    def _state(self, write=False):
+        """読み書きを1つにまとめる（write=True は書き込みロックを取る）。yield: DocState"""
+        raise NotImplementedError
+
+    def _read(self):
+        """今の全体（読むだけ。書き換えない）か None。版数は見ない（集会所のメンバー・採番用）"""
+        with self._state() as state:
+            return state.data()
+
+    def _replace(self, data):
+        """丸ごと置き換え。今ある範囲と新しく入る範囲の版数は全部上げる（前に読んだ doc の保存は StateConflict になる）"""
+        data = normalize_tasks(copy.deepcopy(dict(data)))
+        with self._state(write=True) as state:
+            current = state.versions()
+            state.write(data, {scope: current.get(scope, 0) + 1 for scope in set(current) | data_scopes(data)})
+
+    def init(self):
+        # ID の無い項目に ID を振って保存しておく（読むたびに違う ID にならないように）
+        data = self._read()
+        if data is None:
+            return
+        data = copy.deepcopy(data)
+        if assign_item_ids(data):
+            self._replace(data)
+            log.info("保存先の項目に ID を振った", extra={"storage": self.name})
+
+    @staticmethod
+    def _whole(state):
+        data = state.data()
+        if data is None:
+            return normalize_tasks(copy.deepcopy(DEFAULT_TASKS))
+        # 保存先が dict のまま持っているものは書くときに normalize_tasks 済み
+        return data if state.shared else normalize_tasks(data)
+
+    def load(self, user_id=None, group_id=None):
+        """全体を読むのは1回だけ。user_id を渡すとその人の分だけコピーした doc（relational と同じ範囲）"""
+        with self._state() as state:
+            data = self._whole(state)
+            if user_id is None:
+                doc = TaskDoc(copy.deepcopy(data) if state.shared else data)
+                doc.versions = state.versions()
+            else:
+                doc = _doc_slice(data, user_id, group_id)
+                doc.versions = state.versions(loaded_scopes(doc))
+        doc.snapshot = copy.deepcopy(dict(doc))
+        space_pass_index(doc)
+        return doc
+
+    def save(self, data):
+        if not isinstance(data, TaskDoc):
+            self._replace(data)
+            return {"*"}
+
+        if data.snapshot is not None and data == data.snapshot:
+            return set()
+        loaded, unloaded = _rel_touched_scopes(data)
+        scopes = loaded | unloaded
+        with self._state(write=True) as state:
+            current = state.versions(scopes)
+            # 読んだ範囲は、読んだ時点から誰も書いていないこと（読んでない範囲は足すだけなので見ない）
+            for scope in sorted(loaded):
+                if current.get(scope, 0) != data.versions.get(scope, 0):
+                    raise StateConflict(scope)
+            bumped = {scope: current.get(scope, 0) + 1 for scope in scopes}
+            nbytes = state.write(_doc_merge(self._whole(state), data), bumped)
+        data.versions.update(bumped)
+        data.snapshot = copy.deepcopy(dict(data))
+        _count_kv_save("full", nbytes)
+        return scopes
+
+    def attach_space_by_pass(self, doc, passphrase):
+        if not doc.partial:
+            return None
+        with self._state() as state:
+            data = self._whole(state)
+            sid = min((sid for sid, info in data["spaces"].items() if (info or {}).get("pass") == passphrase),
+                      default=None)
+            if sid is None or ("spaces", sid) in doc.loaded:
+                return sid
+            _doc_slice_spaces(doc, data, [sid])
+            doc.versions.update(state.versions([f"space:{sid}"]))
+        for section in SPACE_SECTIONS:
+            if sid in doc[section]:
+                doc.snapshot.setdefault(section, {})[sid] = copy.deepcopy(doc[section][sid])
+        space_pass_index(doc).setdefault(passphrase, sid)
+        return sid
+
+    def space_members(self, sid):
+        data = self._read() or {}
+        name = (data.get("spaces", {}).get(sid) or {}).get("name")
+        members = sorted(uid for uid, sids in data.get("memberships", {}).items()
+                         if isinstance(sids, list) and sid in sids)
+        return name, members
+
+    def _max_space_number(self):
+        spaces = (self._read() or {}).get("spaces", {})
+        return max((int(sid[1:]) for sid in spaces if re.fullmatch(r"s[0-9]+", sid)), default=0)
+
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS kv_store (
+        k TEXT PRIMARY KEY,
+        v TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        updated_at REAL
+    );""",
+    # 処理済みの webhookEventId（再送の重複防止）
+    """CREATE TABLE IF NOT EXISTS webhook_events (
+        event_id TEXT PRIMARY KEY,
+        seen_at REAL NOT NULL
+    );""",
+    "CREATE INDEX IF NOT EXISTS webhook_events_seen_idx ON webhook_events (seen_at);",
+    # 集会所ID（s1, s2, ...）の採番
+    "CREATE TABLE IF NOT EXISTS counters (k TEXT PRIMARY KEY, n INTEGER NOT NULL);",
+    # 範囲（"user:U" / "space:S" / "group:G"）ごとの版数
+    "CREATE TABLE IF NOT EXISTS state_versions (scope TEXT PRIMARY KEY, version INTEGER NOT NULL);",
+]
+
+class _SqliteState(DocState):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def data(self):
+        row = self.conn.execute("SELECT v FROM kv_store WHERE k = 'tasks';").fetchone()
+        if row is None:
+            return None
+        metrics.observe("linebot_tasks_load_bytes", len(row[0]))
+        with span("json_decode"):
+            return json.loads(row[0])
+
+    def versions(self, scopes=None):
+        if scopes is None:
+            rows = self.conn.execute("SELECT scope, version FROM state_versions;")
+        else:
+            rows = self.conn.execute("SELECT scope, version FROM state_versions WHERE scope IN (SELECT value FROM json_each(?));",
+                                     (json.dumps(sorted(scopes)),))
+        return dict(rows.fetchall())
+
+    def write(self, data, versions):
+        text = json.dumps(data, ensure_ascii=False)
+        self.conn.execute("""
+            INSERT INTO kv_store (k, v, version, updated_at) VALUES ('tasks', ?, 1, ?)
+            ON CONFLICT (k) DO UPDATE SET v = excluded.v, version = kv_store.version + 1, updated_at = excluded.updated_at;
+        """, (text, time.time()))
+        self.conn.executemany("""
+            INSERT INTO state_versions (scope, version) VALUES (?, ?)
+            ON CONFLICT (scope) DO UPDATE SET version = excluded.version;
+        """, list(versions.items()))
+        return len(text)
+
+class SqliteStorage(DocStorage):
+    """
+    SQLite（WAL）。1台で動かす小さな環境向け。同じファイルなら複数プロセスでも使える
+    （読み込みキャッシュは使わない：他のプロセスの書き込みを知る手段がないので）。
+    """
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()   # 接続はスレッドごと
+        self._conns = []
+        self._lock = threading.Lock()
+        # 同じプロセスのスレッド同士は書き込みをここで順番待ちする（SQLite の busy 待ちは順番を守らないので、
+        # 大きな doc を書く間に待たされ続けて SQLITE_BUSY_TIMEOUT を超えることがある）。他のプロセスとは busy 待ち
+        self._write_lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    @contextmanager
+    def _tx(self, write=False):
+        """write=True は最初から書き込みロックを取る（読んでから書くまでに他が割り込まない）"""
+        conn = self._conn()
+        with (self._write_lock if write else nullcontext()):
+            conn.execute("BEGIN IMMEDIATE;" if write else "BEGIN;")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK;")
+                raise
+            else:
+                conn.execute("COMMIT;")
+
+    def init(self):
+        with self._tx(write=True) as conn:
+            for stmt in SQLITE_SCHEMA:
+                conn.execute(stmt)
+        super().init()
+        # 今ある "s<番号>" の最大より後から振る
+        with self._tx(write=True) as conn:
+            conn.execute("INSERT OR IGNORE INTO counters (k, n) VALUES ('space_id', 0);")
+            conn.execute("UPDATE counters SET n = MAX(n, ?) WHERE k = 'space_id';", (self._max_space_number(),))
+
+    @contextmanager
+    def _state(self, write=False):
+        # 読むときも1つのトランザクション（JSON と版数がずれない）。書くときは BEGIN IMMEDIATE
+        with self._tx(write=write) as conn:
+            yield _SqliteState(conn)
+
+    def _read(self):
+        # next_space_id() のトランザクションの中からも呼ぶので、新しく BEGIN しない
+        return _SqliteState(self._conn()).data()
+
+    def claim_event(self, event_id):
+        with self._tx(write=True) as conn:
+            cur = conn.execute("INSERT OR IGNORE INTO webhook_events (event_id, seen_at) VALUES (?, ?);",
+                               (event_id, time.time()))
+            claimed = cur.rowcount == 1
+            now = time.monotonic()
+            if now - self._last_purge > WEBHOOK_DEDUP_PURGE_INTERVAL:
+                self._last_purge = now
+                conn.execute("DELETE FROM webhook_events WHERE seen_at < ?;", (time.time() - WEBHOOK_DEDUP_TTL,))
+        return claimed
+
+    def release_event(self, event_id):
+        with self._tx(write=True) as conn:
+            conn.execute("DELETE FROM webhook_events WHERE event_id = ?;", (event_id,))
+
+    def next_space_id(self):
+        with self._tx(write=True) as conn:
+            # 丸ごと保存で入った集会所（移行など）とも重ならないように
+            conn.execute("UPDATE counters SET n = MAX(n, ?) + 1 WHERE k = 'space_id';", (self._max_space_number(),))
+            n = conn.execute("SELECT n FROM counters WHERE k = 'space_id';").fetchone()[0]
+        return f"s{n}"
+
+    def ping(self):
+        self._conn().execute("SELECT 1;").fetchone()
+
+    def close(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+    def after_fork(self):
+        # 親の接続は子で使わない（閉じもしない）
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+class _MemoryState(DocState):
+    # JSON にしないで dict のまま持つ（保存は変わったオーナーをコピーして差し替えるだけで、中身は書き換えない）
+    shared = True
+
+    def __init__(self, st):
+        self.st = st
+
+    def data(self):
+        return self.st._data
+
+    def versions(self, scopes=None):
+        if scopes is None:
+            return dict(self.st._versions)
+        return {scope: self.st._versions[scope] for scope in scopes if scope in self.st._versions}
+
+    def write(self, data, versions):
+        self.st._data = data
+        self.st._versions.update(versions)
+        return 0
+
+class MemoryStorage(DocStorage):
+    """
+    プロセスのメモリだけ（再起動で消える）。DB なしで動かす・テスト・ベンチ用。
+    gunicorn の複数ワーカーでは中身がワーカーごとに別になるので使わない。
+    """
+    name = "memory"
+
+    def __init__(self):
+        self._data = None      # 全体（差し替えるだけで書き換えない）
+        self._versions = {}    # scope -> 版数
+        self._events = {}      # event_id -> 期限（time.monotonic()）
+        self._space_seq = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _state(self, write=False):
+        with self._lock:
+            yield _MemoryState(self)
+
+
+    def claim_event(self, event_id):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._events) > WEBHOOK_DEDUP_CACHE_SIZE:
+                self._events = {k: t for k, t in self._events.items() if t > now}
+            expires = self._events.get(event_id)
+            if expires is not None and expires > now:
+                return False
+            self._events[event_id] = now + WEBHOOK_DEDUP_TTL
+            return True
+
+    def release_event(self, event_id):
+        with self._lock:
+            self._events.pop(event_id, None)
+
+    def next_space_id(self):
+        n = self._max_space_number()
+        with self._lock:
+            self._space_seq = max(self._space_seq, n) + 1
+            return f"s{self._space_seq}"
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+STORAGE_BACKENDS = {"postgres": PostgresStorage, "sqlite": SqliteStorage, "memory": MemoryStorage}
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def make_storage(kind, **kwargs):
+    cls = STORAGE_BACKENDS.get(kind)
+    if cls is None:
+        raise ValueError(f"unknown STORAGE_BACKEND: {kind}（{' / '.join(STORAGE_BACKENDS)}）")
+    return cls(**kwargs)
+
+def storage():
+    """プロセスに1つ（fork した子は after_fork() で引き継ぐ。memory の中身は fork した時点のコピー）"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = make_storage(STORAGE_BACKEND)
+    return _storage
+
+# =========================
+# LINE Messaging API クライアント（keep-alive で接続を使い回す）
+# =========================
+
+LINE_API_BASE = os.getenv("LINE_API_BASE", "https://api.line.me")
+LINE_CONNECT_TIMEOUT = float(os.getenv("LINE_CONNECT_TIMEOUT", "3.05"))   # 秒
+LINE_READ_TIMEOUT = float(os.getenv("LINE_READ_TIMEOUT", "10"))           # 秒
+LINE_MAX_RETRIES = int(os.getenv("LINE_MAX_RETRIES", "2"))
+LINE_RETRY_BASE = float(os.getenv("LINE_RETRY_BASE", "0.3"))              # 秒
+LINE_RETRY_MAX_WAIT = float(os.getenv("LINE_RETRY_MAX_WAIT", "5"))        # 秒：Retry-After が長すぎても待つのはここまで
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", "10"))
+
+# 送信のレート制限（エンドポイントごとの token bucket。LINE の上限より少し下にしておく）
+LINE_RATE_LIMITS = {       # 1秒あたりの回数
+    "reply": float(os.getenv("LINE_RATE_REPLY", "1000")),
+    "push": float(os.getenv("LINE_RATE_PUSH", "1000")),
+    "multicast": float(os.getenv("LINE_RATE_MULTICAST", "100")),
+}
+LINE_RATE_WAITS = {        # 秒：順番待ちできる上限（reply は replyToken が切れる前に諦める）
+    "reply": float(os.getenv("LINE_RATE_WAIT_REPLY", "5")),
+    "push": float(os.getenv("LINE_RATE_WAIT_PUSH", "30")),
+    "multicast": float(os.getenv("LINE_RATE_WAIT_MULTICAST", "60")),
+}
+LINE_RATE_BURST = float(os.getenv("LINE_RATE_BURST", "1"))   # 秒：何秒分まで溜めて一気に出せるか
+LINE_QUOTA_CHECK = os.getenv("LINE_QUOTA_CHECK", "0") == "1"  # 月の送信数の上限を LINE に聞いて、超えそうなら push を控える
+LINE_QUOTA_REFRESH = float(os.getenv("LINE_QUOTA_REFRESH", "600"))   # 秒：上限・使用数を聞き直す間隔
+
+class TokenBucket:
+    """
+    スレッド間で共有する token bucket。
+    取るときに先に予約（残りがマイナスになってもよい）してから待つので、並んだ順に出ていく。
+    """
+    def __init__(self, rate, burst=LINE_RATE_BURST):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(1.0, self.rate * burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait):
+        """1回分を予約して待つべき秒数を返す。max_wait を超えるなら予約せずに None"""
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def block(self, seconds):
+        """429 を受けたら、seconds の間は誰にも出さない"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+# 順番待ち：result="acquired"（送れた）/ "throttled"（待てる上限を過ぎて送らなかった）。429 を受けた回数は別に数える
+metrics.define("linebot_line_rate_total", "counter", "LINE rate limiter decisions, by endpoint and result.")
+metrics.define("linebot_line_rate_wait_seconds", "histogram", "Time waited for the LINE rate limiter before sending.", SECONDS_BUCKETS)
+metrics.define("linebot_line_rate_limited_total", "counter", "429 responses from LINE (the endpoint is paused for Retry-After).")
+metrics.define("linebot_line_api_retries_total", "counter", "LINE API calls retried after 5xx / 429 / network errors.")
+metrics.define("linebot_line_messages_sent_total", "counter", "Messages counted against the monthly quota (push / multicast).")
+metrics.define("linebot_line_quota_limit", "gauge", "Monthly message limit reported by LINE (LINE_QUOTA_CHECK=1).")
+metrics.define("linebot_line_quota_used", "gauge", "Monthly messages used: LINE's count at the last check + sent since.")
+
+class LineRateLimiter:
+    """エンドポイントごとの TokenBucket。待ち時間・諦めた回数は metrics に数える"""
+    def __init__(self, limits=None, waits=None):
+        limits = LINE_RATE_LIMITS if limits is None else limits
+        self.waits = LINE_RATE_WAITS if waits is None else waits
+        self.buckets = {endpoint: TokenBucket(rate) for endpoint, rate in limits.items()}
+
+    def default_deadline(self, endpoint):
+        return time.monotonic() + self.waits.get(endpoint, LINE_RATE_WAITS["push"])
+
+    def acquire(self, endpoint, deadline):
+        """順番が来るまで待つ。deadline までに来ないなら False（呼び出し側が諦める）"""
+        bucket = self.buckets.get(endpoint)
+        if bucket is None:
+            return True
+        wait = bucket.reserve(max(0.0, deadline - time.monotonic()))
+        if wait is None:
+            metrics.inc("linebot_line_rate_total", (("endpoint", endpoint), ("result", "throttled")))
+            return False
+        metrics.inc("linebot_line_rate_total", (("endpoint", endpoint), ("result", "acquired")))
+        metrics.observe("linebot_line_rate_wait_seconds", wait, (("endpoint", endpoint),))
+        if wait > 0:
+            pause(wait)
         return True
-    except Exception as e:
-        print("❌ DB connection failed:", e)
-        return False
-    
+
+    def penalize(self, endpoint, seconds):
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None:
+            bucket.block(seconds)
+        metrics.inc("linebot_line_rate_limited_total", (("endpoint", endpoint),))
+
+class LineClient:
+    """
+    api.line.me への POST をまとめる。
+    - Session + HTTPAdapter で TLS 接続を使い回す
+    - connect/read タイムアウト（LINE が固まってもワーカーを止めない）
+    - 5xx / 429 / 通信エラーはバックオフして再送（429 は Retry-After の間そのエンドポイント全体を止める）
+    - エンドポイントごとの token bucket で送る速さを抑える（待てる上限を過ぎたら送らない）
+    - エンドポイントごとの呼び出し時間・ステータス、push/multicast で使った通数を metrics に数える
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, token=None, base_url=LINE_API_BASE):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.session = self._new_session()
+        self.limiter = LineRateLimiter()
+        # 月の送信数：used は起動してから（または LINE に聞いてから）送った通数
+        self.quota = {"used": {}, "limit": None, "consumed": None, "fetched_at": None}
+        self._quota_lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=LINE_POOL_SIZE, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Content-Type": "application/json"})
+        return session
+
+    def post(self, endpoint, payload, retry_key=False, deadline=None):
+        """
+        endpoint: "reply" / "push" など（/v2/bot/message/ の後ろ）
+        retry_key=True なら X-Line-Retry-Key を付ける（push は再送しても二重に届かない）
+        deadline: time.monotonic() でこの時刻までに送れなければ諦める（既定は LINE_RATE_WAIT_*）
+        return: requests.Response（通信エラー・順番待ちで諦めたときは None）
+        """
+        url = f"{self.base_url}/v2/bot/message/{endpoint}"
+        headers = {"Authorization": f"Bearer {self.token or LINE_CHANNEL_ACCESS_TOKEN}"}
+        if retry_key:
+            headers["X-Line-Retry-Key"] = str(uuid.uuid4())
+        if deadline is None:
+            deadline = self.limiter.default_deadline(endpoint)
+
+        for attempt in range(LINE_MAX_RETRIES + 1):
+            last = attempt >= LINE_MAX_RETRIES
+            with span("line_rate_wait"):
+                acquired = self.limiter.acquire(endpoint, deadline)
+            if not acquired:
+                metrics.inc("linebot_errors_total", (("kind", "line_throttled"),))
+                log.warning("LINE throttled: gave up waiting for the rate limit", extra={"endpoint": endpoint})
+                return None
+            t0 = time.perf_counter()
+            try:
+                with span(f"line_{endpoint}"):
+                    res = self._send("POST", url, headers, payload)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(endpoint, "error", time.perf_counter() - t0, retried=not last)
+                log.warning("LINE request failed", extra={"endpoint": endpoint, "attempt": attempt, "error": repr(e)})
+                if last:
+                    return None
+                pause(self._backoff(attempt))
+                continue
+
+            retry = res.status_code in self.RETRY_STATUS and not last
+            self._record(endpoint, res.status_code, time.perf_counter() - t0, retried=retry)
+            if res.status_code == 429:
+                # 同じエンドポイントを使う他のスレッドも止める（次の acquire で待つ）
+                self.limiter.penalize(endpoint, self._retry_after(res) or self._backoff(attempt))
+            elif res.status_code == 200:
+                self._count_quota(endpoint, payload)
+            if not retry:
+                return res
+            if res.status_code != 429:
+                pause(self._backoff(attempt))
+
+    def _send(self, method, url, headers, payload=None):
+        """1回分の HTTP（非同期モードの AsyncLineClient はここだけ差し替える）"""
+        # bytes は JSON 化済み（FlexCache の結果を埋め込んだもの）なのでそのまま送る
+        body = {"data": payload} if isinstance(payload, bytes) else {"json": payload}
+        return self.session.request(method, url, headers=headers, timeout=(LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT),
+                                    **(body if payload is not None else {}))
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(LINE_RETRY_MAX_WAIT, LINE_RETRY_BASE * (2 ** attempt)))
+
+    def _retry_after(self, res):
+        value = res.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return min(LINE_RETRY_MAX_WAIT, max(0.0, float(value)))
+        except ValueError:
+            try:
+                wait = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+                return min(LINE_RETRY_MAX_WAIT, max(0.0, wait))
+            except (TypeError, ValueError):
+                return None
+
+    def _record(self, endpoint, status, elapsed, retried=False):
+        metrics.observe("linebot_line_api_seconds", elapsed, (("endpoint", endpoint), ("status", str(status))))
+        if status == "error" or status >= 500:
+            metrics.inc("linebot_errors_total", (("kind", "line_api"),))
+        if retried:
+            metrics.inc("linebot_line_api_retries_total", (("endpoint", endpoint),))
+
+    def _count_quota(self, endpoint, payload):
+        """push / multicast は月の送信数を使う（reply は数えない）"""
+        if endpoint not in ("push", "multicast") or not isinstance(payload, dict):
+            return
+        n = len(payload.get("messages", [])) * (len(payload.get("to", [])) if endpoint == "multicast" else 1)
+        metrics.inc("linebot_line_messages_sent_total", (("endpoint", endpoint),), n)
+        with self._quota_lock:
+            self.quota["used"][endpoint] = self.quota["used"].get(endpoint, 0) + n
+
+    def _refresh_quota(self):
+        """LINE に月の上限と使用数を聞く（LINE_QUOTA_REFRESH 秒に1回）。聞いた時点で used を数え直す"""
+        headers = {"Authorization": f"Bearer {self.token or LINE_CHANNEL_ACCESS_TOKEN}"}
+        try:
+            q = self._send("GET", f"{self.base_url}/v2/bot/message/quota", headers)
+            c = self._send("GET", f"{self.base_url}/v2/bot/message/quota/consumption", headers)
+            limit = q.json().get("value") if q.status_code == 200 and q.json().get("type") == "limited" else None
+            consumed = c.json().get("totalUsage") if c.status_code == 200 else None
+        except (requests.RequestException, ValueError) as e:
+            log.warning("LINE quota check failed", extra={"error": repr(e)})
+            limit, consumed = None, None
+        with self._quota_lock:
+            self.quota["fetched_at"] = time.monotonic()
+            if consumed is not None:
+                self.quota.update(limit=limit, consumed=consumed, used={})
+
+    def quota_allows(self, n=1):
+        """
+        push / multicast で n 通送っても月の上限を超えないか。
+        LINE_QUOTA_CHECK が無効・上限なし・聞けなかったときは True。
+        """
+        if not LINE_QUOTA_CHECK:
+            return True
+        with self._quota_lock:
+            fetched_at = self.quota["fetched_at"]
+        if fetched_at is None or time.monotonic() - fetched_at >= LINE_QUOTA_REFRESH:
+            self._refresh_quota()
+        with self._quota_lock:
+            if self.quota["limit"] is None or self.quota["consumed"] is None:
+                return True
+            used = self.quota["consumed"] + sum(self.quota["used"].values())
+            return used + n <= self.quota["limit"]
+
+    def quota_metrics(self, client):
+        """
+        LINE に聞けたときだけ（LINE_QUOTA_CHECK=1）。上限はチャネル全体の値なので、ワーカーを足さないよう pid を付ける。
+        client: "sync" / "async"（非同期モードは同じプロセスに2つある）
+        """
+        with self._quota_lock:
+            if self.quota["consumed"] is None:
+                return []
+            labels = (("client", client), ("pid", str(os.getpid())))
+            rows = [("linebot_line_quota_used", labels, self.quota["consumed"] + sum(self.quota["used"].values()))]
+            if self.quota["limit"] is not None:
+                rows.append(("linebot_line_quota_limit", labels, self.quota["limit"]))
+        return rows
+
+_line_client = None
+_line_client_pid = None
+_line_client_lock = threading.Lock()
+
+def line_client():
+    """プロセスごとに1つ（fork 後は作り直す：親の TLS 接続を共有しない）"""
+    global _line_client, _line_client_pid
+    io = _async_io.get()
+    if io is not None:
+        return io.line_client
+    pid = os.getpid()
+    if _line_client is None or _line_client_pid != pid:
+        with _line_client_lock:
+            if _line_client is None or _line_client_pid != pid:
+                _line_client = LineClient(LINE_CHANNEL_ACCESS_TOKEN)
+                _line_client_pid = pid
+    return _line_client
+
+@metrics.collector
+def _collect_line_quota():
+    if _line_client is None or _line_client_pid != os.getpid():
+        return []
+    return _line_client.quota_metrics("sync")
+
+def log_line_response(endpoint, res):
+    """200 は DEBUG（間引く）、それ以外は本文も WARNING で"""
+    if res.status_code == 200:
+        log.debug("LINE response", extra={"endpoint": endpoint, "status": res.status_code})
+    else:
+        log.warning("LINE response", extra={"endpoint": endpoint, "status": res.status_code,
+                                             "body": res.text[:LOG_BODY_MAX]})
+
 def send_reply(reply_token, text):
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
-    }
+    # イベント処理中は保存が終わってから送る
+    if defer_outbound(send_reply, reply_token, text):
+        return
+
     data = {
         "replyToken": reply_token,
         "messages": [
@@ -141,99 +3002,417 @@ def send_reply(reply_token, text):
             }
         ]
     }
-    res = requests.post(url, headers=headers, json=data)
-    print("LINE reply status:", res.status_code)
-    print("LINE reply body:", res.text)
-
-def send_push(user_id, message):
-    url = "https://api.line.me/v2/bot/message/push"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
-    }
+    res = line_client().post("reply", data)
+    if res is not None:
+        log_line_response("reply", res)
+
+def send_push(user_id, message, fallback_reply_token=None):
+    """
+    fallback_reply_token: 月の上限・レート制限で push できないとき、代わりにこの replyToken で返す
+    """
+    if defer_outbound(send_push, user_id, message, fallback_reply_token):
+        return
+
     data = {
         "to": user_id,
         "messages": [message]
     }
 
-    res = requests.post(url, headers=headers, json=data)
-    print("PUSH status:", res.status_code)
-    print("PUSH body:", res.text)
+    client = line_client()
+    res = None
+    if client.quota_allows(1):
+        res = client.post("push", data, retry_key=True)
+    if res is not None:
+        log_line_response("push", res)
+    if (res is None or res.status_code == 429) and fallback_reply_token:
+        log.info("PUSH unavailable → reply instead")
+        client.post("reply", {"replyToken": fallback_reply_token, "messages": [message]})
 
 def send_flex(reply_token, flex):
-    url = "https://api.line.me/v2/bot/message/reply"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"
-    }
-    data = {
-        "replyToken": reply_token,
-        "messages": [flex]
-    }
-    requests.post(url, headers=headers, json=data)
+    """flex: メッセージの dict、または render_flex() が返す JSON 化済みの bytes"""
+    if defer_outbound(send_flex, reply_token, flex):
+        return
 
-def build_schedule_flex(personal_tasks, global_tasks, show_done=False, show_delete=False, space_name=None):
-    body = []
+    if isinstance(flex, bytes):
+        data = b'{"replyToken":' + json.dumps(reply_token).encode() + b',"messages":[' + flex + b']}'
+    else:
+        data = {
+            "replyToken": reply_token,
+            "messages": [flex]
+        }
+    line_client().post("reply", data)
 
-    body.append({
-        "type": "text",
-        "text": "📅 予定表",
-        "weight": "bold",
-        "size": "lg"
-    })
+# =========================
+# 集会所の通知：全体予定が増えたらメンバーに multicast（webhook の処理とは別スレッド）
+# =========================
 
-    # 👤 個人予定
-    body.append({
-        "type": "text",
-        "text": "👤 個人の予定",
-        "weight": "bold",
-        "margin": "lg"
-    })
+SPACE_NOTIFY = os.getenv("SPACE_NOTIFY", "0") == "1"
+SPACE_NOTIFY_DELAY = float(os.getenv("SPACE_NOTIFY_DELAY", "5"))   # 秒：この間の追加は1通にまとめる
+SPACE_NOTIFY_MAX_LINES = 10      # 1通に並べる予定の数（残りは「ほか N 件」）
+MULTICAST_MAX_TO = 500           # LINE の multicast 1回の宛先の上限
+
+class SpaceNotifier:
+    """
+    集会所ごとに「追加された予定」を溜めて、最初の追加から SPACE_NOTIFY_DELAY 秒後に1通にまとめて送る。
+    宛先は memberships から引き、MULTICAST_MAX_TO 人ずつ multicast する（1人ずつ push はしない）。
+    """
+    def __init__(self, delay=SPACE_NOTIFY_DELAY):
+        self.delay = delay
+        self.pending = {}    # sid -> {"due": time.monotonic(), "items": [(追加した user_id, text), ...]}
+        self.stats = {"queued": 0, "coalesced": 0, "flushes": 0, "requests": 0, "recipients": 0, "failed": 0,
+                      "skipped_quota": 0}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.thread = threading.Thread(target=self._run, name="space-notifier", daemon=True)
+        self.thread.start()
+
+    def add(self, sid, user_id, text):
+        with self._cond:
+            self.stats["queued"] += 1
+            entry = self.pending.get(sid)
+            if entry is not None:
+                entry["items"].append((user_id, text))
+                self.stats["coalesced"] += 1
+                return
+            self.pending[sid] = {"due": time.monotonic() + self.delay, "items": [(user_id, text)]}
+            self._cond.notify()
+
+    def _take_due(self):
+        """期限が来た分を取り出す（止めるときは全部）。無ければ待つ"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                due = [sid for sid, e in self.pending.items() if self._stopped or e["due"] <= now]
+                if due:
+                    return [(sid, self.pending.pop(sid)["items"]) for sid in due]
+                if self._stopped:
+                    return None
+                wait = min(e["due"] for e in self.pending.values()) - now if self.pending else None
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            batch = self._take_due()
+            if batch is None:
+                return
+            for sid, items in batch:
+                try:
+                    self._flush(sid, items)
+                except Exception:
+                    log.exception("space notify failed", extra={"space_id": sid})
+                    with self._cond:
+                        self.stats["failed"] += 1
+
+    def _flush(self, sid, items):
+        name, members = space_members(sid)
+        # 自分で足した予定だけなら本人には送らない
+        to = [uid for uid in members if any(author != uid for author, _ in items)]
+        with self._cond:
+            self.stats["flushes"] += 1
+        if not to:
+            return
+
+        lines = [f"• {text}" for _, text in items[:SPACE_NOTIFY_MAX_LINES]]
+        if len(items) > SPACE_NOTIFY_MAX_LINES:
+            lines.append(f"…ほか {len(items) - SPACE_NOTIFY_MAX_LINES} 件")
+        message = {"type": "text", "text": f"🌍 「{name or sid}」に全体予定が追加されたよ\n" + "\n".join(lines)}
+
+        client = line_client()
+        for i in range(0, len(to), MULTICAST_MAX_TO):
+            chunk = to[i:i + MULTICAST_MAX_TO]
+            if not client.quota_allows(len(chunk)):
+                # 月の上限に近い：お知らせは諦める（予定表を開けば見える）
+                with self._cond:
+                    self.stats["skipped_quota"] += len(to) - i
+                log.info("MULTICAST skipped: monthly quota", extra={"space_id": sid})
+                return
+            res = client.post("multicast", {"to": chunk, "messages": [message]}, retry_key=True)
+            ok = res is not None and res.status_code == 200
+            with self._cond:
+                self.stats["requests"] += 1
+                self.stats["recipients"] += len(chunk) if ok else 0
+                self.stats["failed"] += 0 if ok else 1
+            if not ok:
+                log.warning("MULTICAST failed", extra={"space_id": sid, "status": res.status_code if res is not None else "error"})
+
+    def shutdown(self, timeout=None):
+        """溜まっている分は待たずに送ってから止める"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self.thread.join(timeout)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats["pending"] = sum(len(e["items"]) for e in self.pending.values())
+        return stats
+
+_space_notifier = None
+_space_notifier_pid = None
+_space_notifier_lock = threading.Lock()
+
+SPACE_NOTIFY_METRICS = {
+    "queued": ("linebot_space_notify_added_total", "Space tasks queued for a notification."),
+    "coalesced": ("linebot_space_notify_coalesced_total", "Space tasks merged into an already pending notification."),
+    "flushes": ("linebot_space_notify_flushes_total", "Pending notifications sent out (one per space per delay)."),
+    "requests": ("linebot_space_notify_multicasts_total", "multicast calls made for space notifications."),
+    "recipients": ("linebot_space_notify_recipients_total", "Users reached by successful space notification multicasts."),
+    "failed": ("linebot_space_notify_failed_total", "Space notification multicasts (or flushes) that failed."),
+    "skipped_quota": ("linebot_space_notify_skipped_quota_total", "Recipients skipped because the monthly quota was near."),
+}
+for _name, _help in SPACE_NOTIFY_METRICS.values():
+    metrics.define(_name, "counter", _help)
+metrics.define("linebot_space_notify_pending", "gauge", "Space tasks waiting for their notification to be sent.")
+
+@metrics.collector
+def _collect_space_notifier():
+    if _space_notifier is None or _space_notifier_pid != os.getpid():
+        return []
+    stats = _space_notifier.get_stats()
+    rows = [(name, (), stats[key]) for key, (name, _help) in SPACE_NOTIFY_METRICS.items()]
+    return rows + [("linebot_space_notify_pending", (), stats["pending"])]
+
+def space_notifier():
+    """プロセスごとに1つ（fork 後の子ではスレッドが無いので作り直す）"""
+    global _space_notifier, _space_notifier_pid
+    pid = os.getpid()
+    if _space_notifier is None or _space_notifier_pid != pid:
+        with _space_notifier_lock:
+            if _space_notifier is None or _space_notifier_pid != pid:
+                _space_notifier = SpaceNotifier()
+                _space_notifier_pid = pid
+    return _space_notifier
+
+def _shutdown_space_notifier():
+    if _space_notifier is not None and _space_notifier_pid == os.getpid():
+        _space_notifier.shutdown(timeout=10)
+
+# close_db_pool より先に動く（atexit は登録の逆順）ので、最後の分も DB を引いて送れる
+atexit.register(_shutdown_space_notifier)
+
+def space_members(sid):
+    """集会所の名前と、参加している user_id（通知用に保存先から直接引く）"""
+    return storage().space_members(sid)
+
+def notify_space_task_added(sid, user_id, text):
+    """全体予定の追加を通知に積む（イベント処理中は保存が終わってから）"""
+    if not SPACE_NOTIFY:
+        return
+    if defer_outbound(notify_space_task_added, sid, user_id, text):
+        return
+    space_notifier().add(sid, user_id, text)
+
+# =========================
+# Flex の描画キャッシュ（同じ入力の画面は組み立ても JSON 化もしない）
+# =========================
+
+FLEX_CACHE_SIZE = int(os.getenv("FLEX_CACHE_SIZE", "512"))   # 画面数
+
+class FlexCache:
+    """
+    画面の種類＋キー → JSON 化済みの bytes の LRU。
+    キーは読んだ範囲の版数（保存のたびに上がる）＋ UI フラグ・カーソルなどで、中身は見ない（予定が多くてもヒットは同じ速さ）。
+    メニューは UI フラグの組み合わせ分しかないので、ほぼ毎回ヒットする。
+    """
+    def __init__(self, size=FLEX_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, kind, key, build):
+        """key: 画面の中身を決める値（hash できるもの。None ならキャッシュしない）。build(): メッセージの dict を返す"""
+        labels = (("kind", kind),)
+        if key is None:
+            metrics.inc("linebot_flex_cache_lookups_total", labels + (("result", "bypass"),))
+            return self._build(build, labels)
+
+        key = (kind, key)
+        with self._lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+        if body is not None:
+            metrics.inc("linebot_flex_cache_lookups_total", labels + (("result", "hit"),))
+            return body
+
+        body = self._build(build, labels)
+        metrics.inc("linebot_flex_cache_lookups_total", labels + (("result", "miss"),))
+
+        evicted = []
+        with self._lock:
+            self.entries[key] = body
+            while len(self.entries) > self.size:
+                evicted.append(self.entries.popitem(last=False)[0][0])
+        for evicted_kind in evicted:
+            metrics.inc("linebot_flex_cache_evictions_total", (("kind", evicted_kind),))
+        return body
+
+    @staticmethod
+    def _build(build, labels):
+        t0 = time.perf_counter()
+        with span("flex_build"):
+            body = json.dumps(build(), ensure_ascii=False, separators=(",", ":")).encode()
+        metrics.observe("linebot_flex_render_seconds", time.perf_counter() - t0, labels)
+        return body
+
+# 画面の種類ごとのヒット率（hit / 全部）と、ミスしたときの組み立て＋JSON 化の時間
+metrics.define("linebot_flex_cache_lookups_total", "counter", "Flex cache lookups by screen kind and result (bypass: built from unsaved changes).")
+metrics.define("linebot_flex_cache_evictions_total", "counter", "Flex cache entries dropped for size (LRU), by screen kind.")
+metrics.define("linebot_flex_render_seconds", "histogram", "Time to build and serialize a Flex message on a cache miss.",
+               (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+metrics.define("linebot_flex_cache_entries", "gauge", "Serialized Flex messages currently cached.")
+
+flex_cache = FlexCache()
+
+@metrics.collector
+def _collect_flex_cache():
+    return [("linebot_flex_cache_entries", (), len(flex_cache.entries))]
+
+def render_flex(kind, key, build):
+    return flex_cache.render(kind, key, build)
+
+def flex_state_key(tasks, *extra):
+    """
+    tasks から組み立てる画面のキー：読んだ範囲の版数＋ extra（ユーザー・UI フラグ・カーソルなど）。
+    このイベントで書き換えてまだ保存していない doc は、版数と中身が合わないので None（キャッシュしない）
+    """
+    uow = current_uow()
+    if uow is not None and uow.dirty and uow.tasks is tasks:
+        return None
+    versions = getattr(tasks, "versions", None)
+    if versions is None:
+        return None
+    return (tuple(sorted(versions.items())),) + extra
+
+# =========================
+# Flex のページ分け（LINE の上限：bubble 30KB / carousel 50KB・12枚。少し余裕を持たせる）
+# =========================
+
+FLEX_BUBBLE_MAX_BYTES = int(os.getenv("FLEX_BUBBLE_MAX_BYTES", "25000"))
+FLEX_CAROUSEL_MAX_BYTES = int(os.getenv("FLEX_CAROUSEL_MAX_BYTES", "45000"))
+FLEX_CAROUSEL_MAX_BUBBLES = 12
+FLEX_PAGE_ROWS = int(os.getenv("FLEX_PAGE_ROWS", "20"))    # 1ページの行数の上限（サイズに余裕があっても）
+FLEX_NAV_RESERVE = 800   # 前へ/次へ・見出しなどの分
+
+def flex_size(obj):
+    return len(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode())
 
-    if personal_tasks:
-        for i, task in enumerate(personal_tasks):
+def take_rows(count, build_row, start, budget, limit=FLEX_PAGE_ROWS, step=1):
+    """
+    start 番目から build_row(i)（部品のリスト）を順に組み立てて、budget バイト・limit 行に収まる分を返す。
+    step=-1 は start の手前から逆向きに（「前へ」の開始位置を出す用）。
+    return: (行のリスト, 次の位置)  ※ step=-1 のときは (行, 入れた一番前の位置)
+    1行目はサイズを超えても入れる（進まなくなるので）
+    """
+    rows, used = [], 0
+    i = start if step > 0 else start - 1
+    while 0 <= i < count and len(rows) < limit:
+        row = build_row(i)
+        size = flex_size(row)
+        if rows and used + size > budget:
+            break
+        rows.append(row)
+        used += size
+        i += step
+    return rows, (i if step > 0 else i + 1)
+
+def page_bounds(count, build_row, cursor, budget, limit=FLEX_PAGE_ROWS):
+    """cursor のページの行を組み立てる。return: (行, 開始, 終了, 前ページの開始)"""
+    cursor = max(0, min(cursor, count - 1)) if count else 0
+    rows, end = take_rows(count, build_row, cursor, budget, limit)
+    prev = take_rows(count, build_row, cursor, budget, limit, step=-1)[1] if cursor else 0
+    return rows, cursor, end, prev
+
+def page_nav(data_format, start, end, count, prev):
+    """前へ/次へ の行。1ページに収まってるときは None。data_format: "#board_page_{}" など"""
+    if start == 0 and end >= count:
+        return None
+    contents = [{"type": "text", "text": f"{start + 1}–{end} / {count}", "size": "xs",
+                 "color": "#94A3B8", "flex": 3, "gravity": "center"}]
+    if start > 0:
+        contents.append({"type": "button", "style": "secondary", "height": "sm", "flex": 2,
+                         "action": {"type": "postback", "label": "◀ 前へ", "data": data_format.format(prev)}})
+    if end < count:
+        contents.append({"type": "button", "style": "secondary", "height": "sm", "flex": 2,
+                         "action": {"type": "postback", "label": "次へ ▶", "data": data_format.format(end)}})
+    return {"type": "box", "layout": "horizontal", "spacing": "sm", "margin": "lg", "contents": contents}
+
+
+def build_schedule_flex(personal_tasks, global_tasks, show_done=False, show_delete=False, space_name=None, cursor=0):
+    """
+    個人予定 → 全体予定 を1列に並べて、cursor 番目からサイズに収まる分だけ描く。
+    完了・削除のボタンには今のページの開始位置を入れる（押した後も同じページを出す）
+    """
+    n_personal = len(personal_tasks)
+    count = n_personal + len(global_tasks)
+    page = max(0, min(cursor, count - 1)) if count else 0   # page_bounds と同じ丸め
+
+    def build_row(i):
+        if i < n_personal:
+            task = personal_tasks[i]
+            ref = item_ref(task, i)
             if show_done:
                 # 完了済み表示（復帰だけ）
-                body.append(task_row(task["text"], f"#list_undo_p_{i}", delete_data=None, label="↩"))
-            else:
-                # 通常表示（完了 + 必要なら削除）
-                if show_delete:
-                    body.append(task_row(task["text"], f"#list_done_p_{i}", f"#list_delete_p_{i}", label="✅"))
-                else:
-                    body.append(task_row(task["text"], f"#list_done_p_{i}", delete_data=None, label="✅"))
-    else:
-        body.append(empty_row())
+                return [task_row(task["text"], f"#list_undo_p_{ref}", delete_data=None, label="↩")]
+            # 通常表示（完了 + 必要なら削除）
+            if show_delete:
+                return [task_row(task["text"], f"#list_done_p_{ref}_{page}", f"#list_delete_p_{ref}_{page}", label="✅")]
+            return [task_row(task["text"], f"#list_done_p_{ref}_{page}", delete_data=None, label="✅")]
 
-    # 🌍 全体予定（集会所名を表示）
-    title = "🌍 全体の予定"
-    if space_name:
-        title += f"（{space_name}）"
+        # ※必要なら「全体の完了済み復帰」を作るならここ（今は show_done でも通常と同じ）
+        task = global_tasks[i - n_personal]
+        ref = task.get("_id")
+        if show_delete:
+            return [task_row(task["text"], f"#space_done_{ref}_{page}", f"#space_delete_{ref}_{page}")]
+        return [task_row(task["text"], f"#space_done_{ref}_{page}", delete_data=None)]
+
+    rows, start, end, prev = page_bounds(count, build_row, cursor, FLEX_BUBBLE_MAX_BYTES - FLEX_NAV_RESERVE)
+
+    body = []
 
     body.append({
         "type": "text",
-        "text": title,
+        "text": "📅 予定表",
         "weight": "bold",
-        "margin": "lg"
+        "size": "lg"
     })
 
-    if global_tasks:
-        for task in global_tasks:
-            idx = task.get("_idx")
+    # 👤 個人予定（このページに入ってるときだけ見出しを出す）
+    if start < n_personal or start == 0:
+        body.append({
+            "type": "text",
+            "text": "👤 個人の予定",
+            "weight": "bold",
+            "margin": "lg"
+        })
+        if not personal_tasks:
+            body.append(empty_row())
+    for i, row in enumerate(rows, start):
+        if i < n_personal:
+            body += row
 
-            if show_done:
-                # ※必要なら「全体の完了済み復帰」を作るならここ
-                # 今は「予定表」では未使用想定なので、いったん通常と同じにしておく
-                if show_delete:
-                    body.append(task_row(task["text"], f"#space_done_{idx}", f"#space_delete_{idx}"))
-                else:
-                    body.append(task_row(task["text"], f"#space_done_{idx}", delete_data=None))
-            else:
-                if show_delete:
-                    body.append(task_row(task["text"], f"#space_done_{idx}", f"#space_delete_{idx}"))
-                else:
-                    body.append(task_row(task["text"], f"#space_done_{idx}", delete_data=None))
-    else:
-        body.append(empty_row())
+    # 🌍 全体予定（集会所名を表示）
+    if end > n_personal or end >= count:
+        title = "🌍 全体の予定"
+        if space_name:
+            title += f"（{space_name}）"
+
+        body.append({
+            "type": "text",
+            "text": title,
+            "weight": "bold",
+            "margin": "lg"
+        })
+        if not global_tasks:
+            body.append(empty_row())
+    for i, row in enumerate(rows, start):
+        if i >= n_personal:
+            body += row
+
+    nav = page_nav("#schedule_page_{}", start, end, count, prev)
+    if nav:
+        body.append(nav)
 
     body.append({
         "type": "button",
@@ -311,8 +3490,13 @@ def empty_row():
         "color": "#999999"
     }
     
-def send_schedule(reply_token, personal_tasks, global_tasks, show_done=False, user_id=None):
-    tasks = load_tasks()
+def send_schedule(reply_token, personal_tasks, global_tasks, show_done=False, user_id=None, cursor=0,
+                  global_source="space"):
+    """
+    personal_tasks: 未完了の個人予定 / global_tasks: 全体予定（global_source が "space" なら今の集会所、
+    ("group", group_id) ならグループ、None なら空）。画面のキャッシュキーは tasks の版数と global_source から作る
+    """
+    tasks = load_tasks(user_id)
 
     # 予定表UI（削除モード）
     show_delete = get_schedule_ui_flags(tasks, user_id).get("show_delete", False)
@@ -323,7 +3507,8 @@ def send_schedule(reply_token, personal_tasks, global_tasks, show_done=False, us
     if sid:
         space_name = tasks.get("spaces", {}).get(sid, {}).get("name", sid)
 
-    flex = {
+    key = flex_state_key(tasks, user_id, global_source, show_done, show_delete, cursor)
+    flex = render_flex("schedule", key, lambda: {
         "type": "flex",
         "altText": "予定表",
         "contents": build_schedule_flex(
@@ -331,18 +3516,37 @@ def send_schedule(reply_token, personal_tasks, global_tasks, show_done=False, us
             global_tasks,
             show_done=show_done,
             show_delete=show_delete,
-            space_name=space_name
+            space_name=space_name,
+            cursor=cursor
         )
-    }
+    })
 
     # ★ここがポイント：既存の send_flex を使うので url/headers 不要
     send_flex(reply_token, flex)
     
-def send_done_schedule(reply_token, personal_done, space_done):
+def handle_schedule_list(reply_token, user_id, group_id=None, cursor=0):
+    tasks = load_tasks(user_id, group_id)
+    personal = [t for t in tasks["users"].get(user_id, []) if t.get("status") != "done"]
+
+    global_tasks, sid = get_space_global_tasks(tasks, user_id)
+
+    if not sid:
+        send_reply(reply_token, "🗝 まだ集会所が未選択だよ。\n「その他」→「合言葉で集会所に参加」から入ってね")
+        return
+
+    send_schedule(reply_token, personal, global_tasks, user_id=user_id, cursor=cursor)
+
+def send_done_schedule(reply_token, personal_done, space_done, user_id=None):
     """
-    personal_done: [{"text":..., "_idx": int}, ...]  ※ _idx 付きにする
-    space_done:    [{"text":..., "_idx": int}, ...]
+    personal_done: [{"text":..., "_id": str}, ...]  ※ _id 付きにする
+    space_done:    [{"text":..., "_id": str}, ...]
+    user_id の予定・今の集会所から作ったもの（キャッシュキーはその tasks の版数）
     """
+    key = flex_state_key(load_tasks(user_id), user_id)
+    flex = render_flex("done_schedule", key, lambda: build_done_schedule_flex(personal_done, space_done))
+    send_flex(reply_token, flex)
+
+def build_done_schedule_flex(personal_done, space_done):
     body = [
         {"type": "text", "text": "✅ 完了済み", "weight": "bold", "size": "lg"},
         {"type": "separator", "margin": "md"},
@@ -352,7 +3556,7 @@ def send_done_schedule(reply_token, personal_done, space_done):
     body.append({"type": "text", "text": "【個人】", "margin": "md", "weight": "bold"})
     if personal_done:
         for t in personal_done:
-            idx = t.get("_idx")
+            ref = t.get("_id")
             body.append({
                 "type": "box",
                 "layout": "horizontal",
@@ -364,7 +3568,7 @@ def send_done_schedule(reply_token, personal_done, space_done):
                         "style": "secondary",
                         "height": "sm",
                         "flex": 2,
-                        "action": {"type": "postback", "label": "🗑", "data": f"#done_delete_p_{idx}"}
+                        "action": {"type": "postback", "label": "🗑", "data": f"#done_delete_p_{ref}"}
                     }
                 ]
             })
@@ -375,7 +3579,7 @@ def send_done_schedule(reply_token, personal_done, space_done):
     body.append({"type": "text", "text": "【全体（集会所）】", "margin": "lg", "weight": "bold"})
     if space_done:
         for t in space_done:
-            idx = t.get("_idx")
+            ref = t.get("_id")
             body.append({
                 "type": "box",
                 "layout": "horizontal",
@@ -387,22 +3591,21 @@ def send_done_schedule(reply_token, personal_done, space_done):
                         "style": "secondary",
                         "height": "sm",
                         "flex": 2,
-                        "action": {"type": "postback", "label": "🗑", "data": f"#done_delete_s_{idx}"}
+                        "action": {"type": "postback", "label": "🗑", "data": f"#done_delete_s_{ref}"}
                     }
                 ]
             })
     else:
         body.append({"type": "text", "text": "（なし）", "size": "sm", "color": "#94A3B8"})
 
-    flex = {
+    return {
         "type": "flex",
         "altText": "完了済み",
         "contents": {"type": "bubble", "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": body}}
     }
-    send_flex(reply_token, flex)
     
 def handle_menu_add(reply_token, user_id):
-    tasks = load_tasks()
+    tasks = load_tasks(user_id)
 
     # チェックUI
     check_ui = get_check_ui_flags(tasks, user_id)
@@ -414,6 +3617,10 @@ def handle_menu_add(reply_token, user_id):
     sched_ui = get_schedule_ui_flags(tasks, user_id)
     sched_del_state = "ON" if sched_ui.get("show_delete") else "OFF"
 
+    inputs = (check_ops_open, del_state, reo_state, sched_del_state)
+    send_flex(reply_token, render_flex("menu_add", inputs, lambda: build_menu_add_flex(*inputs)))
+
+def build_menu_add_flex(check_ops_open, del_state, reo_state, sched_del_state):
     contents = [
         {"type": "text", "text": "➕ 追加", "weight": "bold", "size": "lg"},
 
@@ -464,23 +3671,26 @@ def handle_menu_add(reply_token, user_id):
             },
         ]
 
-    flex = {
+    return {
         "type": "flex",
         "altText": "追加",
         "contents": {"type": "bubble", "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": contents}}
     }
-    send_flex(reply_token, flex)
     
 BOARD_TITLE = "伝言板"
 
 def handle_other_menu(reply_token, user_id, source_type=None, group_id=None):
-    tasks = load_tasks()
+    tasks = load_tasks(user_id, group_id)
     ui = get_board_ui_flags(tasks, user_id)
     ops_open = ui.get("show_ops", False)
 
     del_state = "ON" if ui.get("show_delete") else "OFF"
     reo_state = "ON" if ui.get("show_reorder") else "OFF"
 
+    inputs = (ops_open, del_state, reo_state)
+    send_flex(reply_token, render_flex("other_menu", inputs, lambda: build_other_menu_flex(*inputs)))
+
+def build_other_menu_flex(ops_open, del_state, reo_state):
     contents = [
         {"type": "text", "text": "🧰 その他", "weight": "bold", "size": "lg"},
         {"type": "separator", "margin": "md"},
@@ -522,13 +3732,12 @@ def handle_other_menu(reply_token, user_id, source_type=None, group_id=None):
              "action": {"type": "postback", "label": f"↕ 並び替えモード：{reo_state}", "data": "#board_toggle_reorder"}},
         ]
 
-    flex = {
+    return {
         "type": "flex",
         "altText": "その他",
         "contents": {"type": "bubble", "styles": {"body": {"backgroundColor": "#F8FAFC"}},
                     "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": contents}}
     }
-    send_flex(reply_token, flex)
     
 def normalize_pass(s: str) -> str:
     # 合言葉の表記揺れを減らす（空白トリム、連続空白を1つ）
@@ -546,21 +3755,42 @@ def get_or_create_space_by_pass(tasks, passphrase: str, created_by: str):
         return None
 
     # 既存検索
-    for sid, info in tasks.get("spaces", {}).items():
-        if info.get("pass") == passphrase:
+    sid = space_pass_index(tasks).get(passphrase)
+    if sid:
+        return sid
+
+    # 1ユーザー分だけ読んだ doc には未参加の集会所が入ってないので保存先を引く
+    partial = getattr(tasks, "partial", False)
+    if partial:
+        sid = storage().attach_space_by_pass(tasks, passphrase)
+        if sid:
             return sid
 
     # 新規作成
-    # space_id は単純に連番でOK（衝突しにくい）
     tasks.setdefault("spaces", {})
-    sid = f"s{len(tasks['spaces']) + 1}"
+    sid = next_space_id()
+    if partial:
+        tasks.loaded.add(("spaces", sid))
+        tasks.loaded.add(("space_tasks", sid))
 
     tasks["spaces"][sid] = {
         "name": passphrase,      # 今は名前＝合言葉でOK（後で編集可能にしても良い）
         "pass": passphrase,
         "created_by": created_by
     }
+    space_pass_index(tasks)[passphrase] = sid
     return sid
+
+def space_pass_index(tasks):
+    """合言葉 -> space_id。doc と一緒に持っておいて、集会所を足すたびに足す"""
+    index = getattr(tasks, "pass_index", None)
+    if index is None:
+        index = {}
+        for sid, info in tasks.get("spaces", {}).items():
+            index.setdefault(info.get("pass"), sid)
+        if isinstance(tasks, TaskDoc):
+            tasks.pass_index = index
+    return index
     
 def join_space(tasks, user_id: str, space_id: str):
     tasks.setdefault("memberships", {})
@@ -581,7 +3811,7 @@ def get_user_spaces(tasks, user_id: str):
     tasks.setdefault("memberships", {})
     return tasks["memberships"].get(user_id, [])
 
-def build_space_list_flex(tasks, user_id: str):
+def build_space_list_flex(tasks, user_id: str, cursor=0):
     spaces = tasks.get("spaces", {})
     memberships = get_user_spaces(tasks, user_id)      # 例: ["s1","s2"]
     active_sid = get_active_space_id(tasks, user_id)   # 例: "s1" or None
@@ -595,54 +3825,61 @@ def build_space_list_flex(tasks, user_id: str):
         {"type": "separator", "margin": "md"},
     ]
 
-    if not memberships:
-        body.append({"type": "text", "text": "まだ参加してる集会所がないよ", "color": "#94A3B8"})
-    else:
-        for sid in memberships:
-            info = spaces.get(sid, {})
-            name = info.get("name", sid)
-            is_active = (sid == active_sid)
+    def build_row(i):
+        sid = memberships[i]
+        info = spaces.get(sid, {})
+        name = info.get("name", sid)
+        is_active = (sid == active_sid)
 
-            # 右側ボタン（切替 / 退出）
-            right_box = {
-                "type": "box",
-                "layout": "vertical",
-                "spacing": "xs",
-                "flex": 3,
-                "contents": [
-                    {
-                        "type": "button",
-                        "style": "secondary" if is_active else "primary",
-                        "height": "sm",
-                        "action": {
-                            "type": "postback",
-                            "label": "✅" if is_active else "切替",
-                            "data": f"#space_set_{sid}"
-                        }
-                    },
-                    {
-                        "type": "button",
-                        "style": "secondary",
-                        "height": "sm",
-                        "action": {
-                            "type": "postback",
-                            "label": "退出",
-                            "data": f"#space_leave_{sid}"
-                        }
+        # 右側ボタン（切替 / 退出）
+        right_box = {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "xs",
+            "flex": 3,
+            "contents": [
+                {
+                    "type": "button",
+                    "style": "secondary" if is_active else "primary",
+                    "height": "sm",
+                    "action": {
+                        "type": "postback",
+                        "label": "✅" if is_active else "切替",
+                        "data": f"#space_set_{sid}"
                     }
-                ]
-            }
+                },
+                {
+                    "type": "button",
+                    "style": "secondary",
+                    "height": "sm",
+                    "action": {
+                        "type": "postback",
+                        "label": "退出",
+                        "data": f"#space_leave_{sid}"
+                    }
+                }
+            ]
+        }
 
-            body.append({
-                "type": "box",
-                "layout": "horizontal",
-                "spacing": "sm",
-                "contents": [
-                    {"type": "text", "text": f"{'✅ ' if is_active else ''}{name}", "wrap": True, "flex": 7, "size": "sm"},
-                    right_box
-                ]
-            })
+        return [{
+            "type": "box",
+            "layout": "horizontal",
+            "spacing": "sm",
+            "contents": [
+                {"type": "text", "text": f"{'✅ ' if is_active else ''}{name}", "wrap": True, "flex": 7, "size": "sm"},
+                right_box
+            ]
+        }]
 
+    if not memberships:
+        body.append({"type": "text", "text": "まだ参加してる集会所がないよ", "color": "#94A3B8"})
+    else:
+        rows, start, end, prev = page_bounds(count, build_row, cursor, FLEX_BUBBLE_MAX_BYTES - FLEX_NAV_RESERVE)
+        for row in rows:
+            body += row
+        nav = page_nav("#space_page_{}", start, end, count, prev)
+        if nav:
+            body.append(nav)
 
     return {
         "type": "flex",
@@ -658,13 +3895,13 @@ def build_space_list_flex(tasks, user_id: str):
         }
     }
 
-def handle_space_list(reply_token, user_id: str):
-    tasks = load_tasks()
-    flex = build_space_list_flex(tasks, user_id)
-    send_flex(reply_token, flex)
+def handle_space_list(reply_token, user_id: str, cursor=0):
+    tasks = load_tasks(user_id)
+    key = flex_state_key(tasks, user_id, cursor)
+    send_flex(reply_token, render_flex("space_list", key, lambda: build_space_list_flex(tasks, user_id, cursor)))
 
 def handle_space_set(reply_token, user_id: str, sid: str):
-    tasks = load_tasks()
+    tasks = load_tasks(user_id)
 
     # 参加してない集会所に切替しようとしたら拒否
     memberships = get_user_spaces(tasks, user_id)
@@ -680,7 +3917,7 @@ def handle_space_set(reply_token, user_id: str, sid: str):
     send_reply(reply_token, f"✅ Active集会所を「{name}」に切り替えたよ")
     
 def handle_space_leave(reply_token, user_id: str, sid: str):
-    tasks = load_tasks()
+    tasks = load_tasks(user_id)
 
     memberships = tasks.get("memberships", {}).get(user_id, [])
     if sid not in memberships:
@@ -703,8 +3940,8 @@ def handle_space_leave(reply_token, user_id: str, sid: str):
     
 def get_space_global_tasks(tasks, user_id: str):
     """
-    Active集会所の「未完了の全体予定」を返す（表示用に _idx を付ける）
-    return: (list[{"text":..., "_idx": int}], sid or None)
+    Active集会所の「未完了の全体予定」を返す（postback 用に _id を付ける）
+    return: (list[{"text":..., "_id": str}], sid or None)
     """
     sid = tasks.get("active_space", {}).get(user_id)
     if not sid:
@@ -713,18 +3950,19 @@ def get_space_global_tasks(tasks, user_id: str):
     tasks.setdefault("space_tasks", {})
     items = tasks["space_tasks"].setdefault(sid, [])
 
-    visible = []
-    for idx, t in enumerate(items):
-        done_by = t.get("done_by", [])
-        if user_id not in done_by:
-            visible.append({"text": t.get("text", ""), "_idx": idx})
+    bit = space_member_bit(tasks, sid, user_id)
+    visible = [
+        {"text": t.get("text", ""), "_id": item_ref(t, idx)}
+        for idx, t in enumerate(items)
+        if not t.get("done_mask", 0) & bit
+    ]
 
     return visible, sid
 
 
 def get_space_done_tasks(tasks, user_id: str):
     """
-    Active集会所の「完了済み全体予定」を返す（表示用に _idx を付ける）
+    Active集会所の「完了済み全体予定」を返す（postback 用に _id を付ける）
     """
     sid = tasks.get("active_space", {}).get(user_id)
     if not sid:
@@ -733,11 +3971,15 @@ def get_space_done_tasks(tasks, user_id: str):
     tasks.setdefault("space_tasks", {})
     items = tasks["space_tasks"].setdefault(sid, [])
 
-    done = []
-    for idx, t in enumerate(items):
-        done_by = t.get("done_by", [])
-        if user_id in done_by:
-            done.append({"text": t.get("text", ""), "_idx": idx})
+    # まだ何も完了してないメンバーは、全部見ないで済む
+    bit = space_member_bit(tasks, sid, user_id)
+    if not bit:
+        return [], sid
+    done = [
+        {"text": t.get("text", ""), "_id": item_ref(t, idx)}
+        for idx, t in enumerate(items)
+        if t.get("done_mask", 0) & bit
+    ]
 
     return done, sid
     
@@ -746,25 +3988,26 @@ def _get_board_list(tasks, source_type, user_id, group_id):
         return tasks["board"]["groups"].setdefault(group_id, [])
     return tasks["board"]["users"].setdefault(user_id, [])
 
-def handle_board_list(reply_token, user_id, source_type=None, group_id=None):
-    tasks = load_tasks()
+def handle_board_list(reply_token, user_id, source_type=None, group_id=None, cursor=0):
+    tasks = load_tasks(user_id, group_id)
     ui = get_board_ui_flags(tasks, user_id)
     show_delete = ui.get("show_delete", False)
     show_reorder = ui.get("show_reorder", False)
 
     items = _get_board_list(tasks, source_type, user_id, group_id)
 
-    body = [
-        {"type": "text", "text": f"📌 {BOARD_TITLE}", "weight": "bold", "size": "lg"},
-        {"type": "text", "text": "（連絡先もお願い事もここにまとめる）", "size": "sm", "color": "#64748B"},
-        {"type": "separator", "margin": "md"},
-    ]
+    board_owner = ("group", group_id) if source_type == "group" and group_id else ("user", user_id)
+
+    def build():
+        body = [
+            {"type": "text", "text": f"📌 {BOARD_TITLE}", "weight": "bold", "size": "lg"},
+            {"type": "text", "text": "（連絡先もお願い事もここにまとめる）", "size": "sm", "color": "#64748B"},
+            {"type": "separator", "margin": "md"},
+        ]
 
-    if not items:
-        body.append({"type": "text", "text": "まだ何も入ってないよ", "color": "#94A3B8"})
-    else:
-        for i, it in enumerate(items):
-            text = it.get("text", "")
+        def build_row(i):
+            text = items[i].get("text", "")
+            ref = item_ref(items[i], i)
             row = [
                 {"type": "text", "text": f"• {text}", "wrap": True, "flex": 8, "size": "sm"}
             ]
@@ -772,37 +4015,49 @@ def handle_board_list(reply_token, user_id, source_type=None, group_id=None):
             if show_delete:
                 row.append({
                     "type": "button", "style": "secondary", "height": "sm", "flex": 1,
-                    "action": {"type": "postback", "label": "🗑", "data": f"#board_delete_{i}"}
+                    "action": {"type": "postback", "label": "🗑", "data": f"#board_delete_{ref}"}
                 })
 
-            body.append({"type": "box", "layout": "horizontal", "spacing": "sm", "contents": row})
+            parts = [{"type": "box", "layout": "horizontal", "spacing": "sm", "contents": row}]
 
             if show_reorder:
-                body.append({
+                parts.append({
                     "type": "box", "layout": "horizontal", "spacing": "sm", "margin": "xs",
                     "contents": [
                         {"type": "button", "style": "secondary", "height": "sm",
-                         "action": {"type": "postback", "label": "↑", "data": f"#board_move_{i}_up"}},
+                         "action": {"type": "postback", "label": "↑", "data": f"#board_move_{ref}_up"}},
                         {"type": "button", "style": "secondary", "height": "sm",
-                         "action": {"type": "postback", "label": "↓", "data": f"#board_move_{i}_down"}},
+                         "action": {"type": "postback", "label": "↓", "data": f"#board_move_{ref}_down"}},
                     ]
                 })
+            return parts
 
-    flex = {
-        "type": "flex",
-        "altText": BOARD_TITLE,
-        "contents": {"type": "bubble", "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": body}}
-    }
-    send_flex(reply_token, flex)
+        if not items:
+            body.append({"type": "text", "text": "まだ何も入ってないよ", "color": "#94A3B8"})
+        else:
+            rows, start, end, prev = page_bounds(len(items), build_row, cursor, FLEX_BUBBLE_MAX_BYTES - FLEX_NAV_RESERVE)
+            for row in rows:
+                body += row
+            nav = page_nav("#board_page_{}", start, end, len(items), prev)
+            if nav:
+                body.append(nav)
+
+        return {
+            "type": "flex",
+            "altText": BOARD_TITLE,
+            "contents": {"type": "bubble", "body": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": body}}
+        }
+
+    key = flex_state_key(tasks, user_id, board_owner, show_delete, show_reorder, cursor)
+    send_flex(reply_token, render_flex("board", key, build))
     
 def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
-    tasks = load_tasks()
+    tasks = load_tasks(user_id, group_id)
     # ✅ DBに保存したstateを優先（Renderの複数プロセス対策）
     state = get_persisted_state(tasks, user_id) or user_states.get(user_id)
 
     # ✅ 集会所 参加（合言葉入力）
     if state == "space_join_wait_pass":
-        tasks = load_tasks()
         passphrase = normalize_pass(text)
         if not passphrase:
             send_reply(reply_token, "合言葉が空っぽみたい。もう一度送ってね")
@@ -825,17 +4080,18 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
     
     # ✅ Active集会所の全体予定 追加（統一：space_add_global:{sid}）
     if state and state.startswith("space_add_global:"):
-        tasks = load_tasks()
         sid = state.split(":", 1)[1]
 
         tasks.setdefault("space_tasks", {})
         tasks["space_tasks"].setdefault(sid, []).append({
+            "id": new_item_id(),
             "text": text,
-            "done_by": []
+            "done_mask": 0
         })
 
         save_tasks(tasks)
         user_states.pop(user_id, None)
+        notify_space_task_added(sid, user_id, text)
 
         personal = [t for t in tasks["users"].get(user_id, []) if t.get("status") != "done"]
         global_tasks, _ = get_space_global_tasks(tasks, user_id)
@@ -844,14 +4100,12 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
     
     # ✅ 伝言板 追加（ここを最上部に）
     if state and state.startswith("board_add"):
-        tasks = load_tasks()
-
         if state == "board_add_user":
-            tasks["board"]["users"].setdefault(user_id, []).append({"text": text})
+            tasks["board"]["users"].setdefault(user_id, []).append({"id": new_item_id(), "text": text})
         else:
             # board_add_group:<gid>
             gid = state.split(":", 1)[1]
-            tasks["board"]["groups"].setdefault(gid, []).append({"text": text})
+            tasks["board"]["groups"].setdefault(gid, []).append({"id": new_item_id(), "text": text})
 
         save_tasks(tasks)
         user_states.pop(user_id, None)
@@ -859,15 +4113,14 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
         return
         
     if state == "space_add_global":
-        tasks = load_tasks()
-        
         global_list, sid = get_space_global_tasks(tasks, user_id)
         if not sid:
             send_reply(reply_token, "まだ集会所に参加してないみたい。先に「合言葉で集会所に参加」を押してね")
             return
             
-        tasks["space_tasks"][sid].append({"text": text, "done_by": []})
+        tasks["space_tasks"][sid].append({"id": new_item_id(), "text": text, "done_mask": 0})
         save_tasks(tasks)
+        notify_space_task_added(sid, user_id, text)
         
         user_states.pop(user_id, None)
         send_reply(reply_token, "🌍 全体予定を追加したよ")
@@ -875,12 +4128,11 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
     
     # チェックリストタイトル入力
     if state == "add_check_title":
-        tasks = load_tasks()
-        
         tasks.setdefault("checklists", {})
         tasks["checklists"].setdefault(user_id, [])
         
         tasks["checklists"][user_id].append({
+            "id": new_item_id(),
             "title": text,
             "items": []
         })
@@ -893,15 +4145,14 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
     
     # チェックリスト項目追加
     if state == "add_check_items":
-        tasks = load_tasks()
-        
         if text == "完了":
-            user_states.pop(user_id)
+            user_states.pop(user_id, None)
             save_tasks(tasks)
             send_reply(reply_token, "✅ チェックリスト作成完了")
             return
             
         tasks["checklists"][user_id][-1]["items"].append({
+            "id": new_item_id(),
             "text": text,
             "done": False
         })
@@ -912,8 +4163,10 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
 
     # ✅ チェックリスト：項目追加（既存リストに追記）
     if state and state.startswith("add_check_item:"):
-        _, c_idx, opened = state.split(":")
-        c_idx = int(c_idx)
+        # state の中身は ID（旧形式の位置も読める）
+        _, c_ref, opened = state.split(":")
+        checklists = tasks.get("checklists", {}).get(user_id, [])
+        c_idx = find_checklist(tasks, user_id, c_ref)
 
         if text.strip() == "キャンセル":
             user_states.pop(user_id, None)
@@ -922,29 +4175,27 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
             send_reply(reply_token, "キャンセルしたよ")
             return
 
-        checklists = tasks.get("checklists", {}).get(user_id, [])
-        if 0 <= c_idx < len(checklists):
-            checklists[c_idx].setdefault("items", []).append({"text": text, "done": False})
+        if c_idx is not None:
+            checklists[c_idx].setdefault("items", []).append({"id": new_item_id(), "text": text, "done": False})
 
         # ✅ state を両方から消す（次に残さない）
         user_states.pop(user_id, None)
         clear_persisted_state(tasks, user_id)
         save_tasks(tasks)
 
-        handle_list_check(reply_token, user_id, c_idx)
+        handle_list_check(reply_token, user_id, -1 if c_idx is None else c_idx)
         return
         
     # ===== 個人予定追加 =====
     if state == "add_personal":
-        tasks = load_tasks()
-
         tasks["users"].setdefault(user_id, []).append({
+            "id": new_item_id(),
             "text": text,
             "status": "todo"
         })
 
         save_tasks(tasks)
-        user_states.pop(user_id)
+        user_states.pop(user_id, None)
 
         personal = [
             t for t in tasks["users"].get(user_id, [])
@@ -960,23 +4211,24 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
                 if user_id not in t.get("done_by", [])
             ]
 
-        send_schedule(reply_token, personal, group_tasks)
+        send_schedule(reply_token, personal, group_tasks, user_id=user_id,
+                      global_source=("group", group_id) if source_type == "group" and group_id else None)
 
     # ===== 全体予定追加 =====
     elif state and state.startswith("add_global_"):
         group_id = state.replace("add_global_", "")
-        tasks = load_tasks()
 
         tasks.setdefault("groups", {})
         tasks["groups"].setdefault(group_id, [])
 
         tasks["groups"][group_id].append({
+            "id": new_item_id(),
             "text": text,
             "done_by": []
         })
 
         save_tasks(tasks)
-        user_states.pop(user_id)
+        user_states.pop(user_id, None)
 
         send_reply(reply_token, "🌍 全体予定を追加したよ")
         
@@ -984,80 +4236,64 @@ def handle_message(reply_token, user_id, text, source_type=None, group_id=None):
     else:
         send_reply(reply_token, "メニューから操作してね")
         
-def handle_done(reply_token, user_id, data, source_type, group_id=None):
-    tasks = load_tasks()
-
-    _, _, scope, idx = data.split("_")
-    idx = int(idx)
+def handle_done(reply_token, user_id, scope, ref, source_type, group_id=None, cursor=0):
+    tasks = load_tasks(user_id, group_id)
 
     if scope == "p":
-        tasks["users"][user_id][idx]["status"] = "done"
+        user_list = tasks["users"].get(user_id, [])
+        idx = find_item(tasks, ("users", user_id), user_list, ref)
+        if idx is not None:
+            user_list[idx]["status"] = "done"
 
     elif scope == "g" and group_id:
         tasks.setdefault("groups", {})
         tasks["groups"].setdefault(group_id, [])
+        group_list = tasks["groups"][group_id]
+        idx = find_item(tasks, ("groups", group_id), group_list, ref)
+        if idx is not None and user_id not in group_list[idx].get("done_by", []):
+            group_list[idx].setdefault("done_by", []).append(user_id)
         
     elif scope == "s":
         sid = get_active_space_id(tasks, user_id)
         if sid:
             tasks.setdefault("space_tasks", {})
-            tasks["space_tasks"].setdefault(sid, [])
-            if 0 <= idx < len(tasks["space_tasks"][sid]):
-                tasks["space_tasks"][sid][idx]["status"] = "done"
-        
-        tasks["groups"][group_id][idx].setdefault("done_by", []).append(user_id)
+            items = tasks["space_tasks"].setdefault(sid, [])
+            idx = find_item(tasks, ("space_tasks", sid), items, ref)
+            if idx is not None:
+                set_space_task_done(tasks, sid, items[idx], user_id)
 
     save_tasks(tasks)
-        # ✅ 予定表を再表示（未完了のみ）
+    # ✅ 予定表を再表示（未完了のみ）
     personal = [t for t in tasks["users"].get(user_id, []) if t.get("status") != "done"]
     global_tasks, _ = get_space_global_tasks(tasks, user_id)
-    send_schedule(reply_token, personal, global_tasks, user_id=user_id)
-
-    # 更新後の予定を再表示
-    personal = [t for t in tasks["users"].get(user_id, []) if t.get("status") != "done"]
-    
-    group_tasks = []
-    if source_type == "group" and group_id:
-        tasks.setdefault("groups", {})
-        tasks["groups"].setdefault(group_id, [])
-        
-        group_tasks = [
-            t for t in tasks["groups"][group_id]
-            if user_id not in t.get("done_by", [])
-        ]
-    
-    send_done_schedule(reply_token, personal_done, space_done)
+    send_schedule(reply_token, personal, global_tasks, user_id=user_id, cursor=cursor)
     
 def handle_show_done(reply_token, user_id, source_type, group_id=None):
-    tasks = load_tasks()
+    tasks = load_tasks(user_id, group_id)
 
-    # ✅ 個人の完了済み（_idx 付き）
+    # ✅ 個人の完了済み（_id 付き）
     user_items = tasks.get("users", {}).get(user_id, [])
     personal_done = []
     for idx, t in enumerate(user_items):
         if t.get("status") == "done":
-            personal_done.append({"text": t.get("text", ""), "_idx": idx})
+            personal_done.append({"text": t.get("text", ""), "_id": item_ref(t, idx)})
 
-    # ✅ 集会所の完了済み（_idx 付き）
-    space_done, _sid = get_space_done_tasks(tasks, user_id)  # これはあなたが _idx 付きにしてある前提
+    # ✅ 集会所の完了済み（_id 付き）
+    space_done, _sid = get_space_done_tasks(tasks, user_id)
 
-    send_done_schedule(reply_token, personal_done, space_done)
+    send_done_schedule(reply_token, personal_done, space_done, user_id=user_id)
     
-def handle_delete(reply_token, user_id, data, source_type, group_id=None):
+def handle_delete(reply_token, user_id, scope, ref, source_type, group_id=None, cursor=0):
     """
-    data: #list_delete_p_{idx}  or  #list_delete_g_{idx}
+    #list_delete_p_{id}  or  #list_delete_g_{id}
     """
-    tasks = load_tasks()
-
-    # data を分解
-    # 例: "#list_delete_p_0" -> ["#list", "delete", "p", "0"]
-    _, _, scope, idx = data.split("_")
-    idx = int(idx)
+    tasks = load_tasks(user_id, group_id)
 
     if scope == "p":
         # 個人予定
         user_list = tasks.get("users", {}).get(user_id, [])
-        if 0 <= idx < len(user_list):
+        idx = find_item(tasks, ("users", user_id), user_list, ref)
+        if idx is not None:
             user_list.pop(idx)
             tasks["users"][user_id] = user_list
 
@@ -1065,7 +4301,8 @@ def handle_delete(reply_token, user_id, data, source_type, group_id=None):
         # 全体予定（グループ）
         if source_type == "group" and group_id:
             group_list = tasks.get("groups", {}).get(group_id, [])
-            if 0 <= idx < len(group_list):
+            idx = find_item(tasks, ("groups", group_id), group_list, ref)
+            if idx is not None:
                 group_list.pop(idx)
                 tasks.setdefault("groups", {})[group_id] = group_list
                 
@@ -1074,7 +4311,8 @@ def handle_delete(reply_token, user_id, data, source_type, group_id=None):
         if sid:
             tasks.setdefault("space_tasks", {})
             items = tasks["space_tasks"].setdefault(sid, [])
-            if 0 <= idx < len(items):
+            idx = find_item(tasks, ("space_tasks", sid), items, ref)
+            if idx is not None:
                 items.pop(idx)
     save_tasks(tasks)
 
@@ -1091,11 +4329,11 @@ def handle_delete(reply_token, user_id, data, source_type, group_id=None):
             if user_id not in t.get("done_by", [])
         ]
 
-    send_schedule(reply_token, personal, global_tasks, user_id=user_id)
+    send_schedule(reply_token, personal, global_tasks, user_id=user_id, cursor=cursor,
+                  global_source=("group", group_id) if source_type == "group" and group_id else None)
     
-def handle_space_done(reply_token, user_id, data):
-    idx = int(data.split("_")[-1])
-    tasks = load_tasks()
+def handle_space_done(reply_token, user_id, ref, cursor=0):
+    tasks = load_tasks(user_id)
 
     sid = get_active_space_id(tasks, user_id)
     if not sid:
@@ -1105,20 +4343,18 @@ def handle_space_done(reply_token, user_id, data):
     tasks.setdefault("space_tasks", {})
     items = tasks["space_tasks"].setdefault(sid, [])
 
-    if 0 <= idx < len(items):
-        items[idx].setdefault("done_by", [])
-        if user_id not in items[idx]["done_by"]:
-            items[idx]["done_by"].append(user_id)
+    idx = find_item(tasks, ("space_tasks", sid), items, ref)
+    if idx is not None:
+        set_space_task_done(tasks, sid, items[idx], user_id)
 
     save_tasks(tasks)
 
     personal = [t for t in tasks["users"].get(user_id, []) if t.get("status") != "done"]
     global_tasks, _ = get_space_global_tasks(tasks, user_id)
-    send_schedule(reply_token, personal, global_tasks, user_id=user_id)
+    send_schedule(reply_token, personal, global_tasks, user_id=user_id, cursor=cursor)
 
-def handle_space_delete(reply_token, user_id, data):
-    idx = int(data.split("_")[-1])
-    tasks = load_tasks()
+def handle_space_delete(reply_token, user_id, ref, cursor=0):
+    tasks = load_tasks(user_id)
 
     sid = get_active_space_id(tasks, user_id)
     if not sid:
@@ -1128,21 +4364,22 @@ def handle_space_delete(reply_token, user_id, data):
     tasks.setdefault("space_tasks", {})
     items = tasks["space_tasks"].setdefault(sid, [])
 
-    if 0 <= idx < len(items):
+    idx = find_item(tasks, ("space_tasks", sid), items, ref)
+    if idx is not None:
         items.pop(idx)
 
     save_tasks(tasks)
 
     personal = [t for t in tasks["users"].get(user_id, []) if t.get("status") != "done"]
     global_tasks, _ = get_space_global_tasks(tasks, user_id)
-    send_schedule(reply_token, personal, global_tasks, user_id=user_id)
+    send_schedule(reply_token, personal, global_tasks, user_id=user_id, cursor=cursor)
     
-def handle_done_delete_personal(reply_token, user_id, data):
-    idx = int(data.split("_")[-1])
-    tasks = load_tasks()
+def handle_done_delete_personal(reply_token, user_id, ref):
+    tasks = load_tasks(user_id)
 
     user_list = tasks.get("users", {}).get(user_id, [])
-    if 0 <= idx < len(user_list) and user_list[idx].get("status") == "done":
+    idx = find_item(tasks, ("users", user_id), user_list, ref)
+    if idx is not None and user_list[idx].get("status") == "done":
         user_list.pop(idx)
         tasks["users"][user_id] = user_list
         save_tasks(tasks)
@@ -1151,9 +4388,8 @@ def handle_done_delete_personal(reply_token, user_id, data):
     handle_show_done(reply_token, user_id, source_type=None, group_id=None)
 
 
-def handle_done_delete_space(reply_token, user_id, data):
-    idx = int(data.split("_")[-1])
-    tasks = load_tasks()
+def handle_done_delete_space(reply_token, user_id, ref):
+    tasks = load_tasks(user_id)
 
     sid = get_active_space_id(tasks, user_id)
     if not sid:
@@ -1164,40 +4400,53 @@ def handle_done_delete_space(reply_token, user_id, data):
     items = tasks["space_tasks"].setdefault(sid, [])
 
     # “完了済み”だけ削除許可（安全）
-    if 0 <= idx < len(items) and user_id in items[idx].get("done_by", []):
+    idx = find_item(tasks, ("space_tasks", sid), items, ref)
+    if idx is not None and is_space_task_done(tasks, sid, items[idx], user_id):
         items.pop(idx)
         save_tasks(tasks)
 
     handle_show_done(reply_token, user_id, source_type=None, group_id=None)
 
-def handle_undo(reply_token, user_id, data, group_id):
-    tasks = load_tasks()
-
-    _, _, scope, idx = data.split("_")
-    idx = int(idx)
+def handle_undo(reply_token, user_id, scope, ref, group_id):
+    tasks = load_tasks(user_id, group_id)
 
     if scope == "p":
-        tasks["users"][user_id][idx]["status"] = "todo"
+        user_list = tasks["users"].get(user_id, [])
+        idx = find_item(tasks, ("users", user_id), user_list, ref)
+        if idx is not None:
+            user_list[idx]["status"] = "todo"
 
     elif scope == "g" and group_id:
         tasks.setdefault("groups", {})
-        tasks["groups"].setdefault(group_id, [])
-        
+        group_list = tasks["groups"].setdefault(group_id, [])
+        idx = find_item(tasks, ("groups", group_id), group_list, ref)
+        if idx is not None and user_id in group_list[idx].get("done_by", []):
+            group_list[idx]["done_by"].remove(user_id)
+
     elif scope == "s":
         sid = tasks.get("active_space", {}).get(user_id)
         if not sid:
             send_reply(reply_token, "⚠️ 集会所が未選択だよ。")
             return
-        
-        if user_id in tasks["groups"][group_id][idx].get("done_by", []):
-            tasks["groups"][group_id][idx]["done_by"].remove(user_id)
+
+        items = tasks.get("space_tasks", {}).get(sid, [])
+        idx = find_item(tasks, ("space_tasks", sid), items, ref)
+        if idx is not None:
+            set_space_task_done(tasks, sid, items[idx], user_id, done=False)
 
     save_tasks(tasks)
 
     send_reply(reply_token, "復帰したよ")
 
-def handle_list_check(reply_token, user_id, opened=-1):
-    tasks = load_tasks()
+# 1ページに並べるチェックリストの数（＋前へ/次へ の1枚で carousel の上限 12枚以内）
+CHECK_PAGE_LISTS = 10
+
+def handle_list_check(reply_token, user_id, opened=-1, cursor=None, item_cursor=0):
+    """
+    cursor: 何番目のリストから並べるか（None なら開いてるリストが入るページ）
+    item_cursor: 開いてるリストの何番目の項目から表示するか
+    """
+    tasks = load_tasks(user_id)
 
     # UIフラグ
     ui = get_check_ui_flags(tasks, user_id)
@@ -1206,332 +4455,378 @@ def handle_list_check(reply_token, user_id, opened=-1):
 
     checklists = tasks.get("checklists", {}).get(user_id, [])
 
-    try:
-        opened = int(opened)
-    except:
+    # postback からは ref（ID か旧形式の位置）、中からは位置で来る
+    if isinstance(opened, str):
+        opened = find_checklist(tasks, user_id, opened)
+    if opened is None or not 0 <= opened < len(checklists):
         opened = -1
+    opened_ref = item_ref(checklists[opened], opened) if opened >= 0 else "-1"
 
-    bubbles = []
+    if checklists:
+        if cursor is None:
+            cursor = (opened // CHECK_PAGE_LISTS) * CHECK_PAGE_LISTS if opened >= 0 else 0
+        cursor = max(0, min(cursor, len(checklists) - 1))
 
-    if not checklists:
-        bubbles.append({
-            "type": "bubble",
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [{"type": "text", "text": "チェックリストがありません", "weight": "bold"}]
+    def build():
+        bubbles = []
+
+        if not checklists:
+            bubbles.append({
+                "type": "bubble",
+                "body": {
+                    "type": "box",
+                    "layout": "vertical",
+                    "contents": [{"type": "text", "text": "チェックリストがありません", "weight": "bold"}]
+                }
+            })
+        else:
+            def build_bubble(i):
+                return build_check_bubble(i, checklists[i], opened, show_delete, show_reorder,
+                                          item_cursor if i == opened else 0, opened_ref)
+
+            start = cursor
+            page, end = take_rows(len(checklists), build_bubble, start,
+                                  FLEX_CAROUSEL_MAX_BYTES - FLEX_NAV_RESERVE, limit=CHECK_PAGE_LISTS)
+            if start <= opened and end <= opened:
+                # 大きくてページからはみ出した → 開いてるリストから並べ直す
+                start = opened
+                page, end = take_rows(len(checklists), build_bubble, start,
+                                      FLEX_CAROUSEL_MAX_BYTES - FLEX_NAV_RESERVE, limit=CHECK_PAGE_LISTS)
+            for bubble in page:
+                bubbles += bubble
+
+            if start > 0 or end < len(checklists):
+                prev = take_rows(len(checklists), build_bubble, start, FLEX_CAROUSEL_MAX_BYTES - FLEX_NAV_RESERVE,
+                                 limit=CHECK_PAGE_LISTS, step=-1)[1] if start else 0
+                nav = page_nav(f"#check_page_{opened_ref}_{{}}", start, end, len(checklists), prev)
+                bubbles.append({
+                    "type": "bubble",
+                    "size": "micro",
+                    "body": {"type": "box", "layout": "vertical", "contents": [nav]}
+                })
+
+        return {
+            "type": "flex",
+            "altText": "チェックリスト",
+            "contents": {
+                "type": "carousel",
+                "contents": bubbles
             }
-        })
-    else:
-        for c_idx, checklist in enumerate(checklists):
-            is_open = (opened == c_idx)
-            arrow = "▲" if is_open else "▼"
+        }
+
+    key = flex_state_key(tasks, user_id, opened, cursor, item_cursor, show_delete, show_reorder)
+    send_flex(reply_token, render_flex("checklist", key, build))
+
+def build_check_bubble(c_idx, checklist, opened, show_delete, show_reorder, item_cursor=0, opened_ref="-1"):
+    """
+    チェックリスト1つ分の bubble（take_rows で数えられるように [bubble] で返す）
+    opened: 開いてるリストの位置 / opened_ref: postback に入れるその ID
+    """
+    is_open = (opened == c_idx)
+    arrow = "▲" if is_open else "▼"
+    c_ref = item_ref(checklist, c_idx)
+
+    items = checklist.get("items", [])
+    total = len(items)
+    done_count = sum(1 for i in items if i.get("done"))
+
+    def build_item(i_idx):
+        item = items[i_idx]
+        i_ref = item_ref(item, i_idx)
+        is_done = bool(item.get("done"))
+        text = item.get("text", "")
+
+        # 完了なら薄く＋取り消し線
+        text_color = "#94A3B8" if is_done else "#111111"
+        decoration = "line-through" if is_done else "none"
+        mark = "☑" if is_done else "⬜"
+
+        row_contents = [
+            # 左：表示（取り消し線OKな text）
+            {
+                "type": "text",
+                "text": f"{mark} {text}",
+                "wrap": True,
+                "flex": 7,
+                "color": text_color,
+                "decoration": decoration,
+                "size": "sm"
+            },
+            # 右：切替ボタン（done トグル）
+            {
+                "type": "button",
+                "flex": 2,
+                "style": "secondary",
+                "height": "sm",
+                "action": {
+                    "type": "postback",
+                    "label": "切替",
+                    "data": f"#toggle_check_{c_ref}_{i_ref}_{opened_ref}"
+                }
+            }
+        ]
 
-            items = checklist.get("items", [])
-            total = len(items)
-            done_count = sum(1 for i in items if i.get("done"))
+        # 削除モードONの時だけ、項目削除ボタン
+        if show_delete:
+            row_contents.append({
+                "type": "button",
+                "flex": 1,
+                "style": "secondary",
+                "height": "sm",
+                "action": {
+                    "type": "postback",
+                    "label": "🗑",
+                    "data": f"#delete_item_{c_ref}_{i_ref}_{opened_ref}"
+                }
+            })
 
-            contents = []
+        parts = [{
+            "type": "box",
+            "layout": "horizontal",
+            "margin": "sm",
+            "spacing": "sm",
+            "contents": row_contents
+        }]
 
-            # -------------------------
-            # タイトル行（開閉 + ゴミ箱）
-            # -------------------------
-            if show_delete:
-                contents.append({
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {
-                            "type": "button",
-                            "flex": 4,
-                            "style": "primary",
-                            "action": {
-                                "type": "postback",
-                                "label": f"{arrow} {checklist.get('title','(no title)')}",
-                                "data": f"#toggle_list_{c_idx}_{opened}"
-                            }
-                        },
-                        {
-                            "type": "button",
-                            "flex": 1,
-                            "style": "secondary",
-                            "action": {
-                                "type": "postback",
-                                "label": "🗑",
-                                "data": f"#delete_check_{c_idx}_{opened}"
-                            }
+        # 並び替えモードONの時だけ、↑↓
+        if show_reorder:
+            parts.append({
+                "type": "box",
+                "layout": "horizontal",
+                "spacing": "sm",
+                "margin": "xs",
+                "contents": [
+                    {
+                        "type": "button",
+                        "flex": 1,
+                        "style": "secondary",
+                        "height": "sm",
+                        "action": {
+                            "type": "postback",
+                            "label": "↑",
+                            "data": f"#move_item_{c_ref}_{i_ref}_up_{opened_ref}"
                         }
-                    ]
-                })
-            else:
-                contents.append({
+                    },
+                    {
+                        "type": "button",
+                        "flex": 1,
+                        "style": "secondary",
+                        "height": "sm",
+                        "action": {
+                            "type": "postback",
+                            "label": "↓",
+                            "data": f"#move_item_{c_ref}_{i_ref}_down_{opened_ref}"
+                        }
+                    }
+                ]
+            })
+        return parts
+
+    contents = []
+
+    # -------------------------
+    # タイトル行（開閉 + ゴミ箱）
+    # -------------------------
+    if show_delete:
+        contents.append({
+            "type": "box",
+            "layout": "horizontal",
+            "contents": [
+                {
                     "type": "button",
+                    "flex": 4,
                     "style": "primary",
                     "action": {
                         "type": "postback",
                         "label": f"{arrow} {checklist.get('title','(no title)')}",
-                        "data": f"#toggle_list_{c_idx}_{opened}"
+                        "data": f"#toggle_list_{c_ref}_{opened_ref}"
                     }
-                })
-
-            # 進捗
-            contents.append({
-                "type": "text",
-                "text": f"進捗: {done_count}/{total}",
-                "size": "sm",
-                "color": "#888888",
-                "margin": "sm"
-            })
-
-            # =========================
-            # ✅ 開いている時の中身
-            # =========================
-            if is_open:
-                if not items:
-                    contents.append({
-                        "type": "text",
-                        "text": "項目がありません（追加してね）",
-                        "size": "sm",
-                        "color": "#999999",
-                        "margin": "md"
-                    })
-                else:
-                    for i_idx, item in enumerate(items):
-                        is_done = bool(item.get("done"))
-                        text = item.get("text", "")
-
-                        # 完了なら薄く＋取り消し線
-                        text_color = "#94A3B8" if is_done else "#111111"
-                        decoration = "line-through" if is_done else "none"
-                        mark = "☑" if is_done else "⬜"
-
-                        row_contents = [
-                            # 左：表示（取り消し線OKな text）
-                            {
-                                "type": "text",
-                                "text": f"{mark} {text}",
-                                "wrap": True,
-                                "flex": 7,
-                                "color": text_color,
-                                "decoration": decoration,
-                                "size": "sm"
-                            },
-                            # 右：切替ボタン（done トグル）
-                            {
-                                "type": "button",
-                                "flex": 2,
-                                "style": "secondary",
-                                "height": "sm",
-                                "action": {
-                                    "type": "postback",
-                                    "label": "切替",
-                                    "data": f"#toggle_check_{c_idx}_{i_idx}_{opened}"
-                                }
-                            }
-                        ]
-
-                        # 削除モードONの時だけ、項目削除ボタン
-                        if show_delete:
-                            row_contents.append({
-                                "type": "button",
-                                "flex": 1,
-                                "style": "secondary",
-                                "height": "sm",
-                                "action": {
-                                    "type": "postback",
-                                    "label": "🗑",
-                                    "data": f"#delete_item_{c_idx}_{i_idx}_{opened}"
-                                }
-                            })
-
-                        contents.append({
-                            "type": "box",
-                            "layout": "horizontal",
-                            "margin": "sm",
-                            "spacing": "sm",
-                            "contents": row_contents
-                        })
-
-                        # 並び替えモードONの時だけ、↑↓
-                        if show_reorder:
-                            contents.append({
-                                "type": "box",
-                                "layout": "horizontal",
-                                "spacing": "sm",
-                                "margin": "xs",
-                                "contents": [
-                                    {
-                                        "type": "button",
-                                        "flex": 1,
-                                        "style": "secondary",
-                                        "height": "sm",
-                                        "action": {
-                                            "type": "postback",
-                                            "label": "↑",
-                                            "data": f"#move_item_{c_idx}_{i_idx}_up_{opened}"
-                                        }
-                                    },
-                                    {
-                                        "type": "button",
-                                        "flex": 1,
-                                        "style": "secondary",
-                                        "height": "sm",
-                                        "action": {
-                                            "type": "postback",
-                                            "label": "↓",
-                                            "data": f"#move_item_{c_idx}_{i_idx}_down_{opened}"
-                                        }
-                                    }
-                                ]
-                            })
-
-                # ✅ 開いてるリストの一番下に「➕ 項目を追加」
-                contents.append({
+                },
+                {
                     "type": "button",
-                    "style": "primary",
-                    "margin": "lg",
+                    "flex": 1,
+                    "style": "secondary",
                     "action": {
                         "type": "postback",
-                        "label": "➕ 項目を追加",
-                        "data": f"#add_item_{c_idx}_{opened}"
+                        "label": "🗑",
+                        "data": f"#delete_check_{c_ref}_{opened_ref}"
                     }
-                })
-
-                # ✅ リスト丸ごと削除は削除モードONの時だけ
-                if show_delete:
-                    contents.append({
-                        "type": "button",
-                        "style": "secondary",
-                        "margin": "lg",
-                        "action": {
-                            "type": "postback",
-                            "label": "🗑 このリストを削除",
-                            "data": f"#delete_check_{c_idx}_{opened}"
-                        }
-                    })
+                }
+            ]
+        })
+    else:
+        contents.append({
+            "type": "button",
+            "style": "primary",
+            "action": {
+                "type": "postback",
+                "label": f"{arrow} {checklist.get('title','(no title)')}",
+                "data": f"#toggle_list_{c_ref}_{opened_ref}"
+            }
+        })
 
-            # =========================
-            # ✅ 閉じている時の表示
-            # =========================
-            else:
-                contents.append({
-                    "type": "text",
-                    "text": "タップで開く",
-                    "size": "sm",
-                    "color": "#999999",
-                    "margin": "md"
-                })
+    # 進捗
+    contents.append({
+        "type": "text",
+        "text": f"進捗: {done_count}/{total}",
+        "size": "sm",
+        "color": "#888888",
+        "margin": "sm"
+    })
 
-            bubbles.append({
-                "type": "bubble",
-                "body": {"type": "box", "layout": "vertical", "contents": contents}
+    # =========================
+    # ✅ 開いている時の中身
+    # =========================
+    if is_open:
+        if not items:
+            contents.append({
+                "type": "text",
+                "text": "項目がありません（追加してね）",
+                "size": "sm",
+                "color": "#999999",
+                "margin": "md"
             })
+        else:
+            rows, start, end, prev = page_bounds(len(items), build_item, item_cursor,
+                                               FLEX_BUBBLE_MAX_BYTES - FLEX_NAV_RESERVE)
+            for row in rows:
+                contents += row
+            nav = page_nav(f"#check_items_{c_ref}_{{}}", start, end, len(items), prev)
+            if nav:
+                contents.append(nav)
+
+        # ✅ 開いてるリストの一番下に「➕ 項目を追加」
+        contents.append({
+            "type": "button",
+            "style": "primary",
+            "margin": "lg",
+            "action": {
+                "type": "postback",
+                "label": "➕ 項目を追加",
+                "data": f"#add_item_{c_ref}_{opened_ref}"
+            }
+        })
 
-    flex = {
-        "type": "flex",
-        "altText": "チェックリスト",
-        "contents": {
-            "type": "carousel",
-            "contents": bubbles[:10]
-        }
-    }
-
-    send_flex(reply_token, flex)
+        # ✅ リスト丸ごと削除は削除モードONの時だけ
+        if show_delete:
+            contents.append({
+                "type": "button",
+                "style": "secondary",
+                "margin": "lg",
+                "action": {
+                    "type": "postback",
+                    "label": "🗑 このリストを削除",
+                    "data": f"#delete_check_{c_ref}_{opened_ref}"
+                }
+            })
 
-def handle_toggle_list(reply_token, user_id, data):
-    # data: #toggle_list_{c_idx}_{opened}
-    _, _, c_idx, opened = data.split("_")
-    c_idx = int(c_idx)
-    opened = int(opened)
+    # =========================
+    # ✅ 閉じている時の表示
+    # =========================
+    else:
+        contents.append({
+            "type": "text",
+            "text": "タップで開く",
+            "size": "sm",
+            "color": "#999999",
+            "margin": "md"
+        })
 
-    next_opened = -1 if opened == c_idx else c_idx
+    return [{
+        "type": "bubble",
+        "body": {"type": "box", "layout": "vertical", "contents": contents}
+    }]
+
+def find_checklist(tasks, user_id, ref):
+    """チェックリストの ref → 位置（無ければ None）"""
+    return find_item(tasks, ("checklists", user_id), tasks.get("checklists", {}).get(user_id, []), ref)
+
+def find_checklist_item(tasks, user_id, c_idx, ref):
+    """c_idx 番目のチェックリストの中の項目の ref → 位置（無ければ None）"""
+    checklist = tasks["checklists"][user_id][c_idx]
+    return find_item(tasks, ("checklist_items", user_id, checklist.get("id")), checklist.get("items", []), ref)
+
+def handle_toggle_list(reply_token, user_id, c_ref, opened):
+    # #toggle_list_{c}_{opened}
+    tasks = load_tasks(user_id)
+    c_idx = find_checklist(tasks, user_id, c_ref)
+    opened = find_checklist(tasks, user_id, opened)
+    next_opened = -1 if c_idx is None or opened == c_idx else c_idx
     handle_list_check(reply_token, user_id, next_opened)
 
 
-def handle_toggle_check(reply_token, user_id, data):
-    # data: #toggle_check_{c_idx}_{i_idx}_{opened}
-    tasks = load_tasks()
-    _, _, c_idx, i_idx, opened = data.split("_")
-    c_idx = int(c_idx)
-    i_idx = int(i_idx)
-    opened = int(opened)
+def handle_toggle_check(reply_token, user_id, c_ref, i_ref, opened):
+    # #toggle_check_{c}_{i}_{opened}
+    tasks = load_tasks(user_id)
 
-    checklists = tasks.get("checklists", {}).get(user_id, [])
-    if 0 <= c_idx < len(checklists):
-        items = checklists[c_idx].get("items", [])
-        if 0 <= i_idx < len(items):
+    c_idx = find_checklist(tasks, user_id, c_ref)
+    if c_idx is not None:
+        items = tasks["checklists"][user_id][c_idx].get("items", [])
+        i_idx = find_checklist_item(tasks, user_id, c_idx, i_ref)
+        if i_idx is not None:
             items[i_idx]["done"] = not items[i_idx].get("done", False)
             save_tasks(tasks)
 
     # 開いたまま再表示
-    handle_list_check(reply_token, user_id, c_idx)
+    handle_list_check(reply_token, user_id, -1 if c_idx is None else c_idx)
     
-def handle_add_item_start(reply_token, user_id, data):
-    # data: #add_item_{c_idx}_{opened}
-    parts = data.split("_")
-    c_idx = int(parts[2])
-    opened = int(parts[3])
-
-    tasks = load_tasks()
-    set_persisted_state(tasks, user_id, f"add_check_item:{c_idx}:{opened}")
+def handle_add_item_start(reply_token, user_id, c_ref, opened):
+    # #add_item_{c}_{opened}
+    tasks = load_tasks(user_id)
+    set_persisted_state(tasks, user_id, f"add_check_item:{c_ref}:{opened}")
     save_tasks(tasks)
 
     send_reply(reply_token, "追加する項目を送ってね（キャンセルは「キャンセル」）")
 
-def handle_delete_item(reply_token, user_id, data):
-    # data: #delete_item_{c_idx}_{i_idx}_{opened}
-    tasks = load_tasks()
-    _, _, c_idx, i_idx, opened = data.split("_")
-    c_idx = int(c_idx)
-    i_idx = int(i_idx)
-    opened = int(opened)
+def handle_delete_item(reply_token, user_id, c_ref, i_ref, opened):
+    # #delete_item_{c}_{i}_{opened}
+    tasks = load_tasks(user_id)
 
-    checklists = tasks.get("checklists", {}).get(user_id, [])
-    if 0 <= c_idx < len(checklists):
-        items = checklists[c_idx].get("items", [])
-        if 0 <= i_idx < len(items):
+    c_idx = find_checklist(tasks, user_id, c_ref)
+    if c_idx is not None:
+        items = tasks["checklists"][user_id][c_idx].get("items", [])
+        i_idx = find_checklist_item(tasks, user_id, c_idx, i_ref)
+        if i_idx is not None:
             items.pop(i_idx)
             save_tasks(tasks)
 
-    handle_list_check(reply_token, user_id, c_idx)
+    handle_list_check(reply_token, user_id, -1 if c_idx is None else c_idx)
 
 
-def handle_delete_check(reply_token, user_id, data):
-    # data: #delete_check_{c_idx}_{opened}
-    tasks = load_tasks()
-    _, _, c_idx, opened = data.split("_")
-    c_idx = int(c_idx)
-    opened = int(opened)
+def handle_delete_check(reply_token, user_id, c_ref, opened):
+    # #delete_check_{c}_{opened}
+    tasks = load_tasks(user_id)
 
     checklists = tasks.get("checklists", {}).get(user_id, [])
-    if 0 <= c_idx < len(checklists):
+    c_idx = find_checklist(tasks, user_id, c_ref)
+    opened = find_checklist(tasks, user_id, opened)
+    if opened is None:
+        opened = -1
+    if c_idx is not None:
         checklists.pop(c_idx)
         save_tasks(tasks)
 
-    # 削除後に open index を補正
-    if opened == c_idx:
-        opened = -1
-    elif opened > c_idx:
-        opened = opened - 1
+        # 削除後に open index を補正
+        if opened == c_idx:
+            opened = -1
+        elif opened > c_idx:
+            opened = opened - 1
 
     handle_list_check(reply_token, user_id, opened)
 
 
-def handle_move_item(reply_token, user_id, data):
-    # data: #move_item_{c_idx}_{i_idx}_{dir}_{opened}
-    tasks = load_tasks()
-    _, _, c_idx, i_idx, direction, opened = data.split("_")
-    c_idx = int(c_idx)
-    i_idx = int(i_idx)
-    opened = int(opened)
+def handle_move_item(reply_token, user_id, c_ref, i_ref, direction, opened):
+    # #move_item_{c}_{i}_{dir}_{opened}
+    tasks = load_tasks(user_id)
 
-    checklists = tasks.get("checklists", {}).get(user_id, [])
-    if not (0 <= c_idx < len(checklists)):
+    c_idx = find_checklist(tasks, user_id, c_ref)
+    if c_idx is None:
         handle_list_check(reply_token, user_id, opened)
         return
 
-    items = checklists[c_idx].get("items", [])
-    if not (0 <= i_idx < len(items)):
+    items = tasks["checklists"][user_id][c_idx].get("items", [])
+    i_idx = find_checklist_item(tasks, user_id, c_idx, i_ref)
+    if i_idx is None:
         handle_list_check(reply_token, user_id, opened)
         return
 
@@ -1545,25 +4840,30 @@ def handle_move_item(reply_token, user_id, data):
     # 並び替え後もそのリストを開いて表示
     handle_list_check(reply_token, user_id, c_idx)
     
-def handle_board_delete(reply_token, user_id, data, source_type=None, group_id=None):
-    # data: #board_delete_{i}
-    idx = int(data.split("_")[-1])
-    tasks = load_tasks()
+def _board_key(source_type, user_id, group_id):
+    if source_type == "group" and group_id:
+        return ("board_groups", group_id)
+    return ("board_users", user_id)
+
+def handle_board_delete(reply_token, user_id, ref, source_type=None, group_id=None):
+    # #board_delete_{id}
+    tasks = load_tasks(user_id, group_id)
     items = _get_board_list(tasks, source_type, user_id, group_id)
-    if 0 <= idx < len(items):
+    idx = find_item(tasks, _board_key(source_type, user_id, group_id), items, ref)
+    if idx is not None:
         items.pop(idx)
         save_tasks(tasks)
     handle_board_list(reply_token, user_id, source_type, group_id)
 
-def handle_board_move(reply_token, user_id, data, source_type=None, group_id=None):
-    # data: #board_move_{i}_up/down
-    parts = data.split("_")
-    idx = int(parts[2])
-    direction = parts[3]
-    tasks = load_tasks()
+def handle_board_move(reply_token, user_id, ref, direction, source_type=None, group_id=None):
+    # #board_move_{id}_up/down
+    tasks = load_tasks(user_id, group_id)
     items = _get_board_list(tasks, source_type, user_id, group_id)
+    idx = find_item(tasks, _board_key(source_type, user_id, group_id), items, ref)
 
-    if direction == "up" and idx > 0:
+    if idx is None:
+        pass
+    elif direction == "up" and idx > 0:
         items[idx-1], items[idx] = items[idx], items[idx-1]
         save_tasks(tasks)
     elif direction == "down" and idx < len(items)-1:
@@ -1632,227 +4932,828 @@ def clear_persisted_state(tasks, user_id: str):
     tasks["settings"].setdefault(user_id, {})
     tasks["settings"][user_id].pop("_state", None)
 
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    body = request.get_json(silent=True) or {}
-    print("=== HIT ===")
+# =========================
+# postback のルーティング（完全一致は dict、前方一致は trie で1回引くだけ）
+# =========================
+
+Postback = namedtuple("Postback", "reply_token user_id source_type group_id data")
+
+class Route:
+    def __init__(self, name, fn, params=(), defaults=None):
+        self.name = name
+        self.fn = fn
+        self.params = params     # [(名前, 型), ...]（前方一致の残りを "_" で区切った順）
+        self.defaults = defaults or {}   # 後ろの引数が無いときの値（引数を足す前に送ったボタンの data 用）
+
+    def parse(self, parts):
+        """["k3x9f2ab", "2", "30"] -> {"c": "k3x9f2ab", "i": "2", "cursor": 30}。形が合わなければ None"""
+        n = len(self.params)
+        if len(parts) > n:
+            # 最後の引数は残り全部（"_" を含んでもよい）
+            parts = parts[:n - 1] + ["_".join(parts[n - 1:])]
+        missing = self.params[len(parts):]
+        if not parts or any(name not in self.defaults for name, _typ in missing):
+            return None
+        try:
+            args = {name: typ(part) for (name, typ), part in zip(self.params, parts)}
+        except ValueError:
+            return None
+        for name, _typ in missing:
+            args[name] = self.defaults[name]
+        return args
+
+class PostbackRouter:
+    """
+    @router.route("#board_list") は完全一致、
+    @router.route("#toggle_check_", c=str, i=str, opened=str) は前方一致＋引数。
+    defaults={"cursor": 0} を渡すと、後ろの引数が無い data（前に送ったボタン）もその値で受ける。
+    前方一致のパターンは "_" で終わる前提で、"_" 区切りの単位で trie にする。
+    一番長く一致したものを使う（登録順に依存しない）。
+    """
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}          # "_" 区切りの1語ごとの dict。ルートは None キーに入れる
+        self.routes = []
+
+    def route(self, pattern, defaults=None, **params):
+        def register(fn):
+            route = Route(pattern, fn, tuple(params.items()), defaults)
+            if params:
+                assert pattern.endswith("_"), pattern
+                node = self.trie
+                for word in pattern[:-1].split("_"):
+                    node = node.setdefault(word, {})
+                node[None] = route
+            else:
+                self.exact[pattern] = route
+            self.routes.append(route)
+            return fn
+        return register
+
+    def resolve(self, data):
+        """return: (Route, 引数の dict) / 見つからなければ (None, None)"""
+        route = self.exact.get(data)
+        if route is not None:
+            return route, {}
+
+        words = data.split("_")
+        node, found, found_at = self.trie, None, 0
+        for i in range(len(words) - 1):
+            node = node.get(words[i])
+            if node is None:
+                break
+            if None in node:
+                found, found_at = node[None], i + 1
+        if found is None:
+            return None, None
+        args = found.parse(words[found_at:])
+        if args is None:
+            return None, None
+        return found, args
+
+    def dispatch(self, pb):
+        """処理時間・エラーはルートごとに process_event が metrics に数える"""
+        route, args = self.resolve(pb.data)
+        if route is None:
+            return False
+        route.fn(pb, **args)
+        return True
 
-    for event in body.get("events", []):
-        reply_token = event.get("replyToken")
+router = PostbackRouter()
+route = router.route
 
-        try:
-            source = event.get("source", {}) or {}
-            source_type = source.get("type")
-            user_id = source.get("userId")
-            group_id = source.get("groupId") if source_type == "group" else None
-
-            if event.get("type") == "postback":
-                data = event.get("postback", {}).get("data", "") or ""
-
-                # --- リッチメニュー：予定表 ---
-                if data == "scope=menu&action=list":
-                    tasks = load_tasks()
-                    personal = [t for t in tasks["users"].get(user_id, []) if t.get("status") != "done"]
-                    
-                    global_tasks, sid = get_space_global_tasks(tasks, user_id)
-                    
-                    if not sid:
-                        send_reply(reply_token, "🗝 まだ集会所が未選択だよ。\n「その他」→「合言葉で集会所に参加」から入ってね")
-                        return
-                        
-                    send_schedule(reply_token, personal, global_tasks, user_id=user_id)
-                
-                # --- リッチメニュー：チェックリスト一覧 ---
-                elif data == "scope=menu&action=check":
-                    handle_list_check(reply_token, user_id, -1)
+def event_route(event):
+    """
+    統計用のルート名。postback は登録したパターン（引数を落とした形）
+    例: "#toggle_check_0_1_-1" -> "#toggle_check_"
+    """
+    if event.get("type") != "postback":
+        return event.get("type") or "unknown"
+    data = event.get("postback", {}).get("data", "") or ""
+    r, _ = router.resolve(data)
+    return r.name if r is not None else "unknown"
+
+# --- リッチメニュー：予定表 ---
+@route("scope=menu&action=list")
+def _route_schedule(pb):
+    handle_schedule_list(pb.reply_token, pb.user_id, pb.group_id)
+
+@route("#schedule_page_", cursor=int)
+def _route_schedule_page(pb, cursor):
+    handle_schedule_list(pb.reply_token, pb.user_id, pb.group_id, cursor=max(0, cursor))
+
+# --- リッチメニュー：チェックリスト一覧 ---
+@route("scope=menu&action=check")
+def _route_check(pb):
+    handle_list_check(pb.reply_token, pb.user_id, -1)
+
+@route("#check_page_", opened=str, cursor=int)
+def _route_check_page(pb, opened, cursor):
+    handle_list_check(pb.reply_token, pb.user_id, opened, cursor=max(0, cursor))
+
+@route("#check_items_", c=str, item_cursor=int)
+def _route_check_items(pb, c, item_cursor):
+    handle_list_check(pb.reply_token, pb.user_id, c, item_cursor=max(0, item_cursor))
+
+@route("#toggle_list_", c=str, opened=str)
+def _route_toggle_list(pb, c, opened):
+    handle_toggle_list(pb.reply_token, pb.user_id, c, opened)
+
+@route("#toggle_check_", c=str, i=str, opened=str)
+def _route_toggle_check(pb, c, i, opened):
+    handle_toggle_check(pb.reply_token, pb.user_id, c, i, opened)
+
+@route("#delete_item_", c=str, i=str, opened=str)
+def _route_delete_item(pb, c, i, opened):
+    handle_delete_item(pb.reply_token, pb.user_id, c, i, opened)
+
+@route("#delete_check_", c=str, opened=str)
+def _route_delete_check(pb, c, opened):
+    handle_delete_check(pb.reply_token, pb.user_id, c, opened)
+
+@route("#move_item_", c=str, i=str, direction=str, opened=str)
+def _route_move_item(pb, c, i, direction, opened):
+    handle_move_item(pb.reply_token, pb.user_id, c, i, direction, opened)
+
+# --- リッチメニュー：追加 ---
+@route("scope=menu&action=add")
+def _route_menu_add(pb):
+    if pb.source_type == "group":
+        # グループでは個人予定を push で聞く特例
+        push_message = {"type": "text", "text": "📅 個人予定を追加するよ。予定を書いてね。"}
+        user_states[pb.user_id] = "add_personal"
+        send_push(pb.user_id, push_message, fallback_reply_token=pb.reply_token)
+    else:
+        handle_menu_add(pb.reply_token, pb.user_id)
+
+# --- その他メニュー ---
+@route("scope=menu&action=other")
+@route("other")
+def _route_other_menu(pb):
+    handle_other_menu(pb.reply_token, pb.user_id, pb.source_type, pb.group_id)
+
+# --- 伝言板 ---
+@route("#board_list")
+def _route_board_list(pb):
+    handle_board_list(pb.reply_token, pb.user_id, pb.source_type, pb.group_id)
+
+@route("#board_page_", cursor=int)
+def _route_board_page(pb, cursor):
+    handle_board_list(pb.reply_token, pb.user_id, pb.source_type, pb.group_id, cursor=max(0, cursor))
+
+@route("#board_add")
+def _route_board_add(pb):
+    if pb.source_type == "group" and pb.group_id:
+        user_states[pb.user_id] = f"board_add_group:{pb.group_id}"
+        send_reply(pb.reply_token, f"➕ {BOARD_TITLE}に入れる内容を送ってね（グループ共有）")
+    else:
+        user_states[pb.user_id] = "board_add_user"
+        send_reply(pb.reply_token, f"➕ {BOARD_TITLE}に入れる内容を送ってね")
+
+@route("#board_toggle_delete")
+def _route_board_toggle_delete(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    toggle_board_ui_flag(tasks, pb.user_id, "show_delete")
+    save_tasks(tasks)
+    handle_other_menu(pb.reply_token, pb.user_id, pb.source_type, pb.group_id)
+
+@route("#board_toggle_reorder")
+def _route_board_toggle_reorder(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    toggle_board_ui_flag(tasks, pb.user_id, "show_reorder")
+    save_tasks(tasks)
+    handle_other_menu(pb.reply_token, pb.user_id, pb.source_type, pb.group_id)
+
+@route("#board_toggle_ops")
+def _route_board_toggle_ops(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    ui = get_board_ui_flags(tasks, pb.user_id)
+    ui["show_ops"] = not ui.get("show_ops", False)
+    save_tasks(tasks)
+    handle_other_menu(pb.reply_token, pb.user_id, pb.source_type, pb.group_id)
+
+@route("#board_delete_", ref=str)
+def _route_board_delete(pb, ref):
+    handle_board_delete(pb.reply_token, pb.user_id, ref, pb.source_type, pb.group_id)
+
+@route("#board_move_", ref=str, direction=str)
+def _route_board_move(pb, ref, direction):
+    handle_board_move(pb.reply_token, pb.user_id, ref, direction, pb.source_type, pb.group_id)
+
+# --- 集会所 ---
+@route("#space_join")
+def _route_space_join(pb):
+    user_states[pb.user_id] = "space_join_wait_pass"
+    send_reply(pb.reply_token, "🗝 合言葉を送ってね")
+
+@route("#space_list")
+def _route_space_list(pb):
+    handle_space_list(pb.reply_token, pb.user_id)
+
+@route("#space_page_", cursor=int)
+def _route_space_page(pb, cursor):
+    handle_space_list(pb.reply_token, pb.user_id, cursor=max(0, cursor))
+
+@route("#space_set_", sid=str)
+def _route_space_set(pb, sid):
+    handle_space_set(pb.reply_token, pb.user_id, sid)
+
+@route("#space_leave_", sid=str)
+def _route_space_leave(pb, sid):
+    handle_space_leave(pb.reply_token, pb.user_id, sid)
+
+# ★追加メニュー側の「全体予定追加」＝その他と同じ機能に統一
+@route("#other_add_global")
+@route("#add_global")
+def _route_add_global(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    sid = get_active_space_id(tasks, pb.user_id)
+    if not sid:
+        send_reply(pb.reply_token, "🗝 先に集会所へ参加してね（その他→合言葉で参加）")
+    else:
+        user_states[pb.user_id] = f"space_add_global:{sid}"
+        send_reply(pb.reply_token, "🌍 全体予定を書いてね（この集会所に追加されるよ）")
+
+# ====== 予定（schedule）系 ======
+@route("#space_done_", ref=str, cursor=int, defaults={"cursor": 0})
+def _route_space_done(pb, ref, cursor):
+    handle_space_done(pb.reply_token, pb.user_id, ref, cursor=cursor)
+
+@route("#space_delete_", ref=str, cursor=int, defaults={"cursor": 0})
+def _route_space_delete(pb, ref, cursor):
+    handle_space_delete(pb.reply_token, pb.user_id, ref, cursor=cursor)
+
+@route("#list_undo_", scope=str, ref=str)
+def _route_list_undo(pb, scope, ref):
+    handle_undo(pb.reply_token, pb.user_id, scope, ref, pb.group_id)
+
+@route("#show_done")
+def _route_show_done(pb):
+    handle_show_done(pb.reply_token, pb.user_id, pb.source_type, pb.group_id)
+
+@route("#done_delete_p_", ref=str)
+def _route_done_delete_personal(pb, ref):
+    handle_done_delete_personal(pb.reply_token, pb.user_id, ref)
+
+@route("#done_delete_s_", ref=str)
+def _route_done_delete_space(pb, ref):
+    handle_done_delete_space(pb.reply_token, pb.user_id, ref)
+
+@route("#add_personal")
+def _route_add_personal(pb):
+    user_states[pb.user_id] = "add_personal"
+    send_reply(pb.reply_token, "追加する予定を送ってね")
+
+@route("#list_done_", scope=str, ref=str, cursor=int, defaults={"cursor": 0})
+def _route_list_done(pb, scope, ref, cursor):
+    handle_done(pb.reply_token, pb.user_id, scope, ref, pb.source_type, pb.group_id, cursor=cursor)
+
+@route("#list_delete_", scope=str, ref=str, cursor=int, defaults={"cursor": 0})
+def _route_list_delete(pb, scope, ref, cursor):
+    handle_delete(pb.reply_token, pb.user_id, scope, ref, pb.source_type, pb.group_id, cursor=cursor)
+
+# ====== チェックリスト作成 ======
+@route("#add_check")
+def _route_add_check(pb):
+    user_states[pb.user_id] = "add_check_title"
+    send_reply(pb.reply_token, "📝 チェックリストのタイトルを送ってね")
+
+# ====== モード切替 ======
+@route("#toggle_delete_mode")
+def _route_toggle_delete_mode(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    toggle_check_ui_flag(tasks, pb.user_id, "show_delete")
+    save_tasks(tasks)
+    handle_menu_add(pb.reply_token, pb.user_id)
 
-                elif data.startswith("#toggle_list_"):
-                    handle_toggle_list(reply_token, user_id, data)
+@route("#toggle_reorder_mode")
+def _route_toggle_reorder_mode(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    toggle_check_ui_flag(tasks, pb.user_id, "show_reorder")
+    save_tasks(tasks)
+    handle_menu_add(pb.reply_token, pb.user_id)
 
-                elif data.startswith("#toggle_check_"):
-                    handle_toggle_check(reply_token, user_id, data)
+@route("#toggle_ops_menu")
+def _route_toggle_ops_menu(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    ui = get_check_ui_flags(tasks, pb.user_id)
+    ui["show_ops"] = not ui.get("show_ops", False)
+    save_tasks(tasks)
+    handle_menu_add(pb.reply_token, pb.user_id)
 
-                elif data.startswith("#delete_item_"):
-                    handle_delete_item(reply_token, user_id, data)
+@route("#toggle_schedule_delete_mode")
+def _route_toggle_schedule_delete_mode(pb):
+    tasks = load_tasks(pb.user_id, pb.group_id)
+    toggle_schedule_ui_flag(tasks, pb.user_id, "show_delete")
+    save_tasks(tasks)
+    handle_menu_add(pb.reply_token, pb.user_id)
+
+@route("#add_item_", c=str, opened=str)
+def _route_add_item(pb, c, opened):
+    handle_add_item_start(pb.reply_token, pb.user_id, c, opened)
+
+def handle_event(event):
+    """1イベント分の処理（process_event が UnitOfWork の中で呼ぶ）"""
+    reply_token = event.get("replyToken")
+
+    source = event.get("source", {}) or {}
+    source_type = source.get("type")
+    user_id = source.get("userId")
+    group_id = source.get("groupId") if source_type == "group" else None
+
+    if event.get("type") == "postback":
+        data = event.get("postback", {}).get("data", "") or ""
+        if not router.dispatch(Postback(reply_token, user_id, source_type, group_id, data)):
+            send_reply(reply_token, "未定義メニュー")
+
+    elif event.get("type") == "message":
+        text = event.get("message", {}).get("text", "")
+        handle_message(reply_token, user_id, text, source_type, group_id)
+
+def bench_router(n=200000):
+    """ルーター（dict + trie）と、前の if/elif と同じ順に startswith で探す場合の1回あたりの時間"""
+    samples = ["scope=menu&action=list", "#board_list", "#space_done_3", "#toggle_check_0_1_-1",
+               "#move_item_2_5_down_2", "#add_item_12_12", "#toggle_schedule_delete_mode",
+               "#toggle_check_k3x9f2ab_m2q7c4de_k3x9f2ab"]
+    table = [(r, r.name, bool(r.params)) for r in router.routes]
+
+    def linear(data):
+        for r, name, is_prefix in table:
+            if is_prefix and data.startswith(name):
+                return r, r.parse(data[len(name):].split("_"))
+            if data == name:
+                return r, {}
+
+    for data in samples:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            router.resolve(data)
+        t_router = (time.perf_counter() - t0) / n * 1e9
+        t0 = time.perf_counter()
+        for _ in range(n):
+            linear(data)
+        t_linear = (time.perf_counter() - t0) / n * 1e9
+        print(f"{data:32s} router {t_router:7.0f} ns   if/elif {t_linear:7.0f} ns")
+
+# =========================
+# 再送（isRedelivery）の重複処理防止：webhookEventId で1回だけ処理する
+# =========================
+
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", "86400"))          # 秒
+WEBHOOK_DEDUP_CACHE_SIZE = int(os.getenv("WEBHOOK_DEDUP_CACHE_SIZE", "10000"))
+WEBHOOK_DEDUP_PURGE_INTERVAL = 600   # 秒：期限切れの行を消す間隔
+
+# result: claimed（初めて）/ duplicate_memory・duplicate_db（再送を弾いた場所）/ released（失敗したので印を消した）
+metrics.define("linebot_webhook_dedup_total", "counter", "webhookEventId dedup checks, by result.")
+
+_dedup_cache = OrderedDict()   # event_id -> 期限（time.monotonic()）
+_dedup_lock = threading.Lock()
+
+def _dedup_count(key):
+    metrics.inc("linebot_webhook_dedup_total", (("result", key),))
+
+def _dedup_remember(event_id):
+    with _dedup_lock:
+        _dedup_cache[event_id] = time.monotonic() + WEBHOOK_DEDUP_TTL
+        _dedup_cache.move_to_end(event_id)
+        while len(_dedup_cache) > WEBHOOK_DEDUP_CACHE_SIZE:
+            _dedup_cache.popitem(last=False)
+
+def claim_webhook_event(event_id):
+    """
+    初めて見るイベントなら True（処理してよい）。処理済み・処理中なら False。
+    まずメモリ、無ければ webhook_events テーブルに INSERT して判定（別プロセスで処理した分も弾く）。
+    """
+    if not event_id:
+        return True
 
-                elif data.startswith("#delete_check_"):
-                    handle_delete_check(reply_token, user_id, data)
+    with _dedup_lock:
+        expires = _dedup_cache.get(event_id)
+        hit = expires is not None and expires > time.monotonic()
+    if hit:
+        _dedup_count("duplicate_memory")
+        return False
 
-                elif data.startswith("#move_item_"):
-                    handle_move_item(reply_token, user_id, data)
+    if not ensure_db_ready():
+        raise RuntimeError("DB_INIT_FAILED")
 
-                # --- リッチメニュー：追加（グループで個人予定をpushする特例）---
-                elif data == "scope=menu&action=add" and source_type == "group":
-                    push_message = {"type": "text", "text": "📅 個人予定を追加するよ。予定を書いてね。"}
-                    user_states[user_id] = "add_personal"
-                    send_push(user_id, push_message)
+    claimed = storage().claim_event(event_id)
 
-                # --- 通常：追加メニューを表示 ---
-                elif data == "scope=menu&action=add":
-                    handle_menu_add(reply_token, user_id)
+    _dedup_remember(event_id)
+    _dedup_count("claimed" if claimed else "duplicate_db")
+    return claimed
 
-                # --- その他メニュー ---
-                elif data in ("scope=menu&action=other", "other"):
-                    handle_other_menu(reply_token, user_id, source_type, group_id)
+def release_webhook_event(event_id):
+    """処理に失敗したイベントは印を消して、再送されたときにもう一度処理できるようにする"""
+    if not event_id:
+        return
+    with _dedup_lock:
+        _dedup_cache.pop(event_id, None)
+    try:
+        storage().release_event(event_id)
+        _dedup_count("released")
+    except Exception as e:
+        metrics.inc("linebot_errors_total", (("kind", "dedup_release"),))
+        log.error("release_webhook_event failed", extra={"error": repr(e)})
 
-                # --- 伝言板 ---
-                elif data == "#board_list":
-                    handle_board_list(reply_token, user_id, source_type, group_id)
+# ハンドラが例外で終わったときの返事（bench.py はこの返事の数を失敗として数える）
+DB_FALLBACK_TEXT = "⚠️ いま保存先（DB）が一時的に不調みたい。\n少し待ってからもう一度操作してね。"
 
-                elif data == "#board_add":
-                    if source_type == "group" and group_id:
-                        user_states[user_id] = f"board_add_group:{group_id}"
-                        send_reply(reply_token, f"➕ {BOARD_TITLE}に入れる内容を送ってね（グループ共有）")
-                    else:
-                        user_states[user_id] = "board_add_user"
-                        send_reply(reply_token, f"➕ {BOARD_TITLE}に入れる内容を送ってね")
+def process_event(event):
+    # トレース ID は LINE の webhookEventId（無ければ作る）
+    route = event_route(event)
+    user_id = (event.get("source", {}) or {}).get("userId")
+    with start_trace(event.get("webhookEventId"), route, user_id):
+        _process_event(event, route)
 
-                # --- 集会所参加（合言葉）---
-                elif data == "#space_join":
-                    user_states[user_id] = "space_join_wait_pass"
-                    send_reply(reply_token, "🗝 合言葉を送ってね")
-                
-                elif data == "#space_list":
-                    handle_space_list(reply_token, user_id)
-                    
-                elif data.startswith("#space_set_"):
-                    sid = data.replace("#space_set_", "", 1)
-                    handle_space_set(reply_token, user_id, sid)
-                    
-                elif data.startswith("#space_leave_"):
-                    sid = data.replace("#space_leave_", "", 1)
-                    handle_space_leave(reply_token, user_id, sid)
-
-                elif data == "#board_toggle_delete":
-                    tasks = load_tasks()
-                    toggle_board_ui_flag(tasks, user_id, "show_delete")
-                    save_tasks(tasks)
-                    handle_other_menu(reply_token, user_id, source_type, group_id)
-
-                elif data == "#board_toggle_reorder":
-                    tasks = load_tasks()
-                    toggle_board_ui_flag(tasks, user_id, "show_reorder")
-                    save_tasks(tasks)
-                    handle_other_menu(reply_token, user_id, source_type, group_id)
-
-                elif data.startswith("#board_delete_"):
-                    handle_board_delete(reply_token, user_id, data, source_type, group_id)
-
-                elif data.startswith("#board_move_"):
-                    handle_board_move(reply_token, user_id, data, source_type, group_id)
-                
-                elif data == "#other_add_global":
-                    tasks = load_tasks()
-                    sid = get_active_space_id(tasks, user_id)
-                    if not sid:
-                        send_reply(reply_token, "🗝 先に集会所へ参加してね（その他→合言葉で参加）")
-                        
-                    else:
-                        user_states[user_id] = f"space_add_global:{sid}"
-                        send_reply(reply_token, "🌍 全体予定を書いてね（この集会所に追加されるよ）")
-
-                # ====== 予定（schedule）系 ======
-                elif data.startswith("#space_done_"):
-                    handle_space_done(reply_token, user_id, data)
-                    
-                elif data.startswith("#space_delete_"):
-                    handle_space_delete(reply_token, user_id, data)
-                    
-                elif data.startswith("#list_undo_"):
-                    handle_undo(reply_token, user_id, data, group_id)
-
-                elif data == "#show_done":
-                    handle_show_done(reply_token, user_id, source_type, group_id)
-                
-                elif data.startswith("#done_delete_p_"):
-                    handle_done_delete_personal(reply_token, user_id, data)
-
-                elif data.startswith("#done_delete_s_"):
-                    handle_done_delete_space(reply_token, user_id, data)
-
-                elif data == "#add_personal":
-                    user_states[user_id] = "add_personal"
-                    send_reply(reply_token, "追加する予定を送ってね")
-                    
-                elif data.startswith("#list_done_"):
-                    handle_done(reply_token, user_id, data, source_type, group_id)
-                
-                elif data.startswith("#list_delete_"):
-                    handle_delete(reply_token, user_id, data, source_type, group_id)
-                    
-
-                # ====== チェックリスト作成 ======
-                elif data == "#add_check":
-                    user_states[user_id] = "add_check_title"
-                    send_reply(reply_token, "📝 チェックリストのタイトルを送ってね")
-
-                # ====== モード切替 ======
-                elif data == "#toggle_delete_mode":
-                    tasks = load_tasks()
-                    toggle_check_ui_flag(tasks, user_id, "show_delete")
-                    save_tasks(tasks)
-                    handle_menu_add(reply_token, user_id)
-
-                elif data == "#toggle_reorder_mode":
-                    tasks = load_tasks()
-                    toggle_check_ui_flag(tasks, user_id, "show_reorder")
-                    save_tasks(tasks)
-                    handle_menu_add(reply_token, user_id)
-                    
-                elif data == "#toggle_ops_menu":
-                    tasks = load_tasks()
-                    ui = get_check_ui_flags(tasks, user_id)
-                    ui["show_ops"] = not ui.get("show_ops", False)
-                    save_tasks(tasks)
-                    handle_menu_add(reply_token, user_id)
-                    
-                # ★追加メニュー側の「全体予定追加」＝その他と同じ機能に統一　
-                elif data == "#add_global":
-                    tasks = load_tasks()
-                    sid = get_active_space_id(tasks, user_id)
-                    if not sid:
-                        send_reply(reply_token, "🗝 先に集会所へ参加してね（その他→合言葉で参加）")
-                    else:
-                        user_states[user_id] = f"space_add_global:{sid}"
-                        send_reply(reply_token, "🌍 全体予定を書いてね（この集会所に追加されるよ）")
-                        
-                elif data == "#toggle_schedule_delete_mode":
-                    tasks = load_tasks()
-                    toggle_schedule_ui_flag(tasks, user_id, "show_delete")
-                    save_tasks(tasks)
-                    handle_menu_add(reply_token, user_id)
-                    
-                elif data == "#board_toggle_ops":
-                    tasks = load_tasks()
-                    ui = get_board_ui_flags(tasks, user_id)
-                    ui["show_ops"] = not ui.get("show_ops", False)
-                    save_tasks(tasks)
-                    handle_other_menu(reply_token, user_id, source_type, group_id)
-                    
-                elif data.startswith("#add_item_"):
-                    handle_add_item_start(reply_token, user_id, data)
+def _process_event(event, route):
+    reply_token = event.get("replyToken")
+    event_id = event.get("webhookEventId")
+    claimed = False
+    t0 = time.perf_counter()
 
-                else:
-                    send_reply(reply_token, "未定義メニュー")
+    try:
+        # 再送の重複はここで終わり（DB の state は読まない）
+        with span("dedup_claim"):
+            if not claim_webhook_event(event_id):
+                return
+        claimed = True
 
-            elif event.get("type") == "message":
-                text = event.get("message", {}).get("text", "")
-                handle_message(reply_token, user_id, text, source_type, group_id)
+        source = event.get("source", {}) or {}
+        user_id = source.get("userId")
+        group_id = source.get("groupId") if source.get("type") == "group" else None
 
-        except Exception as e:
-            print("❌ webhook handler error:", repr(e))
-            print(traceback.format_exc())
-            if reply_token:
-                send_reply(
-                    reply_token,
-                    "⚠️ いま保存先（DB）が一時的に不調みたい。\n少し待ってからもう一度操作してね。"
-                )
+        run_in_uow(lambda: handle_event(event), user_id, group_id, route=route)
+
+    except Exception as e:
+        if claimed:
+            release_webhook_event(event_id)
+        metrics.inc("linebot_errors_total", (("kind", "handler"),))
+        metrics.inc("linebot_route_errors_total", (("route", route),))
+        log.exception("webhook handler error")
+        if reply_token:
+            metrics.inc("linebot_db_fallback_replies_total")
+            send_reply(reply_token, DB_FALLBACK_TEXT)
+    finally:
+        if claimed:
+            metrics.observe("linebot_route_seconds", time.perf_counter() - t0, (("route", route),))
+
+def event_partition_key(event):
+    """同じキーのイベントは届いた順に処理する（ユーザー単位。userId が無ければグループ/ルーム）"""
+    source = event.get("source", {}) or {}
+    return source.get("userId") or source.get("groupId") or source.get("roomId") or ""
+
+# =========================
+# 1回の webhook に入っている複数イベント：ユーザーごとに分けて並列に処理
+# =========================
+
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+
+_batch_executor = None
+_batch_executor_pid = None
+_batch_executor_lock = threading.Lock()
+
+def batch_executor():
+    global _batch_executor, _batch_executor_pid
+    pid = os.getpid()
+    if _batch_executor is None or _batch_executor_pid != pid:
+        with _batch_executor_lock:
+            if _batch_executor is None or _batch_executor_pid != pid:
+                _batch_executor = ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS), thread_name_prefix="batch")
+                _batch_executor_pid = pid
+    return _batch_executor
+
+def _process_partition(events):
+    for event in events:
+        process_event(event)   # 例外はイベントごとに process_event の中で処理済み
+
+def process_events(events):
+    """
+    同じユーザー（パーティション）のイベントは順番通り、別ユーザー同士は並列に処理して、全部終わるまで待つ
+    """
+    partitions = {}
+    for event in events:
+        partitions.setdefault(event_partition_key(event), []).append(event)
+
+    if len(partitions) <= 1 or BATCH_WORKERS <= 1:
+        for part in partitions.values():
+            _process_partition(part)
+        return
+
+    futures = [batch_executor().submit(_process_partition, part) for part in partitions.values()]
+    for f in futures:
+        f.result()
+
+# =========================
+# 非同期モード：webhook はキューに積んですぐ 200 を返し、ワーカースレッドで処理する
+# =========================
+
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync")                   # "sync" | "async"
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "4"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "256"))         # 全ワーカー合計の上限
+EVENT_ENQUEUE_TIMEOUT = float(os.getenv("EVENT_ENQUEUE_TIMEOUT", "2"))  # 秒：満杯のとき待つ上限
 
+class EventDispatcher:
+    """
+    ワーカーごとにキューを持ち、パーティションキー（ユーザー）のハッシュで振り分ける。
+    同じユーザーのイベントは必ず同じワーカーに入るので、タップの順番は入れ替わらない。
+    キューが満杯なら EVENT_ENQUEUE_TIMEOUT まで待ち、それでも空かなければ1回の webhook の分を丸ごと断る
+    （呼び出し側が 503。一部だけ積んでおくと、LINE が全部を再送したときに積んだ分が2回目になるので）。
+    1つのキューに入りきらない数が同じキューに来たとき（1人が一度に大量に送ったなど）は、断っても同じ再送が来るだけなので、
+    そのキューが空くのを待ってから、入りきらない分はワーカーが取り出すのに合わせて順に積む。
+    """
+    def __init__(self, workers=EVENT_WORKERS, queue_size=EVENT_QUEUE_SIZE):
+        workers = max(1, workers)
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.capacity = sum(q.maxsize for q in self.queues)
+        self._admit_lock = threading.Lock()   # 積むのは1回に1つの webhook だけ（空きを確かめてから積むまでの間に埋まらないように）
+        self.threads = []
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"event-worker-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _queue_for(self, event):
+        return self.queues[zlib.crc32(event_partition_key(event).encode()) % len(self.queues)]
+
+    def submit_all(self, events, timeout=EVENT_ENQUEUE_TIMEOUT):
+        """全部積めるだけ空くのを timeout まで待って、全部積む。空かなければ1つも積まずに False"""
+        need = {}
+        for event in events:
+            q = self._queue_for(event)
+            need[q] = need.get(q, 0) + 1
+        deadline = time.monotonic() + timeout
+        if not self._admit_lock.acquire(timeout=max(0.0, timeout)):
+            metrics.inc("linebot_event_queue_rejected_total", value=len(events))
+            return False
+        try:
+            # 減らすのはワーカーだけなので、ここで空いていれば下の put は待たずに入る。
+            # 入りきらない数のキューは空になるまで待つ（あふれた分の put は、そのワーカーが前の分を取り出すのを待つだけ）
+            while any(q.maxsize - q.qsize() < min(n, q.maxsize) for q, n in need.items()):
+                if time.monotonic() >= deadline:
+                    metrics.inc("linebot_event_queue_rejected_total", value=len(events))
+                    return False
+                time.sleep(0.005)
+            oversized = sum(n - q.maxsize for q, n in need.items() if n > q.maxsize)
+            if oversized:
+                metrics.inc("linebot_event_queue_overflow_total", value=oversized)
+            now = time.perf_counter()
+            for event in events:
+                self._queue_for(event).put((now, event))
+        finally:
+            self._admit_lock.release()
+        metrics.inc("linebot_event_queue_enqueued_total", value=len(events))
+        return True
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    return
+                enqueued_at, event = item
+                metrics.observe("linebot_event_queue_wait_seconds", time.perf_counter() - enqueued_at)
+                process_event(event)
+            finally:
+                q.task_done()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def shutdown(self, timeout=None):
+        """積まれている分を処理し終えてから止める。timeout までに終わらなければ残りは諦める（daemon スレッド）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for q in self.queues:
+            try:
+                q.put(None, timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                log.warning("event queue still full at shutdown", extra={"dropped": q.qsize()})
+        for t in self.threads:
+            t.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+metrics.define("linebot_event_queue_depth", "gauge", "Events waiting in the async webhook queue.")
+metrics.define("linebot_event_queue_capacity", "gauge", "Async webhook queue size limit (503 when a batch does not fit).")
+metrics.define("linebot_event_queue_wait_seconds", "histogram", "Time an event waited in the queue before a worker took it.", SECONDS_BUCKETS)
+metrics.define("linebot_event_queue_enqueued_total", "counter", "Events accepted into the async webhook queue.")
+metrics.define("linebot_event_queue_rejected_total", "counter", "Events refused with 503 because the queue was full.")
+metrics.define("linebot_event_queue_overflow_total", "counter", "Events of one batch beyond their worker queue size, enqueued as the worker drained it.")
+
+@metrics.collector
+def _collect_event_queue():
+    if _dispatcher is None or _dispatcher_pid != os.getpid():
+        return []
+    return [("linebot_event_queue_depth", (), _dispatcher.depth()),
+            ("linebot_event_queue_capacity", (), _dispatcher.capacity)]
+
+def event_dispatcher():
+    """プロセスごとに1つ（fork 後の子ではスレッドが無いので作り直す）"""
+    global _dispatcher, _dispatcher_pid
+    pid = os.getpid()
+    if _dispatcher is None or _dispatcher_pid != pid:
+        with _dispatcher_lock:
+            if _dispatcher is None or _dispatcher_pid != pid:
+                _dispatcher = EventDispatcher()
+                _dispatcher_pid = pid
+    return _dispatcher
+
+# =========================
+# サンプリングプロファイラ（/admin/profile?seconds=N）：動いている間だけ全スレッドのスタックを数える
+# =========================
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")   # /admin/* は Authorization: Bearer <これ> が必要（未設定なら使えない）
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))    # 秒：サンプルの間隔
+
+def admin_authorized(header):
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(header or "", f"Bearer {ADMIN_TOKEN}")
+
+class SamplingProfiler:
+    """
+    interval 秒ごとに sys._current_frames() で全スレッドのスタックを見て、同じスタックを数える。
+    止めている間は何もしないので、普段のオーバーヘッドは 0。
+    結果は flamegraph.pl / speedscope が読める collapsed 形式（"スレッド名;外側の関数;...;内側の関数 回数"）。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def run(self, seconds, interval=PROFILE_INTERVAL):
+        """seconds 秒サンプルを取って collapsed 形式の文字列を返す。ほかのプロファイルが動いていたら None"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            counts = {}
+            me = threading.get_ident()
+            deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, f"thread-{ident}").replace(" ", "_"))
+                    key = ";".join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+                time.sleep(interval)
+            return "".join(f"{key} {n}\n" for key, n in sorted(counts.items()))
+        finally:
+            self._lock.release()
+
+profiler = SamplingProfiler()
+
+# =========================
+# プロセスの始まりと終わり（gunicorn.conf.py の hook から呼ぶ）
+# =========================
+
+def _after_fork_in_child():
+    """
+    fork した子：親のスレッドが持ったままのロックを引き継がないように作り直す。
+    接続・スレッドを持つもの（プール・LISTEN・LINE の Session・ワーカー）は pid を見て子で作り直す。
+    """
+    global _db_ready_lock, _db_pool_lock
+    global _state_cache_lock, _line_client_lock, _space_notifier_lock
+    global _dedup_lock, _batch_executor_lock, _dispatcher_lock, _storage_lock
+    _db_ready_lock = threading.Lock()
+    _db_pool_lock = threading.Lock()
+    _state_cache_lock = threading.Lock()
+    _line_client_lock = threading.Lock()
+    _space_notifier_lock = threading.Lock()
+    _dedup_lock = threading.Lock()
+    _batch_executor_lock = threading.Lock()
+    _dispatcher_lock = threading.Lock()
+    _storage_lock = threading.Lock()
+    flex_cache._lock = threading.Lock()
+    profiler._lock = threading.Lock()
+    if _storage is not None:
+        _storage.after_fork()
+    metrics.reset()
+    setup_logging()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def prepare_master():
+    """
+    preload した親（gunicorn の master）で1回だけ：テーブル作成・移行を済ませて、
+    使った接続は fork 前に閉じる（子に TCP/TLS の接続を持ち越さない）。
+    """
+    ensure_db_ready()
+    storage().close()
+
+def init_worker():
+    """fork 直後の子で：接続プール・LISTEN・LINE の接続を先に作っておく（最初のリクエストを待たせない）"""
+    if STORAGE_BACKEND == "postgres" and DATABASE_URL:
+        get_db_pool()
+        state_cache()
+    line_client()
+    metrics.start_flusher()
+
+def shutdown_worker(timeout=30.0):
+    """
+    止める前に、受け付け済みのイベント（async のキュー・通知の溜まり）を処理し切ってから接続を閉じる。
+    timeout: 全体でこの秒数まで待つ
+    """
+    pid = os.getpid()
+    deadline = time.monotonic() + timeout
+    if _dispatcher is not None and _dispatcher_pid == pid:
+        _dispatcher.shutdown(timeout=max(0.0, deadline - time.monotonic()))
+    if _batch_executor is not None and _batch_executor_pid == pid:
+        _batch_executor.shutdown(wait=True)
+    if _space_notifier is not None and _space_notifier_pid == pid:
+        _space_notifier.shutdown(timeout=max(0.0, deadline - time.monotonic()))
+    if _state_cache is not None and _state_cache_pid == pid:
+        _state_cache.listener.stop()
+    if _storage is not None:
+        _storage.close()
+    close_db_pool()
+    try:
+        metrics.flush()
+    except OSError as e:
+        log.warning("metrics flush failed", extra={"error": repr(e)})
+    # キューに残っているログを書き出す
+    stop_logging()
+
+# =========================
+# 署名チェック（LINE_CHANNEL_SECRET があるときだけ）
+# =========================
+
+LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
+
+def verify_line_signature(body: bytes, signature) -> bool:
+    if not LINE_CHANNEL_SECRET:
+        return True
+    mac = hmac.new(LINE_CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(mac).decode("ascii"), signature or "")
+
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    t0 = time.perf_counter()
+    text, status = _webhook()
+    metrics.observe("linebot_webhook_seconds", time.perf_counter() - t0, (("status", str(status)),))
+    return text, status
+
+def _webhook():
+    if not verify_line_signature(request.get_data(), request.headers.get("X-Line-Signature")):
+        return "Invalid signature", 400
+
+    body = request.get_json(silent=True) or {}
+    events = body.get("events", [])
+    log.debug("webhook", extra={"events": len(events)})
+
+    if WEBHOOK_MODE == "async":
+        if events and not event_dispatcher().submit_all(events):
+            # 満杯：1つも積まずに、LINE に全部を再送してもらう
+            metrics.inc("linebot_errors_total", (("kind", "busy"),))
+            return "Busy", 503
+        return "OK", 200
+
+    process_events(events)
     return "OK", 200
     
 @app.route("/")
 def home():
     return "Bot is running!"
 
+@app.route("/metrics")
+def metrics_endpoint():
+    if not metrics_authorized(request.headers.get("Authorization")):
+        return "Unauthorized", 401
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    """?seconds=N（既定 10）の間サンプルを取って、collapsed 形式で返す（flamegraph.pl profile.txt > out.svg）"""
+    if not admin_authorized(request.headers.get("Authorization")):
+        return "Not Found", 404
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+    except ValueError:
+        return "seconds must be a number", 400
+    result = profiler.run(seconds)
+    if result is None:
+        return "another profile is running", 409
+    return result, 200, {"Content-Type": "text/plain; charset=utf-8"}
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=10000)
\ No newline at end of file
+    # python app.py migrate [--force] : kv_store → テーブル分割 の移行だけ実行
+    if sys.argv[1:2] == ["migrate"]:
+        STORAGE_MODE = "relational"
+        init_db()
+        migrate_kv_to_relational(force="--force" in sys.argv)
+        sys.exit(0)
+
+    # python app.py bench-router : postback の振り分けにかかる時間
+    if sys.argv[1:2] == ["bench-router"]:
+        bench_router()
+        sys.exit(0)
+
+    # 開発用サーバー（本番は gunicorn -c gunicorn.conf.py app:app）
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "10000")))
\ No newline at end of file
@@ -0,0 +1,391 @@
+# 非同期モード：aiohttp + async psycopg で /webhook を受ける（1プロセスで多くのイベントを同時に待てる）
+#
+#   python app_async.py                 … 起動（PORT、既定 10000）
+#   python app_async.py bench [...]     … 同期モード（Flask + スレッド）との処理件数の比較
+#
+# イベントの処理（handle_event / handle_message / handle_space_done ...、保存、返信）は app.py のものをそのまま使う。
+# 1イベントを greenlet の中で動かし、DB・LINE API・sleep のところだけ await に差し替える
+# （app._async_io を見て db_connect() / line_client() / pause() が切り替わる）。
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import aiohttp
+import greenlet
+import requests
+from aiohttp import web
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+import app
+
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", "100"))   # 同時に処理するイベントの上限
+
+# =========================
+# greenlet：同期の処理の中から await する
+# =========================
+
+class _IoGreenlet(greenlet.greenlet):
+    def __init__(self, fn, driver):
+        super().__init__(fn, driver)
+        self.driver = driver
+
+def await_only(awaitable):
+    """同期の処理（greenlet の中）から awaitable を待つ。イベントループは止まらない"""
+    current = greenlet.getcurrent()
+    if not isinstance(current, _IoGreenlet):
+        raise RuntimeError("await_only() は run_sync() の中でだけ使える")
+    return current.driver.switch(awaitable)
+
+async def run_sync(io, fn, *args):
+    """fn(*args) を greenlet で動かし、中で await_only() に渡されたものをここで await する"""
+    ctx = contextvars.copy_context()
+    ctx.run(app._async_io.set, io)
+    g = _IoGreenlet(fn, greenlet.getcurrent())
+    g.gr_context = ctx
+    result = g.switch(*args)
+    while not g.dead:
+        try:
+            value = await result
+        except BaseException:
+            result = g.throw(*sys.exc_info())
+        else:
+            result = g.switch(value)
+    return result
+
+# =========================
+# async psycopg を同期の形で（app.py の rel_load / rel_save / claim_webhook_event が使う分だけ）
+# =========================
+
+class BridgeCursor:
+    def __init__(self, acur, conn):
+        self._cur = acur
+        self.connection = conn
+
+    def execute(self, query, params=None):
+        await_only(self._cur.execute(query, params))
+        return self
+
+    def fetchone(self):
+        return await_only(self._cur.fetchone())
+
+    def fetchall(self):
+        return await_only(self._cur.fetchall())
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        await_only(self._cur.close())
+        return False
+
+class BridgeConnection:
+    def __init__(self, aconn):
+        self._conn = aconn
+
+    def cursor(self):
+        return BridgeCursor(self._conn.cursor(), self)
+
+    def execute(self, query, params=None):
+        return BridgeCursor(await_only(self._conn.execute(query, params)), self)
+
+    @contextmanager
+    def transaction(self):
+        with _bridge_async_cm(self._conn.transaction()):
+            yield self
+
+@contextmanager
+def _bridge_async_cm(cm):
+    value = await_only(cm.__aenter__())
+    try:
+        yield value
+    except BaseException:
+        if not await_only(cm.__aexit__(*sys.exc_info())):
+            raise
+    else:
+        await_only(cm.__aexit__(None, None, None))
+
+# =========================
+# LINE API：LineClient の HTTP 1回分だけ aiohttp にする（リトライ・レート制限・集計は同じ）
+# =========================
+
+class LineResponse:
+    """requests.Response のうち、呼び出し側が使う所だけ"""
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+class AsyncLineClient(app.LineClient):
+    def __init__(self, http, token=None, base_url=app.LINE_API_BASE, limiter=None):
+        super().__init__(token, base_url)
+        self.http = http
+        if limiter is not None:
+            # 同じプロセスの同期クライアント（通知スレッドなど）とレート制限を分け合う
+            self.limiter = limiter
+
+    def _new_session(self):
+        return None
+
+    def _send(self, method, url, headers, payload=None):
+        return await_only(self._send_async(method, url, headers, payload))
+
+    async def _send_async(self, method, url, headers, payload):
+        kwargs = {}
+        if isinstance(payload, bytes):
+            kwargs["data"] = payload
+            headers = {**headers, "Content-Type": "application/json"}
+        elif payload is not None:
+            kwargs["json"] = payload
+        timeout = aiohttp.ClientTimeout(sock_connect=app.LINE_CONNECT_TIMEOUT, sock_read=app.LINE_READ_TIMEOUT)
+        try:
+            async with self.http.request(method, url, headers=headers, timeout=timeout, **kwargs) as res:
+                return LineResponse(res.status, res.headers, await res.text())
+        except asyncio.TimeoutError as e:
+            raise requests.Timeout(repr(e))
+        except aiohttp.ClientError as e:
+            raise requests.ConnectionError(repr(e))
+
+# =========================
+# プロセスに1つ：async の接続プール・HTTP セッション
+# =========================
+
+class AsyncIO:
+    """app._async_io に入れるもの（db_connect / line_client / sleep）"""
+    def __init__(self, pool, line):
+        self.pool = pool
+        self.line_client = line
+
+    @contextmanager
+    def db_connect(self):
+        with _bridge_async_cm(self.pool.connection()) as aconn:
+            yield BridgeConnection(aconn)
+
+    def sleep(self, seconds):
+        await_only(asyncio.sleep(seconds))
+
+    def run_blocking(self, fn, *args):
+        """同期のまま動かす処理（ロックを持つもの）を別スレッドで待つ。そのスレッドでは差し替えなし"""
+        return await_only(asyncio.to_thread(contextvars.Context().run, fn, *args))
+
+async def open_io(line_base_url=None):
+    # テーブル作成・移行は同期のまま先に1回（ロックを持ったまま await しないように）
+    await asyncio.to_thread(app.ensure_db_ready)
+    pool = None
+    # sqlite / memory は DB 接続を使わない（そのまま同期で呼ぶ。どちらもすぐ返る）
+    if app.STORAGE_BACKEND == "postgres":
+        pool = AsyncConnectionPool(
+            app.DATABASE_URL,
+            min_size=app.DB_POOL_MIN_SIZE,
+            max_size=max(app.DB_POOL_MAX_SIZE, app.DB_POOL_MIN_SIZE),
+            max_idle=app.DB_POOL_MAX_IDLE,
+            max_lifetime=app.DB_POOL_MAX_LIFETIME,
+            timeout=app.DB_POOL_TIMEOUT,
+            check=AsyncConnectionPool.check_connection,
+            kwargs={"row_factory": dict_row},
+            name=f"line-task-bot-async-{os.getpid()}",
+            open=False,
+        )
+        await pool.open()
+    http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max(app.LINE_POOL_SIZE, ASYNC_MAX_INFLIGHT)))
+    line = AsyncLineClient(http, app.LINE_CHANNEL_ACCESS_TOKEN, line_base_url or app.LINE_API_BASE,
+                           limiter=app.line_client().limiter)
+    return AsyncIO(pool, line)
+
+async def close_io(io):
+    await io.line_client.http.close()
+    if io.pool is not None:
+        await io.pool.close()
+
+# =========================
+# webhook
+# =========================
+
+async def process_events(io, events, inflight):
+    """同じユーザーのイベントは順番通り、別ユーザー同士は同時に（app.process_events と同じ分け方）"""
+    partitions = {}
+    for event in events:
+        partitions.setdefault(app.event_partition_key(event), []).append(event)
+
+    async def run_partition(part):
+        for event in part:
+            async with inflight:
+                await run_sync(io, app.process_event, event)
+
+    await asyncio.gather(*(run_partition(part) for part in partitions.values()))
+
+async def webhook(request):
+    t0 = time.perf_counter()
+    res = await _webhook(request)
+    app.metrics.observe("linebot_webhook_seconds", time.perf_counter() - t0, (("status", str(res.status)),))
+    return res
+
+async def _webhook(request):
+    body = await request.read()
+    if not app.verify_line_signature(body, request.headers.get("X-Line-Signature")):
+        return web.Response(status=400, text="Invalid signature")
+    try:
+        data = json.loads(body or b"{}") or {}
+    except ValueError:
+        data = {}
+    events = data.get("events", [])
+    app.log.debug("webhook", extra={"events": len(events)})
+
+    await process_events(request.app["io"], events, request.app["inflight"])
+    return web.Response(text="OK")
+
+async def home(request):
+    return web.Response(text="Bot is running!")
+
+async def metrics_endpoint(request):
+    if not app.metrics_authorized(request.headers.get("Authorization")):
+        return web.Response(status=401, text="Unauthorized")
+    text = await asyncio.to_thread(app.metrics.render)
+    return web.Response(text=text, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def admin_profile(request):
+    if not app.admin_authorized(request.headers.get("Authorization")):
+        return web.Response(status=404, text="Not Found")
+    try:
+        seconds = float(request.query.get("seconds", "10"))
+    except ValueError:
+        return web.Response(status=400, text="seconds must be a number")
+    # サンプルを取っている間もイベントループは止めない（greenlet で動いているイベントのスタックも見える）
+    result = await asyncio.to_thread(app.profiler.run, seconds)
+    if result is None:
+        return web.Response(status=409, text="another profile is running")
+    return web.Response(text=result)
+
+async def _on_startup(web_app):
+    web_app["io"] = await open_io()
+    pool = web_app["io"].pool
+    if pool is not None:
+        app.metrics.collector(lambda: app.db_pool_metrics(pool.get_stats()))
+    line = web_app["io"].line_client
+    app.metrics.collector(lambda: line.quota_metrics("async"))
+    app.metrics.start_flusher()
+    web_app["inflight"] = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+
+async def _on_cleanup(web_app):
+    await close_io(web_app["io"])
+    # 通知スレッドなど同期側の後片付け
+    await asyncio.to_thread(app.shutdown_worker)
+
+async def create_app():
+    """gunicorn の aiohttp.GunicornWebWorker からも使える"""
+    web_app = web.Application()
+    web_app.router.add_post("/webhook", webhook)
+    web_app.router.add_get("/", home)
+    web_app.router.add_get("/metrics", metrics_endpoint)
+    web_app.router.add_route("*", "/admin/profile", admin_profile)
+    web_app.on_startup.append(_on_startup)
+    web_app.on_cleanup.append(_on_cleanup)
+    return web_app
+
+# =========================
+# 同期モードとの比較：python app_async.py bench [--events N] [--users N] [--concurrency N] [--line-latency 秒]
+# =========================
+
+def _start_line_stub(latency):
+    """返事が latency 秒かかる LINE API の代わり"""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def _bench_events(n, users):
+    events = []
+    for i in range(n):
+        source = {"type": "user", "userId": f"bench-u{i % users}"}
+        if i % 2:
+            events.append({"type": "postback", "replyToken": f"rt{i}", "source": source,
+                           "postback": {"data": "#board_list"}})
+        else:
+            events.append({"type": "message", "replyToken": f"rt{i}", "source": source,
+                           "message": {"type": "text", "text": "こんにちは"}})
+    return events
+
+def _bench_sync(stub, events, concurrency):
+    """Flask（gunicorn の gthread と同じく、スレッド concurrency 本で受ける）"""
+    from concurrent.futures import ThreadPoolExecutor
+    app._line_client = app.LineClient(app.LINE_CHANNEL_ACCESS_TOKEN, base_url=stub)
+    app._line_client_pid = os.getpid()
+    client = app.app.test_client()
+
+    def post(event):
+        client.post("/webhook", json={"events": [event]})
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(post, events))
+    return time.perf_counter() - t0
+
+async def _bench_async(stub, events, concurrency):
+    io = await open_io(line_base_url=stub)
+    inflight = asyncio.Semaphore(concurrency)
+    try:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(process_events(io, [event], inflight) for event in events))
+        return time.perf_counter() - t0
+    finally:
+        await close_io(io)
+
+def bench(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="app_async.py bench")
+    parser.add_argument("--events", type=int, default=400)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8, help="同期はスレッド数、非同期は同時に処理する数")
+    parser.add_argument("--async-concurrency", type=int, default=ASYNC_MAX_INFLIGHT)
+    parser.add_argument("--line-latency", type=float, default=0.05, help="LINE API の応答にかかる秒数")
+    args = parser.parse_args(argv)
+
+    stub = _start_line_stub(args.line_latency)
+    app.ensure_db_ready()
+    # 1回流して、ユーザーの行・接続を用意しておく
+    _bench_sync(stub, _bench_events(args.users, args.users), args.concurrency)
+
+    events = _bench_events(args.events, args.users)
+    t_sync = _bench_sync(stub, events, args.concurrency)
+    # 同じ同時数どうしでも比べる（スレッド数と in-flight 数が違うと、それだけで差が出る）
+    inflights = list(dict.fromkeys([args.concurrency, args.async_concurrency]))
+    t_async = {n: asyncio.run(_bench_async(stub, events, n)) for n in inflights}
+    print(f"events={args.events} users={args.users} line_latency={args.line_latency}s")
+    print(f"sync  (threads={args.concurrency:3d})  {args.events / t_sync:8.1f} events/s")
+    for n in inflights:
+        print(f"async (inflight={n:3d}) {args.events / t_async[n]:8.1f} events/s")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["bench"]:
+        bench(sys.argv[2:])
+        sys.exit(0)
+
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.getenv("PORT", "10000")))
@@ -0,0 +1,384 @@
+# ベンチマーク：作ったデータと LINE の webhook イベントを流して、ルートごとの遅延と events/s を測る
+#
+#   BENCH_DATABASE_URL=postgresql://... python bench.py [--sizes 10,100,500] [--users 50] ...
+#
+# ⚠️ BENCH_DATABASE_URL の中身は毎回作り直す（消える）。本番の DB は指定しないこと。
+# STORAGE_BACKEND=sqlite / memory なら BENCH_DATABASE_URL は要らない（sqlite は SQLITE_PATH を作り直す）。
+# LINE API は手元のスタブ（--line-latency 秒かけて 200 を返す）に向ける。
+# 既定は Flask の test client で同じプロセスの app を叩く。--gunicorn なら gunicorn を起動して HTTP で叩く。
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import signal
+import subprocess
+import threading
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_MIX = "schedule=4,space_done=2,check_toggle=3,board_move=1,add_personal=1"
+
+def start_line_stub(latency):
+    """
+    返事が latency 秒かかる LINE API の代わり。
+    return: (base_url, 受けた件数と返事のテキストごとの件数を数える dict)
+    """
+    counts = {"requests": 0, "texts": Counter()}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                messages = json.loads(body or b"{}").get("messages") or []
+            except ValueError:
+                messages = []
+            if latency:
+                time.sleep(latency)
+            with lock:
+                counts["requests"] += 1
+                for m in messages:
+                    if m.get("type") == "text":
+                        counts["texts"][m.get("text")] += 1
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer.daemon_threads = True
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", counts
+
+# =========================
+# データとイベント
+# =========================
+
+def build_dataset(app, users, spaces, size, checklists):
+    """
+    ユーザー users 人、集会所 spaces 個。size は1人あたりの個人予定・伝言板、
+    チェックリスト1つあたりの項目、集会所1つあたりの全体予定の数。
+    """
+    doc = app.normalize_tasks({})
+    for s in range(spaces):
+        sid = f"s{s + 1}"
+        doc["spaces"][sid] = {"name": f"bench{s}", "pass": f"bench{s}", "created_by": "bench-u0"}
+        doc["space_tasks"][sid] = [{"text": f"全体 {s}-{k}", "done_mask": 0} for k in range(size)]
+    for u in range(users):
+        uid = f"bench-u{u}"
+        sid = f"s{u % spaces + 1}" if spaces else None
+        doc["users"][uid] = [{"text": f"予定 {k}", "status": "todo"} for k in range(size)]
+        doc["checklists"][uid] = [
+            {"title": f"リスト {c}", "items": [{"text": f"項目 {k}", "done": False} for k in range(size)]}
+            for c in range(checklists)
+        ]
+        doc["board"]["users"][uid] = [{"text": f"メモ {k}"} for k in range(size)]
+        if sid:
+            doc["memberships"][uid] = [sid]
+            doc["active_space"][uid] = sid
+            app.space_member_bit(doc, sid, uid, create=True)
+    return app.normalize_tasks(doc)   # ID を振る
+
+def seed(app, doc):
+    """DB を doc で丸ごと置き換える"""
+    app.ensure_db_ready()
+    app.save_tasks(dict(doc))
+
+def ev_postback(uid, data):
+    return {"type": "postback", "replyToken": "bench", "source": {"type": "user", "userId": uid},
+            "postback": {"data": data}}
+
+def ev_text(uid, text):
+    return {"type": "message", "replyToken": "bench", "source": {"type": "user", "userId": uid},
+            "message": {"type": "text", "text": text}}
+
+def make_events(doc, n, mix, rng):
+    """
+    mix: {種類: 重み}。return: [[event, ...], ...]（内側は同じユーザーが続けて送る一連のイベント）
+    """
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    uids = list(doc["users"])
+    flows = []
+
+    while len(flows) < n:
+        kind = rng.choices(kinds, weights)[0]
+        uid = rng.choice(uids)
+        if kind == "schedule":
+            flows.append([ev_postback(uid, "scope=menu&action=list")])
+        elif kind == "space_done":
+            sid = doc["active_space"].get(uid)
+            items = doc["space_tasks"].get(sid) or []
+            if items:
+                flows.append([ev_postback(uid, f"#space_done_{rng.choice(items)['id']}")])
+        elif kind == "check_toggle":
+            lists = doc["checklists"].get(uid) or []
+            if lists:
+                c = rng.choice(lists)
+                if c["items"]:
+                    i = rng.choice(c["items"])
+                    flows.append([ev_postback(uid, f"#toggle_check_{c['id']}_{i['id']}_{c['id']}")])
+        elif kind == "board_move":
+            items = doc["board"]["users"].get(uid) or []
+            if items:
+                direction = rng.choice(["up", "down"])
+                flows.append([ev_postback(uid, f"#board_move_{rng.choice(items)['id']}_{direction}")])
+        elif kind == "add_personal":
+            flows.append([ev_postback(uid, "#add_personal"), ev_text(uid, "ベンチの予定")])
+        else:
+            raise SystemExit(f"unknown mix kind: {kind}")
+    return flows
+
+# =========================
+# 送る側（Flask test client / HTTP）
+# =========================
+
+def _signed(body, secret):
+    if not secret:
+        return {}
+    mac = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return {"X-Line-Signature": base64.b64encode(mac).decode("ascii")}
+
+def flask_sender(app):
+    client = app.app.test_client()
+    secret = app.LINE_CHANNEL_SECRET
+
+    def send(event):
+        body = json.dumps({"events": [event]}).encode()
+        res = client.post("/webhook", data=body, headers={"Content-Type": "application/json", **_signed(body, secret)})
+        return res.status_code
+    return send
+
+def http_sender(url, secret):
+    def send(event):
+        body = json.dumps({"events": [event]}).encode()
+        req = urllib.request.Request(f"{url}/webhook", data=body,
+                                     headers={"Content-Type": "application/json", **_signed(body, secret)})
+        try:
+            with urllib.request.urlopen(req, timeout=60) as res:
+                res.read()
+                return res.status
+        except urllib.error.HTTPError as e:
+            return e.code
+    return send
+
+def start_gunicorn(port, env):
+    proc = subprocess.Popen(["gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, **env, "PORT": str(port)},
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + "/", timeout=1).read()
+            return proc, url
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise SystemExit("gunicorn が起動しなかった")
+
+# =========================
+# 測る
+# =========================
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+def run(app, send, flows, concurrency, stub_counts):
+    """
+    同じユーザーの流れは順番に（本物のユーザーは2つの操作を同時にはしない）、別のユーザー同士を同時に流す。
+    webhook は処理に失敗しても 200 を返すので、失敗は LINE スタブに届いた DB_FALLBACK_TEXT の返事で数える。
+    return: ({ルート: [ms, ...]}, 全体の秒数, 失敗した件数（200 以外 + 失敗の返事）)
+    """
+    by_user = {}
+    for flow in flows:
+        by_user.setdefault(app.event_partition_key(flow[0]), []).append(flow)
+
+    samples = {}
+    errors = [0]
+    lock = threading.Lock()
+    fallbacks = stub_counts["texts"][app.DB_FALLBACK_TEXT]
+
+    def run_user(user_flows):
+        for flow in user_flows:
+            for event in flow:
+                route = app.event_route(event)
+                t0 = time.perf_counter()
+                status = send(event)
+                ms = (time.perf_counter() - t0) * 1000
+                with lock:
+                    samples.setdefault(route, []).append(ms)
+                    if status != 200:
+                        errors[0] += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_user, by_user.values()))
+    elapsed = time.perf_counter() - t0
+    return samples, elapsed, errors[0] + stub_counts["texts"][app.DB_FALLBACK_TEXT] - fallbacks
+
+def report(size, samples, elapsed, errors):
+    rows = []
+    total = sum(len(v) for v in samples.values())
+    print(f"\n== size={size}  events={total}  {total / elapsed:.1f} events/s  errors={errors}")
+    print(f"{'route':32s} {'n':>6s} {'ev/s':>8s} {'p50ms':>8s} {'p95ms':>8s} {'p99ms':>8s}")
+    for route in sorted(samples):
+        values = sorted(samples[route])
+        row = {
+            "size": size, "route": route, "n": len(values),
+            "events_per_sec": len(values) / elapsed,
+            "p50_ms": percentile(values, 50), "p95_ms": percentile(values, 95), "p99_ms": percentile(values, 99),
+        }
+        rows.append(row)
+        print(f"{route:32s} {row['n']:6d} {row['events_per_sec']:8.1f} "
+              f"{row['p50_ms']:8.2f} {row['p95_ms']:8.2f} {row['p99_ms']:8.2f}")
+    return rows
+
+# =========================
+# 1イベント = 読み1回・書き1回まで（--check-uow）
+# =========================
+
+def sample_postbacks(app, doc, uid):
+    """登録されている全ルートについて、doc の中の ID を入れた postback data を1つずつ"""
+    c = doc["checklists"][uid][0]
+    sid = doc["active_space"][uid]
+    space_task = doc["space_tasks"][sid][0]["id"]
+    values = {"cursor": "0", "item_cursor": "0", "direction": "down", "scope": "p",
+              "c": c["id"], "opened": c["id"], "i": c["items"][0]["id"], "sid": sid}
+    # ref は何の ID かがルートで違う（それ以外は個人予定）
+    refs = {"#board_": doc["board"]["users"][uid][0]["id"], "#space_": space_task, "#done_delete_s_": space_task}
+    personal = doc["users"][uid][0]["id"]
+    out = []
+    for r in app.router.routes:
+        ref = next((v for prefix, v in refs.items() if r.name.startswith(prefix)), personal)
+        parts = [ref if name == "ref" else values[name] for name, _typ in r.params]
+        out.append(r.name + "_".join(parts))
+    return out
+
+def check_uow(app, send, doc):
+    """
+    全ルートの postback を1つずつ流して、1イベントで読むのは1回まで・書くのも1回までかを確かめる。
+    return: だめだったルートの数
+    """
+    uid = next(iter(doc["users"]))
+    failed = 0
+    print(f"{'route':32s} {'loads':>6s} {'saves':>6s}")
+    for data in sample_postbacks(app, doc, uid):
+        # 前のルートで消した・動かした分と、入力待ちの state を戻してから
+        seed(app, doc)
+        app.user_states.clear()
+        route = app.router.resolve(data)[0].name
+        labels = (("route", route),)
+        before = app.metrics.snapshot()
+        status = send(ev_postback(uid, data))
+        after = app.metrics.snapshot()
+
+        def delta(name, extra=()):
+            key = (name, labels + extra)
+            return after.get(key, 0) - before.get(key, 0)
+
+        events = delta("linebot_uow_events_total")
+        loads, saves = delta("linebot_uow_loads_total"), delta("linebot_uow_saves_total")
+        problems = []
+        if status != 200 or events < 1:
+            problems.append(f"not handled (status {status})")
+        if delta("linebot_uow_over_budget_total", (("kind", "load"),)) or loads > events:
+            problems.append("loaded more than once")
+        if delta("linebot_uow_over_budget_total", (("kind", "save"),)) or saves > events:
+            problems.append("saved more than once")
+        errors = sum(v - before.get(k, 0) for k, v in after.items() if k[0] == "linebot_errors_total")
+        if errors:
+            problems.append(f"{errors} handler errors")
+        failed += bool(problems)
+        print(f"{route:32s} {loads:6d} {saves:6d}  {'; '.join(problems) or 'ok'}")
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="webhook のベンチマーク（BENCH_DATABASE_URL の DB は作り直す）")
+    parser.add_argument("--sizes", default="10,100,500", help="データの大きさ（カンマ区切り。大きさごとに測る）")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--spaces", type=int, default=5)
+    parser.add_argument("--checklists", type=int, default=3, help="1人あたりのチェックリストの数")
+    parser.add_argument("--events", type=int, default=500, help="大きさごとに流すイベント（一連の流れ）の数")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"種類=重み（既定 {DEFAULT_MIX}）")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--line-latency", type=float, default=0.0, help="LINE API スタブの応答秒")
+    parser.add_argument("--gunicorn", action="store_true", help="gunicorn を起動して HTTP で叩く")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル（前回と比べる用）")
+    parser.add_argument("--check-uow", action="store_true",
+                        help="測らずに、全ルートで「読むのは1回・書くのは1回まで」かを確かめる（だめなら終了コード 1）")
+    args = parser.parse_args(argv)
+    if args.check_uow and args.gunicorn:
+        raise SystemExit("--check-uow は同じプロセスの数を見るので --gunicorn とは一緒に使えない")
+
+    backend = os.getenv("STORAGE_BACKEND", "postgres")
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if backend == "postgres" and not database_url:
+        raise SystemExit("BENCH_DATABASE_URL を指定してね（中身は作り直すので本番の DB は使わない）")
+    if backend == "memory" and args.gunicorn:
+        raise SystemExit("STORAGE_BACKEND=memory はプロセスごとに別のデータなので --gunicorn では測れない")
+
+    stub, stub_counts = start_line_stub(args.line_latency)
+    # app を読み込む前に向け先を変える（LINE_API_BASE / DATABASE_URL は読み込み時に決まる）
+    env = {"LINE_API_BASE": stub}
+    if database_url:
+        env["DATABASE_URL"] = database_url
+    os.environ.update(env)
+    os.environ.setdefault("LOG_LEVEL", "ERROR")   # app のログは出さずに、結果だけ出す
+    if args.check_uow:
+        os.environ["WEBHOOK_MODE"] = "sync"   # 返ってきた時点で処理が終わっているように
+    import app
+
+    if args.check_uow:
+        doc = build_dataset(app, users=2, spaces=1, size=3, checklists=1)
+        failed = check_uow(app, flask_sender(app), doc)
+        print(f"\n{failed} route(s) failed" if failed else "\nall routes: ok")
+        raise SystemExit(1 if failed else 0)
+
+    mix = {k: float(v) for k, v in (part.split("=") for part in args.mix.split(","))}
+    rng = random.Random(args.seed)
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        doc = build_dataset(app, args.users, args.spaces, size, args.checklists)
+        seed(app, doc)
+        flows = make_events(doc, args.events, mix, rng)
+
+        proc = None
+        if args.gunicorn:
+            proc, url = start_gunicorn(args.port, env)
+            send = http_sender(url, app.LINE_CHANNEL_SECRET)
+        else:
+            send = flask_sender(app)
+        try:
+            # 接続・キャッシュを温めてから測る
+            run(app, send, flows[:args.concurrency], args.concurrency, stub_counts)
+            samples, elapsed, errors = run(app, send, flows, args.concurrency, stub_counts)
+        finally:
+            if proc is not None:
+                proc.send_signal(signal.SIGTERM)
+                proc.wait(timeout=60)
+        results += report(size, samples, elapsed, errors)
+
+    print(f"\nLINE stub requests: {stub_counts['requests']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
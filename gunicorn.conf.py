@@ -0,0 +1,50 @@
+# gunicorn の設定（render.yaml の startCommand: gunicorn -c gunicorn.conf.py app:app）
+import os
+
+# gevent のときは app を読み込む（preload）前にパッチを当てる
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")   # "gthread"（既定） / "gevent"
+if worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))               # gthread のときの1ワーカーのスレッド数
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "200"))   # gevent のときの同時接続数
+
+# LINE の webhook は数秒で返さないと再送されるので、固まったワーカーは早めに入れ替える
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+# SIGTERM を受けてから、受け付け済みのイベントを処理し切るまで待つ秒数
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# app を親で1回だけ読み込んでから fork（テーブル作成・移行も親で1回）
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+accesslog = "-" if os.getenv("GUNICORN_ACCESS_LOG", "0") == "1" else None
+errorlog = "-"
+
+
+def on_starting(server):
+    # METRICS_DIR：前回起動したときのワーカーの分は消す（数え直し）
+    metrics_dir = os.getenv("METRICS_DIR")
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            if name.startswith("metrics_"):
+                os.remove(os.path.join(metrics_dir, name))
+
+
+def when_ready(server):
+    if preload_app:
+        import app
+        app.prepare_master()
+
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
+
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown_worker(timeout=graceful_timeout)
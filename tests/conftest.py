@@ -0,0 +1,19 @@
+# app は読み込んだ時点で環境変数を見るので、import する前にここで決める。
+#   STORAGE_BACKEND は memory（sqlite は tmp_path に作る）
+#   TEST_DATABASE_URL を指定したときだけ postgres も流す（⚠️ 中身は消える。STORAGE_MODE で relational / kv）
+#   LINE API は手元のスタブ（返事の中身は見ない）
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bench
+
+LINE_STUB, LINE_STUB_COUNTS = bench.start_line_stub(0)
+os.environ["LINE_API_BASE"] = LINE_STUB
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+os.environ["WEBHOOK_MODE"] = "sync"   # 返ってきた時点で処理が終わっているように
+if os.getenv("TEST_DATABASE_URL"):
+    os.environ["DATABASE_URL"] = os.environ["TEST_DATABASE_URL"]
@@ -0,0 +1,59 @@
+# WEBHOOK_MODE=async のキュー（EventDispatcher）
+import threading
+import time
+
+import app
+import bench
+
+
+def _recorder(monkeypatch, delay=0.0):
+    seen = []
+    lock = threading.Lock()
+
+    def process_event(event):
+        time.sleep(delay)
+        with lock:
+            seen.append(event["message"]["text"])
+    monkeypatch.setattr(app, "process_event", process_event)
+    return seen
+
+
+def _wait_for(seen, n, timeout=10):
+    deadline = time.monotonic() + timeout
+    while len(seen) < n and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_batch_larger_than_one_queue_is_accepted_in_order(monkeypatch):
+    # 1人分のイベントがワーカー1つのキュー（4件）より多くても 503 にせず、届いた順に全部処理する
+    seen = _recorder(monkeypatch, delay=0.001)
+    d = app.EventDispatcher(workers=2, queue_size=8)
+    events = [bench.ev_text("u1", f"m{k}") for k in range(20)]
+    assert d.submit_all(events, timeout=1)
+    _wait_for(seen, 20)
+    assert seen == [f"m{k}" for k in range(20)]
+    d.shutdown(timeout=5)
+
+
+def test_full_queue_rejects_whole_batch(monkeypatch):
+    release = threading.Event()
+    seen = []
+    monkeypatch.setattr(app, "process_event", lambda event: release.wait(5) and seen.append(event))
+    d = app.EventDispatcher(workers=1, queue_size=2)
+    assert d.submit_all([bench.ev_text("u1", "a"), bench.ev_text("u1", "b"), bench.ev_text("u1", "c")], timeout=1)
+    # ワーカーは a で止まっていて、キューは b, c で満杯：次の分は1つも積まない
+    assert not d.submit_all([bench.ev_text("u2", "d")], timeout=0.1)
+    release.set()
+    d.shutdown(timeout=5)
+    assert len(seen) == 3
+
+
+def test_shutdown_respects_timeout_when_queue_is_full(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(app, "process_event", lambda event: release.wait(5))
+    d = app.EventDispatcher(workers=1, queue_size=1)
+    assert d.submit_all([bench.ev_text("u1", "a"), bench.ev_text("u1", "b")], timeout=1)
+    t0 = time.monotonic()
+    d.shutdown(timeout=0.2)
+    assert time.monotonic() - t0 < 2
+    release.set()
@@ -0,0 +1,59 @@
+# Flex のキャッシュ：キーは読んだ範囲の版数＋ UI フラグ・カーソル（中身は見ない）
+import pytest
+
+import app
+import bench
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    app.flex_cache.entries.clear()
+    bench.seed(app, bench.build_dataset(app, users=2, spaces=1, size=15, checklists=1))
+    out = []
+    monkeypatch.setattr(app, "send_flex", lambda reply_token, flex: out.append(flex))
+    return out
+
+
+def _lookups(result, kind="schedule"):
+    key = ("linebot_flex_cache_lookups_total", (("kind", kind), ("result", result)))
+    return app.metrics.snapshot().get(key, 0)
+
+
+def _show(uid, cursor=0):
+    app.run_in_uow(lambda: app.handle_schedule_list("r", uid, cursor=cursor), uid)
+
+
+def test_same_state_hits(sent):
+    _show("bench-u0")
+    hits = _lookups("hit")
+    _show("bench-u0")
+    assert _lookups("hit") == hits + 1
+    assert sent[0] is sent[1]
+    # カーソルが違えば別の画面（個人 15 ＋ 全体 15 行 → 2ページ目）
+    _show("bench-u0", cursor=20)
+    assert sent[2] != sent[0]
+
+
+def test_other_members_write_changes_the_screen(sent):
+    _show("bench-u0")
+
+    def add():
+        tasks = app.load_tasks("bench-u1")
+        tasks["space_tasks"]["s1"].insert(0, {"id": app.new_item_id(), "text": "u1 が足した", "done_mask": 0})
+        app.save_tasks(tasks)
+    app.run_in_uow(add, "bench-u1")
+
+    _show("bench-u0")
+    assert "u1 が足した".encode() in sent[-1]
+    assert "u1 が足した".encode() not in sent[0]
+
+
+def test_unsaved_changes_are_not_cached(sent):
+    def done_and_show():
+        tasks = app.load_tasks("bench-u0")
+        tasks["users"]["bench-u0"][0]["status"] = "done"
+        app.save_tasks(tasks)   # UnitOfWork の中では書くのはイベントの最後
+        app.handle_schedule_list("r", "bench-u0")
+    bypass = _lookups("bypass")
+    app.run_in_uow(done_and_show, "bench-u0")
+    assert _lookups("bypass") == bypass + 1
@@ -0,0 +1,80 @@
+# 予定表：完了・削除のボタンは今のページを覚えていて、押した後も同じページを出す
+import json
+
+import pytest
+
+import app
+import bench
+
+UID = "bench-u0"
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    doc = bench.build_dataset(app, users=2, spaces=1, size=15, checklists=1)   # 個人 15 ＋ 全体 15 行 → 2ページ
+    bench.seed(app, doc)
+    out = []
+    monkeypatch.setattr(app, "send_flex", lambda reply_token, flex: out.append(json.loads(flex)))
+    return out
+
+
+def _tap(data):
+    pb = app.Postback("r", UID, "user", None, data)
+    app.run_in_uow(lambda: app.router.dispatch(pb), UID)
+
+
+def _postbacks(node):
+    if isinstance(node, dict):
+        data = (node.get("action") or {}).get("data")
+        if data:
+            yield data
+        for v in node.values():
+            yield from _postbacks(v)
+    elif isinstance(node, list):
+        for v in node:
+            yield from _postbacks(v)
+
+
+def _texts(node):
+    if isinstance(node, dict):
+        if node.get("type") == "text":
+            yield node
+        for v in node.values():
+            yield from _texts(v)
+    elif isinstance(node, list):
+        for v in node:
+            yield from _texts(v)
+
+
+def _page(flex):
+    """「11–29 / 29」（前へ/次へ の行）"""
+    return next(t["text"] for t in _texts(flex) if " / " in t["text"])
+
+
+def test_old_buttons_without_cursor_still_resolve():
+    assert app.router.resolve("#list_done_p_k3x9f2ab")[1] == {"scope": "p", "ref": "k3x9f2ab", "cursor": 0}
+    assert app.router.resolve("#list_done_p_k3x9f2ab_20")[1] == {"scope": "p", "ref": "k3x9f2ab", "cursor": 20}
+    assert app.router.resolve("#space_done_3")[1] == {"ref": "3", "cursor": 0}
+    assert app.router.resolve("#list_done_p_k3x9f2ab_x") == (None, None)
+
+
+@pytest.mark.parametrize("prefix", ["#space_done_", "#list_done_p_"])
+def test_done_keeps_the_page(sent, prefix):
+    # 2ページ目（11 行目から：個人の 11〜15 と全体）
+    _tap("#schedule_page_10")
+    taps = [d for d in _postbacks(sent[-1]) if d.startswith(prefix)]
+    assert taps and all(d.endswith("_10") for d in taps)
+
+    _tap(taps[0])
+    assert _page(sent[-1]) == "11–29 / 29"
+
+
+def test_delete_on_last_row_clamps_to_last_page(sent):
+    _tap("#toggle_schedule_delete_mode")
+    _tap("#schedule_page_29")
+    taps = [d for d in _postbacks(sent[-1]) if d.startswith("#space_delete_")]
+    assert taps == [taps[0]] and taps[0].endswith("_29")
+
+    _tap(taps[0])
+    # 29 行になったので、29 番目（最後の行）から
+    assert _page(sent[-1]) == "29–29 / 29"
@@ -0,0 +1,199 @@
+# 保存先の実装が守ること（全部の保存先で同じテストを流す）
+#   python -m pytest tests/test_storage.py
+# 保存先を足すときは Storage を継承して STORAGE_BACKENDS に登録し、ここに名前を足す。
+import copy
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+import bench
+
+BACKENDS = ["memory", "sqlite", "postgres"]
+
+
+@pytest.fixture(params=BACKENDS)
+def st(request, tmp_path, monkeypatch):
+    kind = request.param
+    if kind == "postgres" and not app.DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL を指定したときだけ（中身は消える）")
+    kwargs = {"path": str(tmp_path / "test.db")} if kind == "sqlite" else {}
+    st = app.make_storage(kind, **kwargs)
+    st.init()
+    st.init()   # 2回目も大丈夫
+    st.save(copy.deepcopy(app.DEFAULT_TASKS))
+    # load_tasks / run_in_uow もこの保存先を使う
+    monkeypatch.setattr(app, "_storage", st)
+    monkeypatch.setattr(app, "STATE_CACHE_ENABLED", False)
+    yield st
+    st.close()
+
+
+@pytest.fixture
+def scoped(st):
+    """版数がユーザー・集会所ごとの保存先だけ（postgres の kv は1行に全部入りで版数も1つ：旧方式）"""
+    if st.name == "postgres" and app.STORAGE_MODE != "relational":
+        pytest.skip("kv は版数が1つなので、別の人の保存ともぶつかる")
+    return st
+
+
+@pytest.fixture
+def data():
+    data = app.normalize_tasks({
+        "users": {"u1": [{"text": "牛乳を買う 🥛", "status": "todo"}, {"text": "done", "status": "done"}],
+                  "u2": [{"text": "u2 の予定", "status": "todo"}]},
+        "checklists": {"u1": [{"title": "旅行", "items": [{"text": "傘", "done": True}, {"text": "充電器", "done": False}]}]},
+        "board": {"users": {"u1": [{"text": "メモ"}]}, "groups": {}},
+        "spaces": {"s1": {"name": "家族", "pass": "aikotoba", "created_by": "u1"}},
+        "memberships": {"u1": ["s1"], "u2": ["s1"]},
+        "active_space": {"u1": "s1", "u2": "s1"},
+        "space_tasks": {"s1": [{"text": "ゴミ出し", "done_mask": 0}]},
+    })
+    app.set_space_task_done(data, "s1", data["space_tasks"]["s1"][0], "u2")
+    return data
+
+
+@pytest.fixture
+def seeded(st, data):
+    st.save(copy.deepcopy(data))
+    return st
+
+
+def test_empty(st):
+    doc = st.load()
+    assert isinstance(doc, app.TaskDoc)
+    assert all(key in doc for key in app.DEFAULT_TASKS) and doc["users"] == {}
+
+
+def test_roundtrip(seeded, data):
+    doc = seeded.load()
+    for section in ("users", "checklists", "spaces", "memberships", "active_space", "space_tasks"):
+        assert doc[section] == data[section], section
+    assert doc["board"]["users"] == data["board"]["users"]
+    assert app.is_space_task_done(doc, "s1", doc["space_tasks"]["s1"][0], "u2")
+
+
+def test_partial_load(seeded, data):
+    doc = seeded.load("u1")
+    assert doc["users"].get("u1") == data["users"]["u1"]
+    # 参加中の集会所の予定も読める
+    assert doc["space_tasks"].get("s1") == data["space_tasks"]["s1"]
+
+
+def test_update(seeded, data):
+    doc = seeded.load("u1")
+    doc["users"]["u1"].append({"text": "追加", "status": "todo"})
+    app.assign_item_ids(doc)
+    new_id = doc["users"]["u1"][-1]["id"]
+    assert seeded.save(doc), "変更があれば書いた範囲を返す"
+
+    doc = seeded.load("u1")
+    assert [t["id"] for t in doc["users"]["u1"]] == [t["id"] for t in data["users"]["u1"]] + [new_id]
+    assert not seeded.save(doc), "変更なしの保存は何も書かない"
+
+    # 1ユーザー分の保存で、他の人・集会所の中身は変わらない
+    whole = seeded.load()
+    assert whole["users"]["u2"] == data["users"]["u2"]
+    assert whole["space_tasks"] == data["space_tasks"]
+
+
+def test_conflict(seeded):
+    a = seeded.load("u1")
+    b = seeded.load("u1")
+    a["users"]["u1"][0]["status"] = "done"
+    seeded.save(a)
+    b["users"]["u1"][0]["text"] = "後から"
+    with pytest.raises(app.StateConflict):
+        seeded.save(b)
+    doc = seeded.load("u1")
+    assert doc["users"]["u1"][0]["status"] == "done"
+    assert doc["users"]["u1"][0]["text"] != "後から"
+
+
+def test_other_users_do_not_conflict(scoped, seeded):
+    # 版数はユーザー・集会所ごと：別のユーザーが間に書いても StateConflict にならない
+    a = seeded.load("u1")
+    b = seeded.load("u2")
+    a["users"]["u1"][0]["text"] = "u1 が書いた"
+    seeded.save(a)
+    b["users"]["u2"][0]["text"] = "u2 が書いた"
+    seeded.save(b)
+    whole = seeded.load()
+    assert whole["users"]["u1"][0]["text"] == "u1 が書いた"
+    assert whole["users"]["u2"][0]["text"] == "u2 が書いた"
+
+
+def test_space_members(seeded):
+    assert seeded.space_members("s1") == ("家族", ["u1", "u2"])
+
+
+def test_join_by_pass(seeded):
+    doc = seeded.load("u3")
+    # get_or_create_space_by_pass() と同じ順（読んである分 → 保存先）。丸ごと読む保存先は読んである分で見つかる
+    sid = app.space_pass_index(doc).get("aikotoba") or seeded.attach_space_by_pass(doc, "aikotoba")
+    assert sid == "s1" and "s1" in doc["space_tasks"]
+    app.join_space(doc, "u3", "s1")
+    app.set_space_task_done(doc, "s1", doc["space_tasks"]["s1"][0], "u3")
+    seeded.save(doc)
+
+    assert seeded.space_members("s1")[1] == ["u1", "u2", "u3"]
+    doc = seeded.load("u1")
+    task = doc["space_tasks"]["s1"][0]
+    # 参加した人の完了も、前からの完了も残る
+    assert app.is_space_task_done(doc, "s1", task, "u2")
+    assert app.is_space_task_done(doc, "s1", task, "u3")
+    assert not app.is_space_task_done(doc, "s1", task, "u1")
+
+
+def test_concurrent_writers_within_retry_budget(scoped):
+    st = scoped
+    """
+    bench と同じ大きさのデータに、8スレッドから run_in_uow で書く（やり直しは本番と同じ STATE_MAX_RETRIES 回まで）。
+    1人5回、個人予定を足す。1回目は集会所の予定の完了も付けるので、同じ集会所の人同士はぶつかる。
+    やり直しきれずに失敗したり、変更が失われたりしないこと
+    """
+    data = bench.build_dataset(app, users=20, spaces=5, size=100, checklists=3)
+    st.save(copy.deepcopy(data))
+    uids = list(data["users"])
+    writes = [(uid, k) for k in range(5) for uid in uids]
+
+    def write(uid, k):
+        def fn():
+            tasks = app.load_tasks(uid)
+            tasks["users"][uid].append({"id": app.new_item_id(), "text": f"{uid}-{k}", "status": "todo"})
+            if k == 0:
+                sid = tasks["active_space"][uid]
+                app.set_space_task_done(tasks, sid, tasks["space_tasks"][sid][0], uid)
+            app.save_tasks(tasks)
+        app.run_in_uow(fn, uid)
+
+    gave_up = ("linebot_state_conflicts_total", (("outcome", "gave_up"),))
+    before = app.metrics.snapshot().get(gave_up, 0)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda w: write(*w), writes))
+    assert app.metrics.snapshot().get(gave_up, 0) == before
+
+    whole = st.load()
+    for uid in uids:
+        texts = [t["text"] for t in whole["users"][uid]]
+        assert sorted(t for t in texts if t.startswith(f"{uid}-")) == [f"{uid}-{k}" for k in range(5)]
+        sid = whole["active_space"][uid]
+        assert app.is_space_task_done(whole, sid, whole["space_tasks"][sid][0], uid), uid
+
+
+def test_space_ids(seeded):
+    ids = [seeded.next_space_id() for _ in range(5)]
+    # 重ならず、今ある s1 とも違う
+    assert len(set(ids)) == 5 and "s1" not in ids
+    assert all(re.fullmatch(r"s[0-9]+", sid) for sid in ids)
+
+
+def test_dedup(st):
+    event_id = f"check-{uuid.uuid4().hex}"
+    assert st.claim_event(event_id), "初めてのイベントは処理してよい"
+    assert not st.claim_event(event_id), "2回目は処理しない"
+    st.release_event(event_id)
+    assert st.claim_event(event_id), "印を消したらもう一度処理してよい"
+    st.ping()
@@ -0,0 +1,35 @@
+# 1イベント = 状態を読むのは1回・書くのも1回まで（全ルート。bench.py --check-uow と同じ確かめ方）
+import pytest
+
+import app
+import bench
+
+DOC = bench.build_dataset(app, users=2, spaces=1, size=3, checklists=1)
+UID = next(iter(DOC["users"]))
+SEND = bench.flask_sender(app)
+
+
+@pytest.mark.parametrize("data", bench.sample_postbacks(app, DOC, UID),
+                         ids=lambda data: app.router.resolve(data)[0].name)
+def test_one_load_and_at_most_one_save(data):
+    # 前のルートで消した・動かした分と、入力待ちの state を戻してから
+    bench.seed(app, DOC)
+    app.user_states.clear()
+    labels = (("route", app.router.resolve(data)[0].name),)
+    before = app.metrics.snapshot()
+    status = SEND(bench.ev_postback(UID, data))
+    after = app.metrics.snapshot()
+
+    def delta(name, extra=()):
+        key = (name, labels + extra)
+        return after.get(key, 0) - before.get(key, 0)
+
+    assert status == 200
+    events = delta("linebot_uow_events_total")
+    assert events == 1
+    assert delta("linebot_uow_loads_total") <= events
+    assert delta("linebot_uow_saves_total") <= events
+    assert not delta("linebot_uow_over_budget_total", (("kind", "load"),))
+    assert not delta("linebot_uow_over_budget_total", (("kind", "save"),))
+    errors = {k: v - before.get(k, 0) for k, v in after.items() if k[0] == "linebot_errors_total"}
+    assert not any(errors.values()), errors